@@ -0,0 +1,406 @@
+import os
+
+import slicer
+from slicer.ScriptedLoadableModule import *
+
+
+#
+# FreeSurferCommon
+#
+
+class FreeSurferCommon(ScriptedLoadableModule):
+    """Hidden module providing the FreeSurferCommonLib package that is shared
+    by the FreeSurfer Commands modules.
+    Uses ScriptedLoadableModule base class, available at:
+    https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
+    """
+
+    def __init__(self, parent):
+        ScriptedLoadableModule.__init__(self, parent)
+        self.parent.title = "FreeSurfer Common"
+        self.parent.categories = ["Segmentation"]
+        self.parent.dependencies = []
+        self.parent.contributors = ["Benjamin Zwick (ISML)"]
+        self.parent.helpText = """Shared functionality of the FreeSurfer Commands modules.
+
+See more information in <a href="https://github.com/SlicerCBM/SlicerFreeSurferCommands">extension documentation</a>.
+"""
+        self.parent.acknowledgementText = """
+This module is part of the FreeSurfer Commands extension.
+"""
+        self.parent.hidden = True
+
+        # Start the FreeSurfer worker (if enabled) after application startup is complete
+        slicer.app.connect("startupCompleted()", startFreeSurferWorker)
+
+
+#
+# Persistent FreeSurfer worker
+#
+
+def startFreeSurferWorker():
+    """
+    Start the FreeSurfer worker shared by the modules, if enabled, see FreeSurferWorker.
+    """
+    from FreeSurferCommonLib import FreeSurferWorker
+    FreeSurferWorker.startShared()
+
+
+#
+# FreeSurferCommonTest
+#
+
+class FreeSurferCommonTest(ScriptedLoadableModuleTest):
+    """
+    Tests of the FreeSurferCommonLib package, which do not need a FreeSurfer installation.
+    Uses ScriptedLoadableModuleTest base class, available at:
+    https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
+    """
+
+    def setUp(self):
+        """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+        """
+        slicer.mrmlScene.Clear()
+
+    def runTest(self):
+        """Run as few or as many tests as needed here.
+        """
+        self.setUp()
+        self.test_VolumeIO()
+        self.test_ResultCache()
+        self.test_CommandOutputParser()
+        self.test_CommandJobWatchdog()
+        self.test_RunFingerprint()
+        self.test_ProcessingWidgetMixin()
+        self.test_ThreadVariables()
+
+    def test_VolumeIO(self):
+        """
+        MGH and NIfTI files are written and read back with the same voxels, type and geometry.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        import struct
+        import tempfile
+        import numpy as np
+        from FreeSurferCommonLib import mapVolumeFile, readVolumeFile, writeVolumeFile
+        from FreeSurferCommonLib.VolumeIO import NIFTI_HEADER_FORMAT, NIFTI_HEADER_SIZE, NIFTI_VOX_OFFSET
+
+        # Oblique geometry with anisotropic spacing
+        ijkToRAS = np.array([
+            [0.0, -1.2, 0.1, 10.0],
+            [0.9, 0.0, 0.0, -20.0],
+            [0.0, 0.1, 2.5, 30.0],
+            [0.0, 0.0, 0.0, 1.0]])
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as tempDir:
+            for dtype in (np.uint8, np.int16, np.int32, np.float32):
+                voxels = (rng.random((7, 8, 9)) * 100).astype(dtype)
+                for extension in ('.mgh', '.mgz', '.nii', '.nii.gz'):
+                    path = os.path.join(tempDir, 'volume' + extension)
+                    writeVolumeFile(path, voxels, ijkToRAS)
+                    readVoxels, readIJKToRAS = readVolumeFile(path)
+                    self.assertEqual(readVoxels.dtype, voxels.dtype, path)
+                    np.testing.assert_array_equal(readVoxels, voxels)
+                    # Geometry is stored in single precision
+                    np.testing.assert_allclose(readIJKToRAS, ijkToRAS, atol=1e-4)
+                    if extension in ('.mgh', '.nii'):
+                        mappedVoxels, mappedIJKToRAS = mapVolumeFile(path)
+                        self.assertEqual(mappedVoxels.shape, (1,) + voxels.shape)
+                        np.testing.assert_array_equal(mappedVoxels[0], voxels)
+                        del mappedVoxels
+
+                # NIfTI-1 header: 348 bytes, voxels at offset 352, geometry in the sform
+                path = os.path.join(tempDir, 'volume.nii')
+                writeVolumeFile(path, voxels, ijkToRAS)
+                self.assertEqual(os.path.getsize(path), NIFTI_VOX_OFFSET + voxels.nbytes)
+                with open(path, 'rb') as f:
+                    fields = struct.unpack('<' + NIFTI_HEADER_FORMAT, f.read(NIFTI_HEADER_SIZE))
+                self.assertEqual(struct.calcsize('<' + NIFTI_HEADER_FORMAT), 348)
+                self.assertEqual(fields[0], 348)
+                self.assertEqual(fields[7:11], (3, 9, 8, 7))
+                niftiTypes = {np.uint8: 2, np.int16: 4, np.int32: 8, np.float32: 16}
+                self.assertEqual(fields[19], niftiTypes[dtype])
+                self.assertEqual(fields[20], voxels.dtype.itemsize * 8)
+                self.assertEqual(fields[30], NIFTI_VOX_OFFSET)
+                self.assertEqual(fields[44:46], (0, 1))
+                np.testing.assert_allclose(np.reshape(fields[52:64], (3, 4)), ijkToRAS[:3], atol=1e-5)
+                self.assertEqual(fields[65], b'n+1\0')
+
+        self.delayDisplay('Test passed')
+
+    def test_ResultCache(self):
+        """
+        Cached files are found by key and the least recently used entries are evicted first.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        import tempfile
+        from FreeSurferCommonLib import ResultCache
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = ResultCache(os.path.join(tempDir, 'cache'), sizeLimitMB=3 / 1024)
+            outputPath = os.path.join(tempDir, 'output.nii')
+            with open(outputPath, 'wb') as f:
+                f.write(bytes(1024))
+
+            self.assertIsNone(cache.lookup('a', ['output.nii']))
+            for i, key in enumerate(['a', 'b', 'c']):
+                cache.store(key, {'output.nii': outputPath})
+                # Distinct access times, 'a' is the oldest entry
+                os.utime(os.path.join(tempDir, 'cache', key), (1000 + i, 1000 + i))
+            paths = cache.lookup('a', ['output.nii'])
+            self.assertEqual(paths, {'output.nii': os.path.join(tempDir, 'cache', 'a', 'output.nii')})
+            self.assertIsNone(cache.lookup('a', ['output.nii', 'missing.nii']))
+
+            # 'a' was used last, so the fourth entry evicts 'b'
+            cache.store('d', {'output.nii': outputPath})
+            self.assertEqual(sorted(os.listdir(os.path.join(tempDir, 'cache'))), ['a', 'c', 'd'])
+            self.assertIsNone(cache.lookup('b', ['output.nii']))
+
+            # A disabled cache has no keys
+            self.assertIsNone(cache.lookup(None, ['output.nii']))
+            cache.store(None, {'output.nii': outputPath})
+            self.assertIsNone(ResultCache(tempDir, enabled=False).key(None, [], 'unknown'))
+
+            cache.clear()
+            self.assertFalse(os.path.exists(os.path.join(tempDir, 'cache')))
+
+        self.delayDisplay('Test passed')
+
+    def test_CommandOutputParser(self):
+        """
+        Processing stages are parsed from the command output and the progress only moves forward.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        from FreeSurferCommonLib import CommandOutputParser
+
+        parser = CommandOutputParser('mri_synthseg')
+        self.assertIsNone(parser.parse('SynthSeg 2.0'))
+        event = parser.parse('using CPU, 4 threads')
+        self.assertEqual((event.command, event.stage), ('mri_synthseg', 'setup'))
+        self.assertAlmostEqual(event.fraction, 0.02)
+        event = parser.parse('predicting 1/4')
+        self.assertEqual(event.stage, 'prediction')
+        self.assertAlmostEqual(event.fraction, 0.1)
+        # Items of the prediction stage, which ends when resampling starts
+        event = parser.parse('predicting 3/4')
+        self.assertEqual(event.stage, 'prediction')
+        self.assertAlmostEqual(event.fraction, 0.1 + 0.7 * 2 / 4)
+        # Earlier stages do not move the progress back
+        self.assertIsNone(parser.parse('loading model'))
+        self.assertEqual(parser.event.stage, 'prediction')
+        event = parser.parse('segmentation saved in: /tmp/seg.nii')
+        self.assertEqual(event.stage, 'writing')
+        self.assertAlmostEqual(event.fraction, 0.9)
+        event = parser.finished()
+        self.assertEqual((event.stage, event.fraction), ('finished', 1.0))
+        self.assertIsNone(event.remainingTime)
+
+        # Second command of a job, doing the second half of the work
+        parser = CommandOutputParser.forCommand(['/usr/local/freesurfer/bin/mri_synthstrip', '-i', 'in.nii'],
+                                                start=0.5, span=0.5)
+        self.assertEqual(parser.command, 'mri_synthstrip')
+        self.assertAlmostEqual(parser.started().fraction, 0.5)
+        self.assertAlmostEqual(parser.parse('Configuring model on the CPU').fraction, 0.525)
+        event = parser.parse('Running SynthStrip model version 1')
+        self.assertEqual(event.stage, 'prediction')
+        self.assertAlmostEqual(event.fraction, 0.6)
+
+        # Commands without known stages
+        parser = CommandOutputParser('mri_watershed')
+        self.assertIsNone(parser.parse('saving brain mask'))
+        self.assertEqual(parser.finished().fraction, 1.0)
+
+        self.delayDisplay('Test passed')
+
+    def test_CommandJobWatchdog(self):
+        """
+        Commands report their progress and are stopped when they write no output for stallTimeout seconds.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        import time
+        from FreeSurferCommonLib import CommandJob, fakeFreeSurferInstallation
+
+        commands = {
+            'mri_synthstrip': '#!/bin/sh\necho "Configuring model on the CPU"\necho "Running SynthStrip model"\n',
+            'mri_hang': '#!/bin/sh\necho started\nexec sleep 60\n',
+            }
+        with fakeFreeSurferInstallation(commands) as home:
+            lines = []
+            job = CommandJob([os.path.join(home, 'bin', 'mri_synthstrip')], onOutput=lines.append, stallTimeout=30)
+            job.run()
+            self.assertEqual(job.status, CommandJob.Succeeded)
+            self.assertEqual(lines, ['Configuring model on the CPU', 'Running SynthStrip model'])
+            self.assertEqual([event.stage for event in job.events],
+                             ['started', 'model loading', 'prediction', 'finished'])
+
+            job = CommandJob([os.path.join(home, 'bin', 'mri_hang')], stallTimeout=1)
+            startTime = time.monotonic()
+            with self.assertRaises(TimeoutError):
+                job.run()
+            self.assertLess(time.monotonic() - startTime, 30)
+            self.assertEqual(job.status, CommandJob.Failed)
+            self.assertIsInstance(job.error, TimeoutError)
+
+        self.delayDisplay('Test passed')
+
+    def test_RunFingerprint(self):
+        """
+        A run is up to date until its inputs, parameters, outputs or the FreeSurfer version change.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        import numpy as np
+        from FreeSurferCommonLib import RunFingerprint, fakeFreeSurferInstallation
+
+        parameterNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScriptedModuleNode')
+        inputVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Input')
+        outputVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output')
+        inputVoxels = np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+        slicer.util.updateVolumeFromArray(inputVolume, inputVoxels)
+        slicer.util.updateVolumeFromArray(outputVolume, (inputVoxels > 50).astype(np.uint8))
+        parameterNode.SetNodeReferenceID('InputVolume', inputVolume.GetID())
+        parameterNode.SetNodeReferenceID('OutputVolume', outputVolume.GetID())
+        parameterNode.SetParameter('BorderThreshold', '1.0')
+
+        def fingerprint():
+            return RunFingerprint(parameterNode, ['InputVolume'], ['OutputVolume'])
+
+        with fakeFreeSurferInstallation(version='freesurfer-test-1'):
+            self.assertFalse(fingerprint().isUpToDate())
+            fingerprint().store()
+            self.assertTrue(fingerprint().isUpToDate())
+
+            # Parameters
+            parameterNode.SetParameter('BorderThreshold', '2.0')
+            self.assertFalse(fingerprint().isUpToDate())
+            parameterNode.SetParameter('BorderThreshold', '1.0')
+            self.assertTrue(fingerprint().isUpToDate())
+
+            # Input content, not its modified time
+            slicer.util.updateVolumeFromArray(inputVolume, inputVoxels + 1)
+            self.assertFalse(fingerprint().isUpToDate())
+            slicer.util.updateVolumeFromArray(inputVolume, inputVoxels.copy())
+            self.assertTrue(fingerprint().isUpToDate())
+
+        with fakeFreeSurferInstallation(version='freesurfer-test-2'):
+            self.assertFalse(fingerprint().isUpToDate())
+
+        with fakeFreeSurferInstallation(version='freesurfer-test-1'):
+            self.assertTrue(fingerprint().isUpToDate())
+
+            # Outputs edited after the run
+            outputVoxels = slicer.util.arrayFromVolume(outputVolume)
+            outputVoxels[0, 0, 0] = 1 - outputVoxels[0, 0, 0]
+            slicer.util.arrayFromVolumeModified(outputVolume)
+            self.assertFalse(fingerprint().isUpToDate())
+
+            fingerprint().store()
+            self.assertTrue(fingerprint().isUpToDate())
+            RunFingerprint.clear(parameterNode)
+            self.assertFalse(fingerprint().isUpToDate())
+
+        self.delayDisplay('Test passed')
+
+    def test_ProcessingWidgetMixin(self):
+        """
+        Jobs of a widget run one at a time, and the fingerprint is only stored when the job succeeds.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        import types
+        import qt
+        from FreeSurferCommonLib import ProcessingWidgetMixin, ProgressEvent, fakeFreeSurferInstallation
+
+        class FakeJob:
+            Pending, Running, Succeeded, Failed, Cancelled = range(5)
+
+            def __init__(self):
+                self.status = self.Pending
+                self.error = None
+
+            def start(self):
+                self.status = self.Running
+
+            def cancel(self):
+                self.status = self.Cancelled
+
+        class Widget(ProcessingWidgetMixin):
+            def __init__(self):
+                ProcessingWidgetMixin.__init__(self)
+                self.ui = types.SimpleNamespace(progressBar=qt.QProgressBar(), cancelButton=qt.QPushButton())
+                self._parameterNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScriptedModuleNode')
+                outputVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Output')
+                self._parameterNode.SetNodeReferenceID('OutputVolume', outputVolume.GetID())
+
+            def fingerprint(self):
+                return self.outdatedFingerprint([], ['OutputVolume'])
+
+        widget = Widget()
+        with fakeFreeSurferInstallation(version='freesurfer-test-1'):
+            first, second = FakeJob(), FakeJob()
+            widget.startJob(first, widget.fingerprint())
+            widget.startJob(second, widget.fingerprint())
+            self.assertEqual((first.status, second.status), (FakeJob.Running, FakeJob.Pending))
+            self.assertTrue(widget.ui.cancelButton.enabled)
+
+            event = ProgressEvent('mri_test', 'stage', 0.5, 0.0, 10.0)
+            widget.onProcessingProgress(event)
+            self.assertEqual(widget.ui.progressBar.value, 50)
+            self.assertEqual(widget.ui.progressBar.format, f'{event.message} (1 queued)')
+
+            # Job stopped without success: the run is not up to date and the queued job starts
+            first.status = FakeJob.Cancelled
+            widget.onProcessingFinished(first)
+            self.assertEqual(second.status, FakeJob.Running)
+            self.assertIsNotNone(widget.fingerprint())
+
+            second.status = FakeJob.Succeeded
+            widget.onProcessingFinished(second)
+            self.assertFalse(widget.ui.cancelButton.enabled)
+            self.assertIsNone(widget.fingerprint())
+
+            # Jobs cancelled by the user never store their fingerprint
+            widget._parameterNode.SetParameter('Threshold', '2')
+            third = FakeJob()
+            widget.startJob(third, widget.fingerprint())
+            widget.onCancelButton()
+            self.assertEqual(third.status, FakeJob.Cancelled)
+            widget.onProcessingFinished(third)
+            self.assertIsNotNone(widget.fingerprint())
+
+        self.delayDisplay('Test passed')
+
+    def test_ThreadVariables(self):
+        """
+        The SynthStrip CLI module, which does not depend on FreeSurferCommon, limits the same
+        thread variables as threadEnvironment().
+        """
+
+        self.delayDisplay("Starting the test")
+
+        import ast
+        from FreeSurferCommonLib.Toolchain import THREAD_VARIABLES
+
+        cliModule = getattr(slicer.modules, 'freesurfersynthstripskullstripcli', None)
+        if cliModule is None:
+            self.delayDisplay('FreeSurferSynthStripSkullStripCLI is not loaded, thread variables are not compared')
+            return
+
+        # Read the list without running the CLI script
+        with open(cliModule.path) as f:
+            tree = ast.parse(f.read())
+        cliVariables = [ast.literal_eval(node.value) for node in tree.body if isinstance(node, ast.Assign)
+                        and [getattr(target, 'id', None) for target in node.targets] == ['THREAD_VARIABLES']]
+        self.assertEqual(cliVariables, [THREAD_VARIABLES])
+
+        self.delayDisplay('Test passed')
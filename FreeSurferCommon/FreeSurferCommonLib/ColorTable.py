@@ -0,0 +1,65 @@
+import os
+
+__all__ = ['parseColorTable', 'getColorTableNode']
+
+# Parsed color tables by file path: (modification time, {label: (name, (r, g, b, a))})
+_colorTables = {}
+
+# Node attribute identifying the color table nodes created from a color table file
+COLOR_TABLE_FILE_ATTRIBUTE = 'FreeSurferCommands.ColorTableFile'
+
+
+def parseColorTable(path):
+    """
+    Parse a color table file in 3D Slicer format (.ctbl), which has the same
+    layout as FreeSurfer's FreeSurferColorLUT.txt ("label name r g b a" per line).
+    The file is only parsed again if it was modified.
+    :param path: color table file
+    :return: dict mapping labels to (name, (r, g, b, a)) with color components in 0-255 range
+    """
+    path = os.path.realpath(path)
+    mtime = os.path.getmtime(path)
+    cached = _colorTables.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    entries = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            label, name = int(fields[0]), fields[1]
+            entries[label] = (name, tuple(int(value) for value in fields[2:6]))
+    _colorTables[path] = (mtime, entries)
+    return entries
+
+
+def getColorTableNode(path, name=None):
+    """
+    Return the color table node created from a color table file, adding it to the scene only once.
+    The node is found again after the scene is saved and reloaded, so repeated runs share a single node.
+    :param path: color table file in 3D Slicer format (.ctbl)
+    :param name: node name, defaults to the file name without extension
+    """
+    import slicer
+
+    path = os.path.realpath(path)
+    for colorNode in slicer.util.getNodesByClass('vtkMRMLColorTableNode'):
+        if colorNode.GetAttribute(COLOR_TABLE_FILE_ATTRIBUTE) == os.path.basename(path):
+            return colorNode
+
+    entries = parseColorTable(path)
+    numberOfColors = max(entries) + 1 if entries else 0
+    colorNode = slicer.vtkMRMLColorTableNode()
+    colorNode.SetName(name if name else os.path.splitext(os.path.basename(path))[0])
+    colorNode.SetTypeToUser()
+    colorNode.SetNumberOfColors(numberOfColors)
+    colorNode.GetLookupTable().SetTableRange(0, max(numberOfColors - 1, 0))
+    colorNode.NamesInitialisedOn()
+    for label, (colorName, (r, g, b, a)) in entries.items():
+        colorNode.SetColor(label, colorName, r / 255.0, g / 255.0, b / 255.0, a / 255.0)
+    # Only the file name is stored so that the node is found when the extension is installed elsewhere
+    colorNode.SetAttribute(COLOR_TABLE_FILE_ATTRIBUTE, os.path.basename(path))
+    slicer.mrmlScene.AddNode(colorNode)
+    return colorNode
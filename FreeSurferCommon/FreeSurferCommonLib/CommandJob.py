@@ -0,0 +1,328 @@
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+from .Profiling import ProcessingStage, ProcessingStats, fileSize, waitForProcess
+from .Progress import CommandOutputParser
+from .Worker import launchCommand
+
+__all__ = ['CommandJob']
+
+
+class CommandJob:
+    """Run FreeSurfer command lines and load their results back into the scene.
+
+    The job can be run either synchronously with run(), or in the background
+    with start() so that the application remains responsive. In the background
+    the command output is read in a worker thread while the callbacks are
+    always called on the main thread, so they can safely modify the scene.
+    Commands are launched with launchCommand(), so Python commands run in the
+    persistent FreeSurfer worker when it is enabled.
+
+    The output lines are parsed as they arrive to report the processing stages
+    of known commands (see CommandOutputParser). A watchdog stops a command
+    that does not write any output for stallTimeout seconds, so that a hung
+    process fails the job instead of blocking it forever.
+
+    :param args: command line to run, a list of command lines to run one after the other
+      (e.g., a pipeline exchanging intermediate files), or None if there is nothing to run
+      (e.g., results are cached)
+    :param onCompleted: called without arguments after all commands succeeded, typically to load the results
+    :param onOutput: called with each line of the command output
+    :param onFinished: called with the job when it succeeded, failed or was cancelled
+    :param stats: ProcessingStats that the commands are recorded in as stages, created if not set;
+      it is finished together with the job
+    :param onProgress: called with a ProgressEvent when a command starts, reaches a new stage or finishes
+    :param stallTimeout: seconds without output after which a command is stopped; 0 disables the watchdog,
+      defaults to the application setting FreeSurferCommands/StallTimeout (1800 seconds)
+    :param environment: environment variables set for the commands (e.g., see threadEnvironment())
+    """
+
+    Pending = 'Pending'
+    Running = 'Running'
+    Succeeded = 'Succeeded'
+    Failed = 'Failed'
+    Cancelled = 'Cancelled'
+
+    DEFAULT_STALL_TIMEOUT = 1800
+
+    def __init__(self, args, onCompleted=None, onOutput=None, onFinished=None, stats=None,
+                 onProgress=None, stallTimeout=None, environment=None):
+        self.args = args
+        if not args:
+            self.commands = []
+        elif isinstance(args[0], (list, tuple)):
+            self.commands = [list(command) for command in args]
+        else:
+            self.commands = [list(args)]
+        self.onCompleted = onCompleted
+        self.onOutput = onOutput
+        self.onFinished = onFinished
+        self.onProgress = onProgress
+        self.stallTimeout = stallTimeout
+        self.environment = environment
+        self.stats = stats if stats is not None else ProcessingStats('CommandJob')
+        self.status = CommandJob.Pending
+        self.error = None
+        # Objects that must be kept alive while the job exists (e.g., temporary folders)
+        self.resources = []
+        # ProgressEvent objects reported for all the commands
+        self.events = []
+        self._commandIndex = 0
+        self._proc = None
+        self._stage = None
+        self._lines = queue.Queue()
+        self._reader = None
+        self._timer = None
+        self._cancelRequested = False
+        self._parser = None
+        self._events = queue.Queue()
+        self._lastOutputTime = None
+        self._stalled = False
+
+    @property
+    def isFinished(self):
+        return self.status in (CommandJob.Succeeded, CommandJob.Failed, CommandJob.Cancelled)
+
+    def run(self):
+        """
+        Run the commands and load the results, blocking until done.
+        Errors are raised as exceptions.
+        """
+        self.status = CommandJob.Running
+        self._resolveStallTimeout()
+        try:
+            for index, command in enumerate(self.commands):
+                logging.info(f"Command: {command}")
+                self._startStage(command, index)
+                self._proc = launchCommand(command, self.environment)
+                finished = self._startWatchdog(self._proc)
+                try:
+                    for line in self._proc.stdout:
+                        self._lastOutputTime = time.monotonic()
+                        line = line.rstrip()
+                        self._parseLine(line)
+                        self._handleEvents()
+                        self._handleLine(line)
+                finally:
+                    finished.set()
+                self._endStage(waitForProcess(self._proc))
+                self._handleEvents()
+                if self._stalled:
+                    raise self._stallError(command)
+                if self._proc.returncode != 0:
+                    raise subprocess.CalledProcessError(self._proc.returncode, command)
+            if self.onCompleted:
+                self.onCompleted()
+        except Exception as e:
+            self.status = CommandJob.Failed
+            self.error = e
+            raise
+        finally:
+            if not self.isFinished:
+                self.status = CommandJob.Succeeded
+            self.stats.finish(self.status)
+            if self.onFinished:
+                self.onFinished(self)
+
+    def start(self):
+        """
+        Start the commands in the background and return immediately.
+        The results are loaded when the last command completes.
+        """
+        import qt
+        if self.status != CommandJob.Pending:
+            raise RuntimeError(f"Job cannot be started in {self.status} state")
+        self.status = CommandJob.Running
+        self._resolveStallTimeout()
+        if not self._launchNextCommand():
+            return
+        self._timer = qt.QTimer()
+        self._timer.setInterval(100)
+        self._timer.connect('timeout()', self._poll)
+        self._timer.start()
+
+    def cancel(self):
+        """
+        Stop the commands by killing the child process.
+        """
+        if self.isFinished:
+            return
+        self._cancelRequested = True
+        if self._proc is not None and self._proc.poll() is None:
+            logging.info(f'Cancelling {self._proc.args[0]}')
+            self._proc.kill()
+        if self.status == CommandJob.Pending:
+            self._finish(CommandJob.Cancelled)
+
+    def wait(self):
+        """
+        Wait until a job started in the background is finished, processing application events meanwhile.
+        """
+        import slicer
+        while not self.isFinished:
+            slicer.app.processEvents()
+            time.sleep(0.01)
+
+    def _launchNextCommand(self):
+        # Start the next command (if any) and a worker thread reading its output
+        self._reader = None
+        if self._commandIndex >= len(self.commands):
+            return True
+        command = self.commands[self._commandIndex]
+        self._commandIndex += 1
+        logging.info(f"Command: {command}")
+        self._startStage(command, self._commandIndex - 1)
+        try:
+            self._proc = launchCommand(command, self.environment)
+        except Exception as e:
+            if self._timer is not None:
+                self._timer.stop()
+            self.error = e
+            self._finish(CommandJob.Failed)
+            return False
+        self._reader = threading.Thread(target=self._readOutput, args=(self._proc,), daemon=True)
+        self._reader.start()
+        return True
+
+    def _readOutput(self, proc):
+        # Runs in the worker thread: only pass the lines and progress events to the main thread
+        finished = self._startWatchdog(proc)
+        try:
+            for line in proc.stdout:
+                self._lastOutputTime = time.monotonic()
+                line = line.rstrip()
+                self._parseLine(line)
+                self._lines.put(line)
+        finally:
+            finished.set()
+        self._peakMemory = waitForProcess(proc)
+
+    def _resolveStallTimeout(self):
+        if self.stallTimeout is None:
+            import qt
+            self.stallTimeout = float(qt.QSettings().value('FreeSurferCommands/StallTimeout',
+                                                           CommandJob.DEFAULT_STALL_TIMEOUT))
+
+    def _startWatchdog(self, proc):
+        # Kill the command if it does not write anything for stallTimeout seconds.
+        # The returned event must be set when the output is read to the end.
+        finished = threading.Event()
+        self._lastOutputTime = time.monotonic()
+        if not self.stallTimeout:
+            return finished
+
+        def watch():
+            while not finished.wait(min(10.0, self.stallTimeout)):
+                if time.monotonic() - self._lastOutputTime > self.stallTimeout:
+                    logging.error(f'{os.path.basename(proc.args[0])} wrote no output for {self.stallTimeout:g} seconds, stopping it')
+                    self._stalled = True
+                    proc.kill()
+                    return
+
+        threading.Thread(target=watch, daemon=True).start()
+        return finished
+
+    def _stallError(self, command):
+        return TimeoutError(f"{os.path.basename(command[0])} stopped after {self.stallTimeout:g} seconds without output")
+
+    def _parseLine(self, line):
+        # May run in the worker thread: events are queued and reported by _handleEvents()
+        event = self._parser.parse(line)
+        if event is not None:
+            self._events.put(event)
+
+    def _handleEvents(self):
+        while True:
+            try:
+                event = self._events.get_nowait()
+            except queue.Empty:
+                break
+            self.events.append(event)
+            if self.onProgress:
+                self.onProgress(event)
+
+    def _startStage(self, command, index):
+        # Each command is a stage, files passed as arguments count as read before and written after it
+        self._stage = ProcessingStage(os.path.basename(command[0]))
+        self._stageFiles = {arg: fileSize(arg) for arg in command[1:] if isinstance(arg, str) and os.path.isabs(arg)}
+        self._stage.bytesRead = sum(self._stageFiles.values())
+        self._stageStartTime = time.perf_counter()
+        self._peakMemory = None
+        self.stats.stages.append(self._stage)
+        # Each command gets an equal part of the job progress
+        self._proc = None
+        self._parser = CommandOutputParser.forCommand(command, index / len(self.commands), 1 / len(self.commands))
+        self._stalled = False
+        self._events.put(self._parser.started())
+        self._handleEvents()
+
+    def _endStage(self, peakMemory):
+        self._stage.wallTime = time.perf_counter() - self._stageStartTime
+        self._stage.peakMemory = peakMemory
+        self._stage.bytesWritten = sum(max(0, fileSize(path) - size) for path, size in self._stageFiles.items())
+        self._stage = None
+        if self._proc is not None and self._proc.returncode == 0:
+            self._events.put(self._parser.finished())
+
+    def _handleLine(self, line):
+        logging.info(line)
+        if self.onOutput:
+            self.onOutput(line)
+
+    def _poll(self):
+        while True:
+            try:
+                line = self._lines.get_nowait()
+            except queue.Empty:
+                break
+            self._handleLine(line)
+        self._handleEvents()
+        if self._reader is not None and self._reader.is_alive():
+            return
+        if self._stage is not None:
+            self._endStage(self._peakMemory)
+            self._handleEvents()
+
+        if self._cancelRequested:
+            self._timer.stop()
+            self._finish(CommandJob.Cancelled)
+            return
+        if self._stalled:
+            self._timer.stop()
+            self.error = self._stallError(self._proc.args)
+            self._finish(CommandJob.Failed)
+            return
+        if self._proc is not None and self._proc.returncode != 0:
+            self._timer.stop()
+            self.error = subprocess.CalledProcessError(self._proc.returncode, self._proc.args)
+            self._finish(CommandJob.Failed)
+            return
+        if self._commandIndex < len(self.commands):
+            self._launchNextCommand()
+            return
+
+        self._timer.stop()
+        try:
+            if self.onCompleted:
+                self.onCompleted()
+        except Exception as e:
+            logging.exception('Loading the processing results failed')
+            self.error = e
+            self._finish(CommandJob.Failed)
+            return
+        self._finish(CommandJob.Succeeded)
+
+    def _finish(self, status):
+        self.status = status
+        if self._stage is not None:
+            self._endStage(None)
+        self.stats.finish(status)
+        if status == CommandJob.Failed:
+            logging.error(f'Processing failed: {self.error}')
+        self.resources = []
+        if self.onFinished:
+            self.onFinished(self)
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+
+__all__ = ['RunFingerprint']
+
+
+class RunFingerprint:
+    """Fingerprint of the last successful run of a module, stored in its parameter node.
+
+    The fingerprint combines the content of the input nodes, all the parameters
+    of the parameter node and the FreeSurfer version. After a successful run it
+    is stored in the parameter node together with a summary of the content of
+    the output nodes and files, so that it is saved with the scene. When the
+    module is applied again with the same fingerprint and the outputs have not
+    been modified or removed since, the run can be skipped.
+
+    Node contents are hashed, not their modified times, so that the fingerprint
+    remains valid after the scene is saved and loaded again. Hashes are cached
+    for the session and only computed again when a node is modified.
+
+    :param parameterNode: parameter node of the module
+    :param inputRoles: node reference roles of the input nodes (e.g., 'InputVolume')
+    :param outputRoles: node reference roles of the output nodes (e.g., 'OutputVolume')
+    :param outputFileParameters: parameters containing the paths of output files (e.g., 'Posteriors')
+    """
+
+    PARAMETER = 'LastRunFingerprint'
+
+    # Node ID -> (modified time, content hash)
+    _contentHashes = {}
+
+    def __init__(self, parameterNode, inputRoles, outputRoles, outputFileParameters=()):
+        self.parameterNode = parameterNode
+        self.inputRoles = list(inputRoles)
+        self.outputRoles = list(outputRoles)
+        self.outputFileParameters = list(outputFileParameters)
+        self.digest = self._inputsDigest()
+
+    def _inputsDigest(self):
+        from .Toolchain import FreeSurferToolchain
+        parameters = {name: self.parameterNode.GetParameter(name)
+                      for name in self.parameterNode.GetParameterNames() if name != self.PARAMETER}
+        inputs = {role: self.contentHash(self.parameterNode.GetNodeReference(role)) for role in self.inputRoles}
+        return hashlib.sha256(json.dumps({
+            'parameters': parameters,
+            'inputs': inputs,
+            'version': FreeSurferToolchain.resolve().version,
+            }, sort_keys=True).encode()).hexdigest()
+
+    def _outputsSummary(self):
+        outputs = {role: self.contentHash(self.parameterNode.GetNodeReference(role)) for role in self.outputRoles}
+        for name in self.outputFileParameters:
+            path = self.parameterNode.GetParameter(name)
+            try:
+                stat = os.stat(path) if path else None
+            except OSError:
+                stat = None
+            outputs[name] = [stat.st_size, stat.st_mtime_ns] if stat else None
+        return outputs
+
+    def isUpToDate(self):
+        """
+        Check whether the last successful run had the same fingerprint and its outputs are intact.
+        """
+        stored = self.parameterNode.GetParameter(self.PARAMETER)
+        if not stored:
+            return False
+        try:
+            stored = json.loads(stored)
+        except ValueError:
+            return False
+        if stored.get('digest') != self.digest:
+            return False
+        outputs = self._outputsSummary()
+        # Outputs not selected (None) cannot be considered up to date
+        if any(outputs[role] is None for role in self.outputRoles if self.parameterNode.GetNodeReference(role)):
+            return False
+        return stored.get('outputs') == outputs
+
+    def store(self):
+        """
+        Record the fingerprint and the current state of the outputs after a successful run.
+        """
+        self.parameterNode.SetParameter(self.PARAMETER, json.dumps({
+            'digest': self.digest,
+            'outputs': self._outputsSummary(),
+            }, sort_keys=True))
+
+    @classmethod
+    def clear(cls, parameterNode):
+        """
+        Forget the last run, so that the next run is not skipped.
+        """
+        parameterNode.UnsetParameter(cls.PARAMETER)
+
+    @classmethod
+    def contentHash(cls, node):
+        """
+        Return a hash of the content of a volume, segmentation, table or markups node,
+        or None if the node is not set or has no content.
+        Other nodes are identified by their modified time, which does not survive saving the scene.
+        """
+        if node is None:
+            return None
+        modifiedTime = cls._modifiedTime(node)
+        cached = cls._contentHashes.get(node.GetID())
+        if cached and cached[0] == modifiedTime:
+            return cached[1]
+        summary = cls._contentSummary(node)
+        if summary is None:
+            return None
+        h = hashlib.sha256()
+        for item in summary:
+            if isinstance(item, (bytes, memoryview)):
+                h.update(item)
+            else:
+                h.update(json.dumps(item, sort_keys=True).encode())
+        contentHash = h.hexdigest()
+        cls._contentHashes[node.GetID()] = (modifiedTime, contentHash)
+        return contentHash
+
+    @staticmethod
+    def _modifiedTime(node):
+        times = [node.GetMTime()]
+        if node.IsA('vtkMRMLVolumeNode') and node.GetImageData():
+            imageData = node.GetImageData()
+            times.append(imageData.GetMTime())
+            if imageData.GetPointData().GetScalars():
+                times.append(imageData.GetPointData().GetScalars().GetMTime())
+        elif node.IsA('vtkMRMLSegmentationNode') and node.GetSegmentation():
+            segmentation = node.GetSegmentation()
+            times.append(segmentation.GetMTime())
+            for layer in range(segmentation.GetNumberOfLayers()):
+                times.append(segmentation.GetLayerDataObject(layer).GetMTime())
+        return max(times)
+
+    @staticmethod
+    def _roundedGeometry(values):
+        # Geometry is compared with a tolerance, as it may be rounded when the scene is saved
+        return [round(float(value), 5) for value in values]
+
+    @classmethod
+    def _contentSummary(cls, node):
+        # Items hashed to identify the content of a node; invariant to saving and loading the scene
+        import numpy as np
+        import slicer
+        if node.IsA('vtkMRMLVolumeNode'):
+            if not node.GetImageData() or not node.GetImageData().GetPointData().GetScalars():
+                return None
+            voxels = slicer.util.arrayFromVolume(node)
+            directions = [[0.0] * 3 for _ in range(3)]
+            node.GetIJKToRASDirections(directions)
+            geometry = {
+                'dtype': voxels.dtype.str,
+                'shape': voxels.shape,
+                'origin': cls._roundedGeometry(node.GetOrigin()),
+                'spacing': cls._roundedGeometry(node.GetSpacing()),
+                'directions': [cls._roundedGeometry(row) for row in directions],
+                }
+            return [geometry, voxels.data if voxels.flags['C_CONTIGUOUS'] else voxels.tobytes()]
+        if node.IsA('vtkMRMLSegmentationNode'):
+            # Voxel count of each segment: does not depend on how segments are
+            # shared in layers or on the extent of the layers, which may change
+            # when the segmentation is saved
+            segmentation = node.GetSegmentation()
+            if segmentation is None or segmentation.GetNumberOfSegments() == 0:
+                return None
+            counts = {}
+            for layer in range(segmentation.GetNumberOfLayers()):
+                labelmap = segmentation.GetLayerDataObject(layer)
+                scalars = labelmap.GetPointData().GetScalars() if labelmap else None
+                counts[layer] = (np.bincount(slicer.util.vtkToNumpy(scalars).ravel().astype(np.int64, copy=False))
+                                 if scalars and scalars.GetNumberOfTuples() else np.zeros(1, np.int64))
+            segments = []
+            for segmentId in segmentation.GetSegmentIDs():
+                segment = segmentation.GetSegment(segmentId)
+                layerCounts = counts.get(segmentation.GetLayerIndex(segmentId))
+                labelValue = segment.GetLabelValue()
+                voxelCount = int(layerCounts[labelValue]) if layerCounts is not None and labelValue < len(layerCounts) else 0
+                segments.append([segmentId, segment.GetName(), voxelCount])
+            return [segments]
+        if node.IsA('vtkMRMLTableNode'):
+            table = node.GetTable()
+            if table is None or table.GetNumberOfColumns() == 0:
+                return None
+            columns = []
+            for columnIndex in range(table.GetNumberOfColumns()):
+                column = table.GetColumn(columnIndex)
+                columns.append([column.GetName()] + [str(column.GetValue(row)) for row in range(column.GetNumberOfTuples())])
+            return [columns]
+        if node.IsA('vtkMRMLMarkupsNode'):
+            points = slicer.util.arrayFromMarkupsControlPoints(node)
+            summary = [node.GetClassName(), cls._roundedGeometry(points.ravel())]
+            if node.IsA('vtkMRMLMarkupsROINode'):
+                summary.append(cls._roundedGeometry(node.GetSize()))
+                matrix = node.GetObjectToWorldMatrix()
+                summary.append(cls._roundedGeometry(matrix.GetElement(row, column) for row in range(4) for column in range(4)))
+            return [summary]
+        # Content of other nodes is not compared: only unchanged during the session
+        logging.debug(f'Content of {node.GetClassName()} nodes is not hashed, using modified time of {node.GetName()}')
+        return [node.GetClassName(), node.GetID(), node.GetMTime(), id(node)]
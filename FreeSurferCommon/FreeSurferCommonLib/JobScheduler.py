@@ -0,0 +1,162 @@
+import importlib
+import inspect
+import logging
+import os
+import time
+
+__all__ = ['JobScheduler']
+
+
+class JobScheduler:
+    """Run a queue of FreeSurfer processing jobs concurrently within a CPU thread budget.
+
+    Each job is described by the module that processes it, its input and output
+    nodes and its parameters, for example:
+
+        scheduler = JobScheduler(maxConcurrentJobs=4, threadBudget=64)
+        scheduler.addJob('FreeSurferSynthStripSkullStripScripted', inputNode, strippedNode, maskNode)
+        scheduler.addJob('FreeSurferSynthSeg', inputNode, segmentationNode, cpu=True, robust=True)
+        scheduler.run()
+
+    At most maxConcurrentJobs jobs run at the same time, and the thread budget is
+    divided among the running jobs: each job is started with an equal share of
+    the threads that are not used by the jobs already running. The share is passed
+    as the threads parameter of the logic's createProcessingJob() method if the
+    module supports it.
+
+    Jobs are prepared (inputs exported) only when they are started, so that the
+    queue can be much longer than what fits in temporary storage. Failed jobs are
+    reported and do not stop the other jobs.
+
+    :param maxConcurrentJobs: maximum number of jobs running at the same time
+    :param threadBudget: total number of CPU threads shared by the running jobs, defaults to the number of CPUs
+    """
+
+    def __init__(self, maxConcurrentJobs=1, threadBudget=None):
+        self.maxConcurrentJobs = max(1, int(maxConcurrentJobs))
+        self.threadBudget = max(1, int(threadBudget if threadBudget else os.cpu_count() or 1))
+        self.onJobFinished = None
+        self._pending = []
+        self._running = []  # (description, threads, job)
+        self._finished = []  # (description, job, duration)
+        self._logics = {}
+        self._startTime = None
+        self._cancelled = False
+
+    def addJob(self, module, *args, **kwargs):
+        """
+        Add a job to the queue.
+        :param module: module name (e.g., 'FreeSurferSynthSeg') or logic instance with a createProcessingJob() method
+        :param args: input and output nodes, as passed to the logic's process() method
+        :param kwargs: processing parameters, as passed to the logic's process() method
+        """
+        self._pending.append((module, args, kwargs))
+
+    def start(self):
+        """
+        Start running the queued jobs in the background and return immediately.
+        """
+        if self._startTime is None:
+            self._startTime = time.time()
+        self._cancelled = False
+        self._startJobs()
+
+    def run(self):
+        """
+        Run all queued jobs, blocking until they are finished.
+        Application events are processed meanwhile, so this also works in batch mode
+        (e.g., Slicer --no-main-window --python-script).
+        :return: statistics, see statistics()
+        """
+        import slicer
+        self.start()
+        while self._pending or self._running:
+            slicer.app.processEvents()
+            time.sleep(0.05)
+        stats = self.statistics()
+        logging.info(f"Processed {stats['succeeded']} jobs ({stats['failed']} failed, {stats['cancelled']} cancelled) "
+                     f"in {stats['elapsedTime']:.1f} seconds ({stats['throughput']:.2f} jobs per hour)")
+        return stats
+
+    def cancel(self):
+        """
+        Cancel running jobs and remove pending jobs from the queue.
+        """
+        self._cancelled = True
+        self._pending = []
+        for _, _, job in list(self._running):
+            job.cancel()
+
+    @property
+    def isRunning(self):
+        return bool(self._running)
+
+    def statistics(self):
+        """
+        Return aggregate statistics of the finished jobs.
+        :return: dict with number of succeeded, failed, cancelled, running and pending jobs,
+          elapsedTime (seconds), throughput (succeeded jobs per hour) and mean job duration (seconds)
+        """
+        from .CommandJob import CommandJob
+        elapsedTime = time.time() - self._startTime if self._startTime else 0.0
+        succeeded = [duration for _, job, duration in self._finished if job.status == CommandJob.Succeeded]
+        return {
+            'succeeded': len(succeeded),
+            'failed': sum(1 for _, job, _ in self._finished if job.status == CommandJob.Failed),
+            'cancelled': sum(1 for _, job, _ in self._finished if job.status == CommandJob.Cancelled),
+            'running': len(self._running),
+            'pending': len(self._pending),
+            'elapsedTime': elapsedTime,
+            'throughput': len(succeeded) * 3600.0 / elapsedTime if elapsedTime > 0 else 0.0,
+            'meanJobDuration': sum(succeeded) / len(succeeded) if succeeded else 0.0,
+        }
+
+    def _logic(self, module):
+        if not isinstance(module, str):
+            return module
+        if module not in self._logics:
+            self._logics[module] = getattr(importlib.import_module(module), module + 'Logic')()
+        return self._logics[module]
+
+    def _startJobs(self):
+        while self._pending and len(self._running) < self.maxConcurrentJobs and not self._cancelled:
+            usedThreads = sum(threads for _, threads, _ in self._running)
+            slots = min(self.maxConcurrentJobs - len(self._running), len(self._pending))
+            threads = max(1, (self.threadBudget - usedThreads) // slots)
+
+            module, args, kwargs = self._pending.pop(0)
+            logic = self._logic(module)
+            description = f"{type(logic).__name__} #{len(self._finished) + len(self._running) + 1}"
+            kwargs = dict(kwargs)
+            if 'threads' in inspect.signature(logic.createProcessingJob).parameters:
+                kwargs['threads'] = threads
+            startTime = time.time()
+
+            def onFinished(job, description=description, startTime=startTime):
+                self._jobFinished(description, job, time.time() - startTime)
+
+            try:
+                job = logic.createProcessingJob(*args, onFinished=onFinished, **kwargs)
+            except Exception as e:
+                # Invalid inputs: report and continue with the next job
+                from .CommandJob import CommandJob
+                logging.error(f"{description} could not be started: {e}")
+                job = CommandJob(None)
+                job.status = CommandJob.Failed
+                job.error = e
+                self._finished.append((description, job, 0.0))
+                continue
+            logging.info(f"Starting {description} with {threads} threads")
+            self._running.append((description, threads, job))
+            job.start()
+
+    def _jobFinished(self, description, job, duration):
+        self._running = [item for item in self._running if item[2] is not job]
+        self._finished.append((description, job, duration))
+        stats = self.statistics()
+        logging.info(f"{description} {job.status.lower()} in {duration:.1f} seconds - "
+                     f"{stats['succeeded']} done, {stats['running']} running, {stats['pending']} pending "
+                     f"({stats['throughput']:.2f} jobs per hour)")
+        if self.onJobFinished:
+            self.onJobFinished(job, stats)
+        self._startJobs()
@@ -0,0 +1,113 @@
+import logging
+
+__all__ = ['ProcessingWidgetMixin']
+
+
+class ProcessingWidgetMixin:
+    """Job queue and progress reporting shared by the module widgets.
+
+    Jobs started from the widget run one at a time in the background, the
+    following ones are queued. The widget must have ``progressBar`` and
+    ``cancelButton`` in its ``ui`` and a ``_parameterNode``; the cancel button
+    is connected to :meth:`onCancelButton` and the callbacks of the jobs to
+    :meth:`onProcessingOutput`, :meth:`onProcessingProgress` and
+    :meth:`onProcessingFinished`.
+
+    Call ``ProcessingWidgetMixin.__init__(self)`` from the widget constructor.
+    """
+
+    def __init__(self):
+        self._jobs = []  # running job followed by queued jobs
+        self._progress = None  # last ProgressEvent of the running job
+        self._fingerprints = {}  # job -> RunFingerprint stored when the job succeeds
+
+    def outdatedFingerprint(self, inputRoles, outputRoles, outputFileParameters=()):
+        """
+        Return the fingerprint of the run, or None if inputs, parameters and outputs are unchanged
+        since the last successful run and the run can be skipped.
+        """
+        import slicer
+        from .Fingerprint import RunFingerprint
+        fingerprint = RunFingerprint(self._parameterNode, inputRoles, outputRoles,
+                                     outputFileParameters=outputFileParameters)
+        if fingerprint.isUpToDate():
+            logging.info('Outputs are up to date, processing skipped')
+            slicer.util.showStatusMessage("Outputs are up to date.", 3000)
+            return None
+        return fingerprint
+
+    def startJob(self, job, fingerprint=None):
+        """
+        Run job in the background, or queue it if another job is running.
+        The fingerprint of the run is stored when the job succeeds.
+        """
+        if fingerprint is not None:
+            self._fingerprints[job] = fingerprint
+        self._jobs.append(job)
+        if len(self._jobs) == 1:
+            job.start()
+        self.updateProgress()
+
+    def onCancelButton(self):
+        """
+        Cancel the running job and all queued jobs.
+        """
+        jobs = self._jobs
+        self._jobs = []
+        # Cancelled jobs never succeed
+        self._fingerprints.clear()
+        for job in jobs:
+            job.cancel()
+        self.updateProgress()
+
+    def onProcessingOutput(self, line):
+        """
+        Show the last line of the command output as progress, until a processing stage is known.
+        """
+        self.updateProgress(line)
+
+    def onProcessingProgress(self, event):
+        """
+        Show the processing stage and the progress of the running job.
+        """
+        self._progress = event if event.fraction > 0 else None
+        self.updateProgress()
+
+    def onProcessingFinished(self, job):
+        """
+        Store the fingerprint of a successful run, report errors and start the next queued job.
+        """
+        import slicer
+        if job in self._jobs:
+            self._jobs.remove(job)
+        self._progress = None
+        fingerprint = self._fingerprints.pop(job, None)
+        if fingerprint is not None and job.status == job.Succeeded:
+            fingerprint.store()
+        if job.status == job.Failed:
+            slicer.util.errorDisplay("Failed to compute results.", detailedText=str(job.error))
+        if self._jobs and self._jobs[0].status == job.Pending:
+            self._jobs[0].start()
+        self.updateProgress()
+
+    def updateProgress(self, text=None):
+        """
+        Update progress bar and cancel button according to the running jobs.
+        """
+        import slicer
+        self.ui.progressBar.visible = bool(self._jobs)
+        self.ui.cancelButton.enabled = bool(self._jobs)
+        if not self._jobs:
+            return
+        # Busy indicator until the stage of the command is known
+        self.ui.progressBar.maximum = 100 if self._progress else 0
+        if self._progress:
+            self.ui.progressBar.value = round(self._progress.fraction * 100)
+            message = self._progress.message
+        else:
+            message = text if text else "Processing..."
+        queued = len(self._jobs) - 1
+        if queued:
+            message = f"{message} ({queued} queued)"
+        self.ui.progressBar.format = message
+        slicer.util.showStatusMessage(message)
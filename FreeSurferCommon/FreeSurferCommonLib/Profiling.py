@@ -0,0 +1,177 @@
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+__all__ = ['ProcessingStage', 'ProcessingStats', 'waitForProcess']
+
+
+class ProcessingStage:
+    """Measurements of one processing stage (e.g., exporting the input, running a command, loading the results).
+
+    :ivar name: stage name
+    :ivar wallTime: elapsed time in seconds
+    :ivar peakMemory: peak resident set size of the child process in bytes, None if no child process was run
+    :ivar bytesRead: number of bytes of the files read in this stage
+    :ivar bytesWritten: number of bytes of the files written in this stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.wallTime = 0.0
+        self.peakMemory = None
+        self.bytesRead = 0
+        self.bytesWritten = 0
+
+    def read(self, *paths):
+        """
+        Count the size of files (or folders) read in this stage. None items are ignored.
+        """
+        self.bytesRead += sum(fileSize(path) for path in paths if path)
+
+    def wrote(self, *paths):
+        """
+        Count the size of files (or folders) written in this stage. None items are ignored.
+        """
+        self.bytesWritten += sum(fileSize(path) for path in paths if path)
+
+    def asDict(self):
+        return {
+            'name': self.name,
+            'wallTime': self.wallTime,
+            'peakMemory': self.peakMemory,
+            'bytesRead': self.bytesRead,
+            'bytesWritten': self.bytesWritten,
+        }
+
+
+class ProcessingStats:
+    """Per-stage timing and resource usage of a processing run.
+
+    Stages are measured with a context manager, for example:
+
+        stats = ProcessingStats('FreeSurferSynthSeg')
+        with stats.stage('export') as stage:
+            exportVolumeNode(inputNode, path)
+            stage.wrote(path)
+        ...
+        stats.finish()
+
+    When the run is finished the statistics are logged and, if the
+    FreeSurferCommands/ProfilingLog application setting is set to a file path,
+    appended to that file as one JSON object per line so that runs can be
+    compared across releases.
+
+    :param name: name of the processing run, typically the module name
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        # Additional information describing the run (e.g., input size, FreeSurfer version)
+        self.info = {}
+        self.status = None
+        self.startTime = time.time()
+        self.totalTime = 0.0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure the wall time of a stage.
+        :return: context manager yielding the ProcessingStage, to record file sizes and memory usage
+        """
+        stage = ProcessingStage(name)
+        self.stages.append(stage)
+        startTime = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.wallTime = time.perf_counter() - startTime
+
+    @property
+    def peakMemory(self):
+        """
+        Peak resident set size of all child processes in bytes, None if no child process was run.
+        """
+        values = [stage.peakMemory for stage in self.stages if stage.peakMemory is not None]
+        return max(values) if values else None
+
+    def finish(self, status='Succeeded', logPath=None):
+        """
+        Complete the statistics, log them and append them to the profiling log.
+        :param status: status of the run
+        :param logPath: JSONL file to append to, defaults to the FreeSurferCommands/ProfilingLog application setting
+        """
+        self.status = status
+        self.totalTime = time.time() - self.startTime
+        logging.info(f'Processing {status.lower()} in {self.totalTime:.2f} seconds ('
+                     + ', '.join(f'{stage.name}: {stage.wallTime:.2f}s' for stage in self.stages) + ')')
+        if logPath is None:
+            logPath = profilingLogPath()
+        if logPath:
+            self.appendToLog(logPath)
+
+    def appendToLog(self, path):
+        """
+        Append the statistics to a JSONL file (one JSON object per line).
+        """
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.asDict()) + '\n')
+
+    def asDict(self):
+        return {
+            'name': self.name,
+            'startTime': datetime.datetime.fromtimestamp(self.startTime).isoformat(),
+            'status': self.status,
+            'totalTime': self.totalTime,
+            'peakMemory': self.peakMemory,
+            'bytesRead': sum(stage.bytesRead for stage in self.stages),
+            'bytesWritten': sum(stage.bytesWritten for stage in self.stages),
+            'info': self.info,
+            'stages': [stage.asDict() for stage in self.stages],
+        }
+
+
+def profilingLogPath():
+    """
+    Return the profiling log file configured in the application settings, or an empty string.
+    """
+    import qt
+    return qt.QSettings().value('FreeSurferCommands/ProfilingLog', '')
+
+
+def fileSize(path):
+    """
+    Return the size of a file, or the total size of the files in a folder, 0 if it does not exist.
+    """
+    if os.path.isdir(path):
+        return sum(fileSize(os.path.join(path, name)) for name in os.listdir(path))
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def waitForProcess(proc):
+    """
+    Wait for a child process to exit and return its peak resident set size.
+    The process is reaped with os.wait4() to get the resource usage of that
+    process only. On platforms without os.wait4() (Windows) the process is
+    waited for normally and None is returned.
+    :return: peak resident set size in bytes, or None if not available
+    """
+    if not hasattr(os, 'wait4') or proc.returncode is not None:
+        proc.wait()
+        return None
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # Already reaped elsewhere
+        proc.wait()
+        return None
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
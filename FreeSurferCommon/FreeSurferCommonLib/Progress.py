@@ -0,0 +1,159 @@
+import os
+import re
+import time
+
+__all__ = ['ProgressEvent', 'CommandOutputParser']
+
+# Known stages of the output of FreeSurfer commands, in order:
+# (pattern of the line starting the stage, stage name, fraction of the command done when the stage starts)
+OUTPUT_STAGES = {
+    'mri_synthseg': [
+        (r'\busing (CPU|GPU)\b|\busing \d+ threads?\b', 'setup', 0.02),
+        (r'\b(loading|building)\b', 'model loading', 0.05),
+        (r'\bpredicting\b', 'prediction', 0.1),
+        (r'\bresampling\b', 'resampling', 0.8),
+        (r'\bsaved (in|to)\b|\bsaving\b|\bwriting\b', 'writing', 0.9),
+    ],
+    'mri_synthstrip': [
+        (r'\bConfiguring model\b', 'model loading', 0.05),
+        (r'\bRunning SynthStrip\b', 'prediction', 0.2),
+        (r'\bresampling\b', 'resampling', 0.8),
+        (r'\bsaved (in|to)\b|\bsaving\b|\bwriting\b', 'writing', 0.9),
+    ],
+}
+
+# Progress of a stage processing several items (e.g., "predicting 3/10" when segmenting a batch)
+ITEM_PROGRESS = re.compile(r'\b(\d+)\s*/\s*(\d+)\b')
+
+
+class ProgressEvent:
+    """Processing stage reached by a command, parsed from its output.
+
+    :param command: command name (e.g., 'mri_synthseg')
+    :param stage: stage name (e.g., 'prediction')
+    :param fraction: fraction of the job done, between 0 and 1
+    :param timestamp: time the event was parsed, in seconds since the epoch
+    :param elapsed: time since the command started, in seconds
+    :param line: output line the event was parsed from
+    :param stageTimestamp: time the stage started, defaults to timestamp
+    """
+
+    def __init__(self, command, stage, fraction, timestamp, elapsed, line='', stageTimestamp=None):
+        self.command = command
+        self.stage = stage
+        self.fraction = fraction
+        self.timestamp = timestamp
+        self.elapsed = elapsed
+        self.line = line
+        self.stageTimestamp = stageTimestamp if stageTimestamp is not None else timestamp
+
+    @property
+    def remainingTime(self):
+        """
+        Rough estimate of the remaining time of the job in seconds, assuming constant speed; None if unknown.
+        """
+        if self.fraction <= 0.05 or self.fraction >= 1:
+            return None
+        return self.elapsed * (1 - self.fraction) / self.fraction
+
+    @property
+    def message(self):
+        message = f"{self.command}: {self.stage} since {time.strftime('%H:%M:%S', time.localtime(self.stageTimestamp))}"
+        if self.remainingTime is not None:
+            message += f", about {max(1, round(self.remainingTime / 60))} min left"
+        return message
+
+    def asDict(self):
+        return {
+            'command': self.command,
+            'stage': self.stage,
+            'fraction': self.fraction,
+            'timestamp': self.timestamp,
+            'stageTimestamp': self.stageTimestamp,
+            'elapsed': self.elapsed,
+            'line': self.line,
+            }
+
+    def __str__(self):
+        return f'{self.message} ({self.fraction:.0%})'
+
+
+class CommandOutputParser:
+    """Turn the output lines of a FreeSurfer command into ProgressEvent objects.
+
+    Stages are recognized with the patterns of OUTPUT_STAGES and only move
+    forward, so that a line matching an earlier stage does not move the
+    progress back. Commands without known stages only report that they
+    started and finished.
+
+    A job running several commands gives each command a part of the job
+    progress, from start to start + span.
+
+    :param command: command name (e.g., 'mri_synthseg')
+    :param stages: list of (pattern, stage name, fraction), defaults to the stages of the command in OUTPUT_STAGES
+    :param start: fraction of the job done when the command starts
+    :param span: fraction of the job done by the command
+    """
+
+    def __init__(self, command, stages=None, start=0.0, span=1.0):
+        self.command = command
+        if stages is None:
+            stages = OUTPUT_STAGES.get(command, [])
+        self.stages = [(re.compile(pattern, re.IGNORECASE), name, fraction) for pattern, name, fraction in stages]
+        self.start = start
+        self.span = span
+        self.stageIndex = -1
+        self.event = None
+        self._startTime = time.perf_counter()
+
+    @classmethod
+    def forCommand(cls, command, start=0.0, span=1.0):
+        """
+        Create the parser of a command line.
+        """
+        return cls(os.path.basename(command[0]), start=start, span=span)
+
+    def _event(self, stage, fraction, line=''):
+        timestamp = time.time()
+        stageTimestamp = self.event.stageTimestamp if self.event and self.event.stage == stage else timestamp
+        self.event = ProgressEvent(self.command, stage, self.start + self.span * min(max(fraction, 0.0), 1.0),
+                                   timestamp, time.perf_counter() - self._startTime, line, stageTimestamp)
+        return self.event
+
+    def started(self):
+        """
+        Return the event of the command start.
+        """
+        self._startTime = time.perf_counter()
+        return self._event('started', 0.0)
+
+    def finished(self):
+        """
+        Return the event of the command end.
+        """
+        return self._event('finished', 1.0)
+
+    def parse(self, line):
+        """
+        Parse an output line.
+        :return: ProgressEvent if the line starts a new stage or advances the current one, None otherwise
+        """
+        # Later stages first: a line may match several stages (e.g., "resampled image saved in")
+        for index in range(len(self.stages) - 1, self.stageIndex, -1):
+            pattern, name, fraction = self.stages[index]
+            if pattern.search(line):
+                self.stageIndex = index
+                return self._event(name, fraction, line)
+        if self.stageIndex < 0:
+            return None
+        # Items processed in the current stage
+        match = ITEM_PROGRESS.search(line)
+        if match and self.stages[self.stageIndex][0].search(line):
+            done, total = int(match.group(1)), int(match.group(2))
+            if 0 < done <= total:
+                stageStart = self.stages[self.stageIndex][2]
+                stageEnd = self.stages[self.stageIndex + 1][2] if self.stageIndex + 1 < len(self.stages) else 1.0
+                # Item 'done' is being processed: the previous items are complete
+                fraction = stageStart + (stageEnd - stageStart) * (done - 1) / total
+                return self._event(self.stages[self.stageIndex][1], fraction, line)
+        return None
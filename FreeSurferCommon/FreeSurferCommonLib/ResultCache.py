@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+__all__ = ['ResultCache', 'freeSurferVersion']
+
+
+def freeSurferVersion(freeSurferHome):
+    """
+    Return the FreeSurfer version string of the installation in freeSurferHome.
+    FreeSurfer records its version in the build-stamp.txt file; 'unknown' is
+    returned when the file is not available.
+    """
+    try:
+        with open(os.path.join(freeSurferHome, 'build-stamp.txt')) as f:
+            return f.read().strip()
+    except OSError:
+        return 'unknown'
+
+
+class ResultCache:
+    """On-disk cache of FreeSurfer command output files.
+
+    Entries are addressed by a hash of the input volume (voxels and geometry),
+    the full command line and the FreeSurfer version, so that running the same
+    command on an unchanged volume loads the stored results instead of
+    recomputing them. The least recently used entries are evicted when the
+    total size of the cache exceeds the size limit.
+
+    The cache is configured with the application settings:
+    - FreeSurferCommands/ResultCacheEnabled: "true" (default) or "false"
+    - FreeSurferCommands/ResultCacheDirectory: defaults to FreeSurferCommands in the Slicer cache folder
+    - FreeSurferCommands/ResultCacheSizeLimitMB: defaults to 2048
+    """
+
+    DEFAULT_SIZE_LIMIT_MB = 2048
+
+    def __init__(self, directory, sizeLimitMB=DEFAULT_SIZE_LIMIT_MB, enabled=True):
+        self.directory = Path(directory)
+        self.sizeLimit = int(sizeLimitMB * 1024 * 1024)
+        self.enabled = enabled
+
+    @classmethod
+    def fromSettings(cls):
+        """
+        Create cache using the directory, size limit and enabled state stored in the application settings.
+        """
+        import qt
+        import slicer
+        settings = qt.QSettings()
+        enabled = str(settings.value('FreeSurferCommands/ResultCacheEnabled', 'true')).lower() == 'true'
+        directory = settings.value('FreeSurferCommands/ResultCacheDirectory', '')
+        if not directory:
+            directory = os.path.join(slicer.app.cachePath, 'FreeSurferCommands')
+        sizeLimitMB = float(settings.value('FreeSurferCommands/ResultCacheSizeLimitMB', cls.DEFAULT_SIZE_LIMIT_MB))
+        return cls(directory, sizeLimitMB, enabled)
+
+    def key(self, volumeNode, args, version):
+        """
+        Compute the cache key of running a command on a volume.
+        :param volumeNode: input volume of the command
+        :param args: full command line; temporary file names must not change from run to run
+        :param version: version of the software running the command
+        :return: hexadecimal key or None if the cache is disabled
+        """
+        if not self.enabled:
+            return None
+
+        import slicer
+        voxels = slicer.util.arrayFromVolume(volumeNode)
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            'dtype': voxels.dtype.str,
+            'shape': voxels.shape,
+            'origin': list(volumeNode.GetOrigin()),
+            'spacing': list(volumeNode.GetSpacing()),
+            'directions': [list(row) for row in self._directions(volumeNode)],
+            'args': [str(arg) for arg in args],
+            'version': version,
+            }, sort_keys=True).encode())
+        if voxels.flags['C_CONTIGUOUS']:
+            h.update(voxels.data)
+        else:
+            h.update(voxels.tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def _directions(volumeNode):
+        directions = [[0.0] * 3 for _ in range(3)]
+        volumeNode.GetIJKToRASDirections(directions)
+        return directions
+
+    def lookup(self, key, fileNames):
+        """
+        Find cached output files.
+        :param key: cache key returned by key()
+        :param fileNames: names of the output files that must be present
+        :return: dict mapping file names to cached file paths, or None if not found
+        """
+        if key is None:
+            return None
+        entry = self.directory / key
+        paths = {name: str(entry / name) for name in fileNames}
+        if not all(os.path.isfile(path) for path in paths.values()):
+            return None
+        # Mark entry as recently used
+        os.utime(entry)
+        logging.info(f'Using cached results {entry}')
+        return paths
+
+    def store(self, key, files):
+        """
+        Copy output files into the cache.
+        :param key: cache key returned by key()
+        :param files: dict mapping file names to the paths of the files to store
+        """
+        if key is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entry = self.directory / key
+        # Write into a staging folder and rename it so that incomplete entries are never visible
+        staging = self.directory / f'.{key}.{uuid.uuid4().hex}'
+        staging.mkdir()
+        try:
+            for name, path in files.items():
+                shutil.copyfile(path, staging / name)
+            if entry.exists():
+                shutil.rmtree(entry, ignore_errors=True)
+            os.replace(staging, entry)
+        except OSError as e:
+            logging.warning(f'Failed to store results in cache: {e}')
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in the size limit.
+        """
+        entries = []
+        for entry in self.directory.iterdir():
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+            entries.append((entry.stat().st_mtime, size, entry))
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if totalSize <= self.sizeLimit:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            totalSize -= size
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        if self.directory.exists():
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,53 @@
+import os
+from pathlib import Path
+
+__all__ = ['StagingArea']
+
+
+class StagingArea:
+    """Temporary folder for the image files exchanged with FreeSurfer commands.
+
+    The files only exist for the duration of a run, so by default they are
+    written in uncompressed NIfTI format to avoid compressing and decompressing
+    every volume twice per run. The format and the folder where the temporary
+    folders are created (e.g., /dev/shm to stay in memory) are configured with
+    the application settings:
+    - FreeSurferCommands/StagingFormat: ".nii" (default), ".mgh", ".mgz" or ".nii.gz"
+    - FreeSurferCommands/StagingDirectory: defaults to the system temporary folder
+
+    :param supportedFormats: file formats that can be read and written by the command;
+      the default format is used if the configured one is not supported
+    """
+
+    FORMATS = ('.nii', '.mgh', '.mgz', '.nii.gz')
+    DEFAULT_FORMAT = '.nii'
+
+    def __init__(self, supportedFormats=FORMATS, fileFormat=None, directory=None):
+        import qt
+        settings = qt.QSettings()
+        if fileFormat is None:
+            fileFormat = settings.value('FreeSurferCommands/StagingFormat', StagingArea.DEFAULT_FORMAT)
+        if fileFormat not in supportedFormats:
+            fileFormat = StagingArea.DEFAULT_FORMAT
+        if directory is None:
+            directory = settings.value('FreeSurferCommands/StagingDirectory', '')
+        self.extension = fileFormat
+        if directory:
+            self.temporaryDir = qt.QTemporaryDir(os.path.join(directory, 'FreeSurferCommands-XXXXXX'))
+        else:
+            self.temporaryDir = qt.QTemporaryDir()
+        if not self.temporaryDir.isValid():
+            raise OSError(f"Failed to create temporary folder in {directory or 'system temporary folder'}")
+        self.path = Path(self.temporaryDir.path())
+
+    def fileName(self, name):
+        """
+        Return file name in the staging format, without folder.
+        """
+        return name + self.extension
+
+    def file(self, name):
+        """
+        Return path of a file in the staging format in the temporary folder.
+        """
+        return str(self.path / self.fileName(name))
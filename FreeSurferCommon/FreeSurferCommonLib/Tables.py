@@ -0,0 +1,53 @@
+import numpy as np
+
+__all__ = ['appendTableRows', 'updateTableFromColumns']
+
+
+def updateTableFromColumns(tableNode, columns):
+    """
+    Replace the content of a table node with the given columns.
+    Numeric columns are copied at once from NumPy arrays.
+    :param tableNode: vtkMRMLTableNode to update
+    :param columns: list of (column name, values), values being a list of strings or a numeric array
+    """
+    import vtk
+    from vtk.util import numpy_support
+
+    wasModified = tableNode.StartModify()
+    tableNode.RemoveAllColumns()
+    for name, values in columns:
+        values = np.asarray(values)
+        if values.dtype.kind in 'OSU':
+            array = vtk.vtkStringArray()
+            array.SetNumberOfValues(len(values))
+            for index, value in enumerate(values):
+                array.SetValue(index, str(value))
+        else:
+            array = numpy_support.numpy_to_vtk(np.ascontiguousarray(values), deep=True)
+        array.SetName(name)
+        tableNode.AddColumn(array)
+    tableNode.Modified()
+    tableNode.EndModify(wasModified)
+
+
+def appendTableRows(tableNode, columns):
+    """
+    Append rows to a table node, for example to aggregate the results of several subjects in one table.
+    If the table does not have the same columns, its content is replaced.
+    :param tableNode: vtkMRMLTableNode to update
+    :param columns: list of (column name, values), all with the same number of values (rows to append)
+    """
+    table = tableNode.GetTable()
+    names = [name for name, _ in columns]
+    if [table.GetColumnName(index) for index in range(table.GetNumberOfColumns())] != names:
+        updateTableFromColumns(tableNode, columns)
+        return
+
+    wasModified = tableNode.StartModify()
+    for index, (_, values) in enumerate(columns):
+        array = table.GetColumn(index)
+        for value in values:
+            array.InsertNextValue(value if array.IsNumeric() else str(value))
+    table.Modified()
+    tableNode.Modified()
+    tableNode.EndModify(wasModified)
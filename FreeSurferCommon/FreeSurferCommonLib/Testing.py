@@ -0,0 +1,40 @@
+import contextlib
+import os
+import tempfile
+
+__all__ = ['fakeFreeSurferInstallation']
+
+
+@contextlib.contextmanager
+def fakeFreeSurferInstallation(commands=None, version='freesurfer-test'):
+    """
+    Create a temporary FreeSurfer installation folder with fake commands and use it as FREESURFER_HOME,
+    so that the modules can be tested without FreeSurfer. The result cache is disabled meanwhile,
+    so that the commands are run every time.
+    :param commands: dict mapping command names (e.g., 'mri_synthseg') to the content of executable scripts
+    :param version: FreeSurfer version recorded in the installation folder
+    :return: context manager yielding the installation folder
+    """
+    import qt
+    settings = qt.QSettings()
+    cacheEnabled = settings.value('FreeSurferCommands/ResultCacheEnabled', 'true')
+    freeSurferHome = os.environ.get('FREESURFER_HOME')
+    with tempfile.TemporaryDirectory() as home:
+        os.mkdir(os.path.join(home, 'bin'))
+        with open(os.path.join(home, 'build-stamp.txt'), 'w') as f:
+            f.write(version + '\n')
+        for name, script in (commands or {}).items():
+            path = os.path.join(home, 'bin', name)
+            with open(path, 'w') as f:
+                f.write(script)
+            os.chmod(path, 0o755)
+        os.environ['FREESURFER_HOME'] = home
+        settings.setValue('FreeSurferCommands/ResultCacheEnabled', 'false')
+        try:
+            yield home
+        finally:
+            settings.setValue('FreeSurferCommands/ResultCacheEnabled', cacheEnabled)
+            if freeSurferHome is None:
+                os.environ.pop('FREESURFER_HOME', None)
+            else:
+                os.environ['FREESURFER_HOME'] = freeSurferHome
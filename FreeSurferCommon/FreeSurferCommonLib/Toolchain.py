@@ -0,0 +1,140 @@
+import logging
+import os
+import subprocess
+
+from .ResultCache import freeSurferVersion
+
+__all__ = ['FreeSurferToolchain', 'threadEnvironment']
+
+# Environment variables limiting the threads of the numerical libraries used by the
+# FreeSurfer Python commands (PyTorch and TensorFlow CPU kernels, BLAS, NumExpr)
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS')
+
+
+def threadEnvironment(threads):
+    """
+    Return the environment variables limiting a command to a number of CPU threads.
+    :param threads: number of threads, None or 0 for the default of the libraries (all CPU cores)
+    """
+    if not threads:
+        return {}
+    return {name: str(int(threads)) for name in THREAD_VARIABLES}
+
+
+class FreeSurferToolchain:
+    """FreeSurfer installation used to run the commands, validated once per session.
+
+    The installation folder is checked when the toolchain is resolved, so that a
+    missing or wrong FREESURFER_HOME is reported with a clear error before any
+    volume is exported. The version, the paths of the commands, the options they
+    support and the environment of the commands are determined on first use and
+    cached, so that batch runs do not repeat this work for every volume.
+
+    Use FreeSurferToolchain.resolve() to get the toolchain shared by all modules.
+
+    :param home: FreeSurfer installation folder
+    """
+
+    _resolved = {}
+
+    def __init__(self, home):
+        if not home:
+            raise OSError("FreeSurfer installation not found: "
+                          "set the FREESURFER_HOME environment variable to the FreeSurfer installation folder")
+        self.home = os.path.abspath(home)
+        self.binDirectory = os.path.join(self.home, 'bin')
+        if not os.path.isdir(self.binDirectory):
+            raise OSError(f"FREESURFER_HOME is not a FreeSurfer installation folder ({self.binDirectory} not found): {home}")
+        self.version = freeSurferVersion(self.home)
+        self._environment = None
+        self._binaries = {}
+        self._flags = {}
+
+    @classmethod
+    def resolve(cls, home=None):
+        """
+        Return the toolchain of a FreeSurfer installation, validated on first use.
+        :param home: FreeSurfer installation folder, defaults to the FREESURFER_HOME environment variable
+        """
+        if home is None:
+            home = os.environ.get('FREESURFER_HOME')
+        toolchain = cls._resolved.get(home)
+        if toolchain is None:
+            # Invalid installations are not cached, so that they can be fixed during the session
+            toolchain = cls(home)
+            cls._resolved[home] = toolchain
+            logging.info(f'FreeSurfer {toolchain.version} found in {toolchain.home}')
+        return toolchain
+
+    @classmethod
+    def forCommand(cls, command):
+        """
+        Return the toolchain of the installation a command line belongs to, or None.
+        """
+        binDirectory = os.path.dirname(os.path.abspath(command[0]))
+        if os.path.basename(binDirectory) != 'bin':
+            return None
+        try:
+            return cls.resolve(os.path.dirname(binDirectory))
+        except OSError:
+            return None
+
+    @property
+    def environment(self):
+        """
+        Environment of the FreeSurfer commands: the environment Slicer was started from
+        (without the Slicer Python environment), with FREESURFER_HOME set.
+        """
+        if self._environment is None:
+            import slicer
+            environment = slicer.util.startupEnvironment()
+            # Use system Python environment
+            environment.pop('PYTHONHOME', None)
+            environment['FREESURFER_HOME'] = self.home
+            self._environment = environment
+        return self._environment
+
+    def binary(self, name):
+        """
+        Return the path of a FreeSurfer command.
+        Raises an error if the command is not available in this FreeSurfer version.
+        """
+        path = self._binaries.get(name)
+        if path is None:
+            path = os.path.join(self.binDirectory, name)
+            if not (os.path.isfile(path) and os.access(path, os.X_OK)):
+                raise FileNotFoundError(f"{name} not found in {self.binDirectory} (FreeSurfer {self.version})")
+            self._binaries[name] = path
+        return path
+
+    def supportsFlag(self, name, flag):
+        """
+        Check whether a FreeSurfer command accepts a command line option (e.g., '--v1').
+        Python commands are checked by reading their source; other commands by running them with --help.
+        """
+        key = (name, flag)
+        if key not in self._flags:
+            path = self.binary(name)
+            with open(path, 'rb') as f:
+                source = f.read()
+            if source.startswith(b'#!') and b'python' in source.split(b'\n', 1)[0]:
+                text = source.decode('utf-8', 'replace')
+                supported = f"'{flag}'" in text or f'"{flag}"' in text
+            else:
+                try:
+                    helpText = subprocess.run([path, '--help'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                              universal_newlines=True, env=self.environment, timeout=60).stdout
+                except (OSError, subprocess.TimeoutExpired):
+                    helpText = ''
+                supported = flag in helpText.split()
+            self._flags[key] = supported
+        return self._flags[key]
+
+    def checkFlags(self, name, flags):
+        """
+        Raise an error if a FreeSurfer command does not accept some command line options.
+        """
+        unsupported = [flag for flag in flags if not self.supportsFlag(name, flag)]
+        if unsupported:
+            raise ValueError(f"{name} of FreeSurfer {self.version} does not support {', '.join(unsupported)}")
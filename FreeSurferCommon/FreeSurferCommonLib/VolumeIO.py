@@ -0,0 +1,412 @@
+import gzip
+import struct
+
+import numpy as np
+
+__all__ = ['readMGH', 'writeMGH', 'readNIfTI', 'writeNIfTI', 'readVolumeFile', 'writeVolumeFile', 'mapVolumeFile',
+           'exportVolumeNode', 'importVolumeNode', 'importArrayToVolumeNode', 'importLabelmapToSegmentationNode',
+           'importSegmentationNode']
+
+# FreeSurfer MGH file format
+# See: https://surfer.nmr.mgh.harvard.edu/fswiki/FsTutorial/MghFormat
+MGH_VERSION = 1
+MGH_HEADER_SIZE = 284
+MGH_UCHAR = 0
+MGH_INT = 1
+MGH_FLOAT = 3
+MGH_SHORT = 4
+
+MGH_DTYPES = {
+    MGH_UCHAR: np.dtype('>u1'),
+    MGH_INT: np.dtype('>i4'),
+    MGH_FLOAT: np.dtype('>f4'),
+    MGH_SHORT: np.dtype('>i2'),
+}
+
+
+# NIfTI-1 file format
+# See: https://nifti.nimh.nih.gov/nifti-1
+NIFTI_HEADER_FORMAT = 'i10s18sihcc8h3fhhhh8ffffhccffffii80s24shh6f4f4f4f16s4s'
+NIFTI_HEADER_SIZE = 348
+NIFTI_VOX_OFFSET = 352
+
+NIFTI_DTYPES = {
+    2: np.dtype('u1'),
+    4: np.dtype('i2'),
+    8: np.dtype('i4'),
+    16: np.dtype('f4'),
+    64: np.dtype('f8'),
+    256: np.dtype('i1'),
+    512: np.dtype('u2'),
+    768: np.dtype('u4'),
+    1024: np.dtype('i8'),
+    1280: np.dtype('u8'),
+}
+
+
+def _open(path, mode):
+    # .mgz and .nii.gz files are gzip compressed .mgh and .nii files
+    if str(path).endswith(('.mgz', '.gz')):
+        return gzip.open(path, mode, compresslevel=1) if 'w' in mode else gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _mghType(dtype):
+    """
+    Return the MGH type that can store values of dtype without loss.
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.uint8 or dtype == np.bool_:
+        return MGH_UCHAR
+    if dtype in (np.int8, np.int16):
+        return MGH_SHORT
+    if dtype in (np.uint16, np.int32):
+        return MGH_INT
+    if dtype.kind in 'iu':
+        # Wider integer types (typically labels) are stored as int when possible
+        return MGH_INT
+    return MGH_FLOAT
+
+
+def writeMGH(path, voxels, ijkToRAS):
+    """
+    Write a volume in FreeSurfer MGH format (compressed if the file name ends with .mgz).
+    :param path: output file name
+    :param voxels: scalar voxel array indexed as [k, j, i], as returned by slicer.util.arrayFromVolume
+    :param ijkToRAS: 4x4 IJK to RAS matrix of the volume
+    """
+    voxels = np.asarray(voxels)
+    if voxels.ndim != 3:
+        raise ValueError(f"Only scalar volumes can be written in MGH format (array shape {voxels.shape})")
+    mghType = _mghType(voxels.dtype)
+    if mghType == MGH_INT and voxels.dtype.kind in 'iu' and voxels.dtype.itemsize > 4 and voxels.size:
+        if voxels.min() < np.iinfo(np.int32).min or voxels.max() > np.iinfo(np.int32).max:
+            mghType = MGH_FLOAT
+
+    ijkToRAS = np.asarray(ijkToRAS, dtype=float)
+    spacing = np.linalg.norm(ijkToRAS[:3, :3], axis=0)
+    directions = ijkToRAS[:3, :3] / spacing
+    # MGH files store the RAS coordinates of the center of the volume instead of the origin
+    depth, height, width = voxels.shape
+    center = ijkToRAS @ np.array([width / 2, height / 2, depth / 2, 1.0])
+
+    header = struct.pack('>7i', MGH_VERSION, width, height, depth, 1, mghType, 0)
+    header += struct.pack('>h', 1)  # goodRASFlag
+    header += struct.pack('>3f', *spacing)
+    header += struct.pack('>9f', *directions.T.flatten())
+    header += struct.pack('>3f', *center[:3])
+    header += b'\0' * (MGH_HEADER_SIZE - len(header))
+
+    # Voxels are stored with i varying fastest, which is the memory layout of the [k, j, i] array
+    data = np.ascontiguousarray(voxels, dtype=MGH_DTYPES[mghType])
+    with _open(path, 'wb') as f:
+        f.write(header)
+        f.write(memoryview(data).cast('B'))
+
+
+def _readMGHHeader(header, path):
+    """
+    Parse the header of an MGH file.
+    :return: array shape as (frames, depth, height, width), voxel data type (big endian) and 4x4 IJK to RAS matrix
+    """
+    version, width, height, depth, frames, mghType, dof = struct.unpack('>7i', header[:28])
+    if version != MGH_VERSION:
+        raise ValueError(f"Unsupported MGH file version {version} in {path}")
+    if mghType not in MGH_DTYPES:
+        raise ValueError(f"Unsupported MGH data type {mghType} in {path}")
+    goodRASFlag, = struct.unpack('>h', header[28:30])
+
+    ijkToRAS = np.eye(4)
+    if goodRASFlag > 0:
+        spacing = np.array(struct.unpack('>3f', header[30:42]))
+        directions = np.array(struct.unpack('>9f', header[42:78])).reshape((3, 3)).T
+        center = np.array(struct.unpack('>3f', header[78:90]))
+        ijkToRAS[:3, :3] = directions * spacing
+        ijkToRAS[:3, 3] = center - ijkToRAS[:3, :3] @ np.array([width / 2, height / 2, depth / 2])
+    else:
+        # Default FreeSurfer orientation (coronal, LIA)
+        ijkToRAS[:3, :3] = np.array([[-1, 0, 0], [0, 0, 1], [0, -1, 0]])
+        ijkToRAS[:3, 3] = -ijkToRAS[:3, :3] @ np.array([width / 2, height / 2, depth / 2])
+    return (frames, depth, height, width), MGH_DTYPES[mghType], ijkToRAS
+
+
+def readMGH(path):
+    """
+    Read a volume in FreeSurfer MGH format (compressed if the file name ends with .mgz).
+    :param path: input file name
+    :return: voxel array indexed as [k, j, i] (or [frame, k, j, i] for multi-frame volumes) and 4x4 IJK to RAS matrix
+    """
+    with _open(path, 'rb') as f:
+        shape, dtype, ijkToRAS = _readMGHHeader(f.read(MGH_HEADER_SIZE), path)
+        count = int(np.prod(shape))
+        data = f.read(count * dtype.itemsize)
+
+    voxels = np.frombuffer(data, dtype=dtype, count=count).astype(dtype.newbyteorder('='))
+    return voxels.reshape(shape[1:] if shape[0] == 1 else shape), ijkToRAS
+
+
+def writeNIfTI(path, voxels, ijkToRAS):
+    """
+    Write a volume in NIfTI-1 format (compressed if the file name ends with .nii.gz).
+    :param path: output file name
+    :param voxels: scalar voxel array indexed as [k, j, i], as returned by slicer.util.arrayFromVolume
+    :param ijkToRAS: 4x4 IJK to RAS matrix of the volume
+    """
+    voxels = np.asarray(voxels)
+    if voxels.ndim != 3:
+        raise ValueError(f"Only scalar volumes can be written in NIfTI format (array shape {voxels.shape})")
+    if voxels.dtype == np.bool_:
+        voxels = voxels.astype(np.uint8)
+    dtype = voxels.dtype.newbyteorder('<')
+    datatypes = {value: key for key, value in NIFTI_DTYPES.items()}
+    if dtype.newbyteorder('=') not in datatypes:
+        raise ValueError(f"Voxel type {voxels.dtype} cannot be written in NIfTI format")
+    datatype = datatypes[dtype.newbyteorder('=')]
+
+    ijkToRAS = np.asarray(ijkToRAS, dtype=float)
+    spacing = np.linalg.norm(ijkToRAS[:3, :3], axis=0)
+    depth, height, width = voxels.shape
+    # NIfTI world coordinates are RAS, so the IJK to RAS matrix is stored as is in the sform
+    header = struct.pack('<' + NIFTI_HEADER_FORMAT,
+                         NIFTI_HEADER_SIZE, b'', b'', 0, 0, b'r', b'\0',
+                         3, width, height, depth, 1, 1, 1, 1,
+                         0.0, 0.0, 0.0, 0, datatype, dtype.itemsize * 8, 0,
+                         1.0, *spacing, 0.0, 0.0, 0.0, 0.0,
+                         float(NIFTI_VOX_OFFSET), 1.0, 0.0, 0, b'\0', b'\x02',  # xyzt_units: mm
+                         0.0, 0.0, 0.0, 0.0, 0, 0,
+                         b'', b'',
+                         0, 1,  # qform_code, sform_code (scanner)
+                         0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+                         *ijkToRAS[0], *ijkToRAS[1], *ijkToRAS[2],
+                         b'', b'n+1\0')
+
+    data = np.ascontiguousarray(voxels, dtype=dtype)
+    with _open(path, 'wb') as f:
+        f.write(header)
+        f.write(b'\0' * (NIFTI_VOX_OFFSET - NIFTI_HEADER_SIZE))
+        f.write(memoryview(data).cast('B'))
+
+
+def _readNIfTIHeader(header, path):
+    """
+    Parse the header of a NIfTI-1 file.
+    :return: array shape as (frames, depth, height, width), voxel data type (in file byte order),
+      offset of the voxels in the file, intensity scaling (None if not scaled) and 4x4 IJK to RAS matrix
+    """
+    endian = '<' if struct.unpack('<i', header[:4])[0] == NIFTI_HEADER_SIZE else '>'
+    fields = struct.unpack(endian + NIFTI_HEADER_FORMAT, header)
+    dim = fields[7:15]
+    datatype = fields[19]
+    pixdim = fields[22:30]
+    voxOffset = int(fields[30])
+    sclSlope, sclInter = fields[31:33]
+    qformCode, sformCode = fields[44:46]
+    quatern = fields[46:49]
+    qoffset = fields[49:52]
+    srow = np.array(fields[52:64]).reshape((3, 4))
+    if fields[65] not in (b'n+1\0', b'ni1\0'):
+        raise ValueError(f"Not a NIfTI-1 file: {path}")
+    if datatype not in NIFTI_DTYPES:
+        raise ValueError(f"Unsupported NIfTI data type {datatype} in {path}")
+    dtype = NIFTI_DTYPES[datatype].newbyteorder(endian)
+    width, height, depth, frames = [max(1, dim[index]) for index in range(1, 5)]
+
+    # A zero or undefined (NaN, as written by nibabel) slope means no scaling
+    scaling = None
+    if np.isfinite(sclSlope) and sclSlope != 0.0:
+        sclInter = sclInter if np.isfinite(sclInter) else 0.0
+        if sclSlope != 1.0 or sclInter != 0.0:
+            scaling = (sclSlope, sclInter)
+
+    ijkToRAS = np.eye(4)
+    if sformCode > 0:
+        ijkToRAS[:3, :] = srow
+    elif qformCode > 0:
+        b, c, d = quatern
+        a = np.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+        rotation = np.array([
+            [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+            [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+            [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]])
+        qfac = -1.0 if pixdim[0] < 0 else 1.0
+        ijkToRAS[:3, :3] = rotation * np.array([pixdim[1], pixdim[2], qfac * pixdim[3]])
+        ijkToRAS[:3, 3] = qoffset
+    else:
+        ijkToRAS[:3, :3] = np.diag(pixdim[1:4])
+    return (frames, depth, height, width), dtype, voxOffset, scaling, ijkToRAS
+
+
+def readNIfTI(path):
+    """
+    Read a volume in NIfTI-1 format (compressed if the file name ends with .nii.gz).
+    :param path: input file name
+    :return: voxel array indexed as [k, j, i] (or [frame, k, j, i] for 4D volumes) and 4x4 IJK to RAS matrix
+    """
+    with _open(path, 'rb') as f:
+        shape, dtype, voxOffset, scaling, ijkToRAS = _readNIfTIHeader(f.read(NIFTI_HEADER_SIZE), path)
+        f.read(voxOffset - NIFTI_HEADER_SIZE)
+        count = int(np.prod(shape))
+        data = f.read(count * dtype.itemsize)
+
+    voxels = np.frombuffer(data, dtype=dtype, count=count).astype(dtype.newbyteorder('='))
+    voxels = voxels.reshape(shape[1:] if shape[0] == 1 else shape)
+    if scaling:
+        voxels = voxels.astype(np.float32) * scaling[0] + scaling[1]
+    return voxels, ijkToRAS
+
+
+def writeVolumeFile(path, voxels, ijkToRAS):
+    """
+    Write a volume in MGH or NIfTI format depending on the file name extension.
+    """
+    if str(path).endswith(('.nii', '.nii.gz')):
+        writeNIfTI(path, voxels, ijkToRAS)
+    else:
+        writeMGH(path, voxels, ijkToRAS)
+
+
+def readVolumeFile(path):
+    """
+    Read a volume in MGH or NIfTI format depending on the file name extension.
+    """
+    if str(path).endswith(('.nii', '.nii.gz')):
+        return readNIfTI(path)
+    return readMGH(path)
+
+
+def mapVolumeFile(path):
+    """
+    Memory-map the voxels of an uncompressed MGH or NIfTI file instead of reading them,
+    so that only the parts of the array that are accessed are read from disk.
+    Intensity scaling of NIfTI files is not applied.
+    :param path: .mgh or .nii file name
+    :return: read-only voxel array indexed as [frame, k, j, i] and 4x4 IJK to RAS matrix
+    """
+    path = str(path)
+    if path.endswith(('.mgz', '.gz')):
+        raise ValueError(f"Compressed files cannot be memory-mapped: {path}")
+    with open(path, 'rb') as f:
+        if path.endswith('.nii'):
+            shape, dtype, offset, _, ijkToRAS = _readNIfTIHeader(f.read(NIFTI_HEADER_SIZE), path)
+        else:
+            shape, dtype, ijkToRAS = _readMGHHeader(f.read(MGH_HEADER_SIZE), path)
+            offset = MGH_HEADER_SIZE
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape), ijkToRAS
+
+
+def exportVolumeNode(volumeNode, path, extent=None):
+    """
+    Write the voxels of a volume node to an MGH or NIfTI file without going through MRML storage nodes.
+    The volume is written in its own coordinate system (parent transforms are not applied),
+    the same way as slicer.util.exportNode.
+    :param extent: optional (imin, imax, jmin, jmax, kmin, kmax) voxel range to write (inclusive, as VTK extents),
+      to write only a part of the volume without copying the rest
+    """
+    import slicer
+    import vtk
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    voxels = slicer.util.arrayFromVolume(volumeNode)
+    ijkToRAS = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+    if extent is not None:
+        imin, imax, jmin, jmax, kmin, kmax = extent
+        voxels = voxels[kmin:kmax + 1, jmin:jmax + 1, imin:imax + 1]
+        ijkToRAS = ijkToRAS.copy()
+        ijkToRAS[:, 3] = ijkToRAS @ np.array([imin, jmin, kmin, 1.0])
+    writeVolumeFile(path, voxels, ijkToRAS)
+
+
+def importVolumeNode(path, volumeNode):
+    """
+    Read an MGH or NIfTI file directly into the image data of a volume node.
+    """
+    voxels, ijkToRAS = readVolumeFile(path)
+    importArrayToVolumeNode(voxels, ijkToRAS, volumeNode)
+
+
+def importArrayToVolumeNode(voxels, ijkToRAS, volumeNode):
+    """
+    Set the voxels and geometry of a volume node, e.g. from an array read by readVolumeFile().
+    :param voxels: array indexed as [k, j, i]
+    :param ijkToRAS: 4x4 IJK to RAS matrix of the array
+    """
+    import slicer
+    volumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(ijkToRAS))
+    slicer.util.updateVolumeFromArray(volumeNode, voxels)
+    if volumeNode.GetDisplayNode() is None:
+        volumeNode.CreateDefaultDisplayNodes()
+
+
+def importLabelmapToSegmentationNode(voxels, ijkToRAS, segmentationNode, colorNode=None):
+    """
+    Replace the segments of a segmentation node by one segment per label present in a label array.
+    All segments share a single binary labelmap built from the array in one pass, and no closed
+    surface is generated: it is created by the display when the segmentation is shown in 3D.
+    :param voxels: label array indexed as [k, j, i]
+    :param ijkToRAS: 4x4 IJK to RAS matrix of the label array
+    :param segmentationNode: segmentation node to fill
+    :param colorNode: color node providing names and colors of the labels (optional)
+    """
+    import slicer
+    import vtk
+    from vtk.util import numpy_support
+
+    voxels = np.asarray(voxels)
+    if voxels.dtype.kind in 'ub' or (voxels.dtype.kind == 'i' and voxels.size and voxels.min() >= 0):
+        labels = np.flatnonzero(np.bincount(voxels.ravel()))
+    else:
+        labels = np.unique(voxels)
+    labels = labels[labels != 0]
+
+    # Store labels in the smallest integer type
+    maxLabel = int(labels.max()) if labels.size else 0
+    if maxLabel <= np.iinfo(np.uint8).max:
+        labelType = np.uint8
+    elif maxLabel <= np.iinfo(np.int16).max:
+        labelType = np.int16
+    else:
+        labelType = np.int32
+    depth, height, width = voxels.shape
+    labelmap = slicer.vtkOrientedImageData()
+    labelmap.SetDimensions(width, height, depth)
+    labelmap.SetImageToWorldMatrix(slicer.util.vtkMatrixFromArray(ijkToRAS))
+    labelmap.GetPointData().SetScalars(numpy_support.numpy_to_vtk(
+        np.ascontiguousarray(voxels, dtype=labelType).ravel(), deep=True))
+
+    binaryLabelmapName = slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName()
+    segmentation = segmentationNode.GetSegmentation()
+    wasModified = segmentationNode.StartModify()
+    try:
+        segmentation.RemoveAllSegments()
+        if hasattr(segmentation, 'SetSourceRepresentationName'):
+            segmentation.SetSourceRepresentationName(binaryLabelmapName)
+        else:
+            segmentation.SetMasterRepresentationName(binaryLabelmapName)
+        segmentation.SetConversionParameter(
+            slicer.vtkSegmentationConverter.GetReferenceImageGeometryParameterName(),
+            slicer.vtkSegmentationConverter.SerializeImageGeometry(labelmap))
+        color = [0.0, 0.0, 0.0, 0.0]
+        for label in labels:
+            label = int(label)
+            segment = slicer.vtkSegment()
+            if colorNode and colorNode.GetColor(label, color):
+                segment.SetName(colorNode.GetColorName(label))
+                segment.SetColor(color[:3])
+            else:
+                segment.SetName(f'Segment_{label}')
+            segment.AddRepresentation(binaryLabelmapName, labelmap)
+            segment.SetLabelValue(label)
+            segmentation.AddSegment(segment, f'{segment.GetName()}_{label}')
+    finally:
+        segmentationNode.EndModify(wasModified)
+    if segmentationNode.GetDisplayNode() is None:
+        segmentationNode.CreateDefaultDisplayNodes()
+
+
+def importSegmentationNode(path, segmentationNode, colorNode=None):
+    """
+    Read a label volume file (MGH or NIfTI) directly into a segmentation node.
+    See importLabelmapToSegmentationNode().
+    """
+    voxels, ijkToRAS = readVolumeFile(path)
+    importLabelmapToSegmentationNode(voxels, ijkToRAS, segmentationNode, colorNode)
@@ -0,0 +1,67 @@
+import numpy as np
+
+__all__ = ['labelVolumes', 'segmentationVolumes']
+
+
+def labelVolumes(voxels, voxelVolume, background=0):
+    """
+    Compute the volume of each label of a label image in a single pass.
+    :param voxels: array of integer labels
+    :param voxelVolume: volume of one voxel (e.g., in mm3)
+    :param background: label that is not reported, None to report all labels
+    :return: labels present in the image, their number of voxels and their volumes
+    """
+    voxels = np.asarray(voxels).ravel()
+    if voxels.size == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    # bincount needs non-negative integers
+    offset = int(voxels.min())
+    if offset != 0:
+        voxels = voxels.astype(np.int64) - offset
+    counts = np.bincount(voxels)
+    labels = np.flatnonzero(counts)
+    counts = counts[labels]
+    labels = labels + offset
+    if background is not None:
+        keep = labels != background
+        labels, counts = labels[keep], counts[keep]
+    return labels, counts, counts * float(voxelVolume)
+
+
+def segmentationVolumes(segmentationNode):
+    """
+    Compute the volume of each segment of a segmentation from its binary labelmap representation.
+    Segments sharing a labelmap layer are counted in a single pass over that layer.
+    :return: segment IDs and their number of voxels and volumes (in mm3)
+    """
+    import slicer
+    from vtk.util import numpy_support
+
+    segmentation = segmentationNode.GetSegmentation()
+    labelmapName = slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName()
+    if not segmentation.ContainsRepresentation(labelmapName):
+        raise ValueError(f"Segmentation {segmentationNode.GetName()} has no binary labelmap representation")
+
+    segmentIds = []
+    counts = []
+    spacing = (1.0, 1.0, 1.0)
+    for layer in range(segmentation.GetNumberOfLayers()):
+        image = segmentation.GetLayerDataObject(layer)
+        layerSegmentIds = list(segmentation.GetSegmentIDsForLayer(layer))
+        if image is None or image.GetPointData().GetScalars() is None:
+            layerCounts = {}
+        else:
+            voxels = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+            labels, labelCounts, _ = labelVolumes(voxels, 1.0)
+            layerCounts = dict(zip(labels.tolist(), labelCounts.tolist()))
+        for segmentId in layerSegmentIds:
+            segmentIds.append(segmentId)
+            counts.append(layerCounts.get(segmentation.GetSegment(segmentId).GetLabelValue(), 0))
+        if image is not None:
+            # All layers of a segmentation have the same geometry
+            spacing = image.GetSpacing()
+
+    counts = np.array(counts, dtype=np.int64)
+    return segmentIds, counts, counts * float(np.prod(spacing))
+
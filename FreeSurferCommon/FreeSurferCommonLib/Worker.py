@@ -0,0 +1,280 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+
+from .Toolchain import FreeSurferToolchain
+from .WorkerMain import DONE_MARKER
+
+__all__ = ['FreeSurferWorker', 'launchCommand']
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'WorkerMain.py')
+
+# Line of a shell wrapper running a Python script with its own arguments, e.g.,
+# exec fspython "$FREESURFER_HOME/python/scripts/mri_synthseg" "$@"
+WRAPPER_PATTERN = re.compile(r'(?:^|[\s/])(?:fs)?python[0-9.]*\s+"?([^"\s]+)"?\s+"?\$[@*]', re.MULTILINE)
+
+# Frameworks imported by the shared workers when they start: TensorFlow for mri_synthseg,
+# PyTorch for mri_synthstrip
+WORKER_PRELOAD = ('tensorflow', 'torch')
+
+
+def workerEnabled():
+    """
+    Return True if the persistent worker is enabled in the application settings.
+    """
+    import qt
+    return str(qt.QSettings().value('FreeSurferCommands/PersistentWorker', 'false')).lower() == 'true'
+
+
+def launchCommand(command, environment=None):
+    """
+    Launch a FreeSurfer command line.
+    Python commands (e.g., mri_synthseg, mri_synthstrip) run in the persistent worker if it is
+    enabled and idle; otherwise, or if the worker cannot be started, the command runs in a new
+    process, in the environment of the FreeSurfer toolchain.
+    :param environment: environment variables to set for this command (e.g., see threadEnvironment())
+    :return: subprocess.Popen or WorkerCommand, with the stdout, returncode, poll(), wait() and kill() interface
+    """
+    import slicer
+    toolchain = FreeSurferToolchain.forCommand(command)
+    if toolchain is None:
+        if environment:
+            return slicer.util.launchConsoleProcess(command, updateEnvironment=environment)
+        return slicer.util.launchConsoleProcess(command)
+    if workerEnabled():
+        worker = FreeSurferWorker.shared(toolchain.home)
+        if worker.canRun(command):
+            try:
+                return worker.launch(command, environment)
+            except (OSError, RuntimeError) as e:
+                logging.warning(f"FreeSurfer worker is not available, running command in a new process: {e}")
+    env = toolchain.environment
+    if environment:
+        env = dict(env, **environment)
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, env=env)
+
+
+class WorkerCommand:
+    """Command running in a FreeSurferWorker.
+
+    Provides the part of the subprocess.Popen interface used by CommandJob, so that
+    commands run in the worker and in a new process are handled the same way.
+    """
+
+    # No child process of its own, so no resource usage either
+    pid = None
+
+    def __init__(self, worker, args):
+        self.args = args
+        self.returncode = None
+        self._worker = worker
+        self.stdout = self._readLines()
+
+    def _readLines(self):
+        try:
+            for line in self._worker.process.stdout:
+                if line.startswith(DONE_MARKER):
+                    self.returncode = int(line.split()[1])
+                    return
+                yield line
+            # Worker exited (crashed or killed) before the end of the command
+            self.returncode = self._worker.process.wait() or 1
+        finally:
+            if self.returncode is None:
+                # Output not read to the end, the worker state is unknown
+                self._worker.stop()
+                self.returncode = 1
+            self._worker.busy = False
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        for _ in self.stdout:
+            pass
+        return self.returncode
+
+    def kill(self):
+        # The command cannot be interrupted inside the worker, the worker is restarted for the next command
+        self._worker.kill()
+
+
+class FreeSurferWorker:
+    """Long-lived FreeSurfer Python process running Python commands one after the other.
+
+    mri_synthseg and mri_synthstrip are Python scripts: each run in a new process
+    spends seconds starting the interpreter and importing TensorFlow or PyTorch
+    before processing any voxel. The worker (WorkerMain.py run with fspython)
+    pays for this once, and then runs the scripts in-process with the arguments
+    sent over its standard input. The model weights loaded by a script are kept
+    in the worker, so that the next runs with the same weights do not load them
+    again.
+
+    The worker runs one command at a time; launchCommand() runs commands in new
+    processes when the worker is busy, not running or fails to start. It is
+    enabled with the application setting FreeSurferCommands/PersistentWorker
+    ("false" by default). The shared worker of the FREESURFER_HOME installation
+    is started with the application (see startShared()), so that the frameworks
+    are imported in the background before the first command.
+
+    :param freeSurferHome: FreeSurfer installation folder
+    :param preload: Python modules imported when the worker starts (e.g., 'tensorflow')
+    """
+
+    _shared = {}
+
+    def __init__(self, freeSurferHome, preload=()):
+        self.freeSurferHome = freeSurferHome
+        self.python = os.path.join(freeSurferHome, 'bin', 'fspython')
+        self.preload = list(preload)
+        self.process = None
+        self.busy = False
+        self._lock = threading.Lock()
+        self._entryPoints = {}
+
+    @classmethod
+    def shared(cls, freeSurferHome):
+        """
+        Return the worker of a FreeSurfer installation shared by all modules, created on first use.
+        Shared workers import the frameworks of the FreeSurfer Python commands when they start,
+        and are stopped when the application exits.
+        """
+        if not cls._shared:
+            import slicer
+            slicer.app.connect("aboutToQuit()", cls.stopAll)
+        if freeSurferHome not in cls._shared:
+            cls._shared[freeSurferHome] = cls(freeSurferHome, WORKER_PRELOAD)
+        return cls._shared[freeSurferHome]
+
+    @classmethod
+    def startShared(cls):
+        """
+        Start the shared worker of the FREESURFER_HOME installation if the worker is enabled
+        (e.g., when the application starts), so that it is ready for the first command.
+        """
+        if not workerEnabled():
+            return
+        try:
+            cls.shared(FreeSurferToolchain.resolve().home).start()
+        except OSError as e:
+            logging.warning(f"FreeSurfer worker is not started: {e}")
+
+    @classmethod
+    def stopAll(cls):
+        """
+        Stop all shared workers, called when the application exits.
+        """
+        for worker in cls._shared.values():
+            worker.stop()
+
+    @property
+    def isRunning(self):
+        return self.process is not None and self.process.poll() is None
+
+    @staticmethod
+    def isPythonScript(path):
+        """
+        Check whether a file is a Python script.
+        """
+        try:
+            with open(path, 'rb') as f:
+                firstLine = f.readline(256)
+        except OSError:
+            return False
+        return path.endswith('.py') or (firstLine.startswith(b'#!') and b'python' in firstLine)
+
+    def pythonEntryPoint(self, path):
+        """
+        Return the Python script run by a command, which can run in the worker, or None.
+        Commands are either Python scripts, or shell scripts running a Python script of the
+        installation with the same arguments (see WRAPPER_PATTERN).
+        """
+        if path not in self._entryPoints:
+            self._entryPoints[path] = self._findEntryPoint(path)
+        return self._entryPoints[path]
+
+    def _findEntryPoint(self, path):
+        if self.isPythonScript(path):
+            return path
+        try:
+            with open(path, 'rb') as f:
+                if not f.readline(256).startswith(b'#!'):
+                    # Compiled command (e.g., mri_watershed)
+                    return None
+                source = f.read(65536).decode('utf-8', 'replace')
+        except OSError:
+            return None
+        name = os.path.basename(path)
+        match = WRAPPER_PATTERN.search(source)
+        if match:
+            script = re.sub(r'\$\{?FREESURFER_HOME\}?', lambda _: self.freeSurferHome, match.group(1))
+            script = re.sub(r'\$\(dirname "?\$0"?\)', lambda _: os.path.dirname(path), script)
+            if os.path.isabs(script) and self.isPythonScript(script):
+                logging.info(f"{name} is a shell script running {script}, which runs in the FreeSurfer worker")
+                return script
+        logging.warning(f"{name} is a shell script whose Python script cannot be found, "
+                        "it runs in a new process instead of the FreeSurfer worker")
+        return None
+
+    def canRun(self, command):
+        return not self.busy and os.path.exists(self.python) and self.pythonEntryPoint(command[0]) is not None
+
+    def start(self):
+        """
+        Start the worker process if it is not running.
+        """
+        if self.isRunning:
+            return
+        logging.info(f'Starting FreeSurfer worker: {self.python}')
+        # Same environment as commands launched in a new process; stdout only carries the worker protocol,
+        # diagnostics of the worker go to the application error output
+        self.process = subprocess.Popen(
+            [self.python, WORKER_SCRIPT] + self.preload,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True, bufsize=1, env=FreeSurferToolchain.resolve(self.freeSurferHome).environment)
+
+    def launch(self, command, environment=None):
+        """
+        Run a Python command line in the worker, starting the worker if needed.
+        :param environment: environment variables to set while the command runs
+        :return: WorkerCommand
+        """
+        with self._lock:
+            if self.busy:
+                raise RuntimeError("FreeSurfer worker is busy")
+            self.start()
+            self.busy = True
+        try:
+            # Shell wrappers are replaced by the Python script they run, with the same arguments
+            args = [self.pythonEntryPoint(command[0])] + list(command[1:])
+            self.process.stdin.write(json.dumps({'args': [str(arg) for arg in args],
+                                                 'environment': environment or {}}) + '\n')
+            self.process.stdin.flush()
+        except OSError:
+            self.busy = False
+            self.kill()
+            raise
+        return WorkerCommand(self, command)
+
+    def kill(self):
+        if self.isRunning:
+            self.process.kill()
+
+    def stop(self, timeout=5):
+        """
+        Stop the worker process, killing it if it does not exit within timeout seconds.
+        """
+        if not self.isRunning:
+            self.process = None
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
@@ -0,0 +1,216 @@
+"""
+Persistent FreeSurfer Python worker, see Worker.FreeSurferWorker.
+
+This script runs with FreeSurfer's Python (fspython), not in Slicer. It reads
+one JSON request per line on stdin, {"args": [script, arg1, ...], "environment":
+{name: value, ...}}, and runs the Python script in this process as if it was run
+from the command line, with the environment variables set. The
+Python interpreter and the deep learning frameworks imported by the scripts
+(TensorFlow for mri_synthseg, PyTorch for mri_synthstrip) are therefore only
+loaded once for all the commands.
+
+The model weights read by the scripts are kept in memory as well: the weights
+loading functions of the frameworks are wrapped so that a weights file already
+read by a previous run of the same script is not read again. The weights of a
+script are released when it runs with other weights files.
+
+The output of each command (including its error output) is written to stdout,
+followed by a line starting with DONE_MARKER and the exit code of the command.
+Only this protocol is written to stdout: diagnostics of the worker itself are
+written to the stderr of the worker process.
+
+Usage:
+
+    fspython WorkerMain.py [module to import at startup ...]
+"""
+
+import copy
+import gc
+import json
+import os
+import runpy
+import sys
+import traceback
+
+DONE_MARKER = '\x1eFreeSurferWorkerDone'
+
+# Weights loaded by the scripts: (script, value) by weights file and loading options
+loadedWeights = {}
+# Script run by the current command and the weights it loaded
+currentScript = None
+usedWeights = set()
+# Thread counts of the frameworks before any command changed them, and scripts using TensorFlow
+defaultThreads = {}
+tensorflowScripts = set()
+
+
+def weightsKey(path, *options):
+    # Weights files are identified by their path, size and modification time
+    path = os.path.realpath(os.fspath(path))
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns) + tuple(repr(option) for option in options)
+
+
+def cachedWeights(key, load):
+    # Return the weights of a file, loaded by load() if not yet loaded by the current script
+    usedWeights.add(key)
+    if key not in loadedWeights:
+        loadedWeights[key] = (currentScript, load())
+    return loadedWeights[key][1]
+
+
+def installWeightsCache():
+    # Wrap the weights loading functions of the frameworks imported so far
+    torch = sys.modules.get('torch')
+    if torch is not None and not hasattr(torch.load, 'workerCache'):
+        torchLoad = torch.load
+
+        def load(f, map_location=None, *args, **kwargs):
+            if args or not isinstance(f, (str, os.PathLike)):
+                return torchLoad(f, map_location, *args, **kwargs)
+            key = weightsKey(f, map_location, sorted(kwargs.items()))
+            # Checkpoints are dictionaries of tensors, copied into the model by the scripts
+            return copy.copy(cachedWeights(key, lambda: torchLoad(f, map_location, **kwargs)))
+
+        load.workerCache = True
+        torch.load = load
+
+    tf = sys.modules.get('tensorflow')
+    models = [sys.modules['keras'].Model] if 'keras' in sys.modules else []
+    if tf is not None:
+        models.append(tf.keras.Model)
+    for model in models:
+        if hasattr(model.load_weights, 'workerCache'):
+            continue
+
+        def loadWeights(self, filepath, *args, kerasLoadWeights=model.load_weights, **kwargs):
+            # Only HDF5 files (used by mri_synthseg) are cached: loading a TensorFlow checkpoint
+            # returns a status object that scripts may use
+            if not isinstance(filepath, (str, os.PathLike)) or not os.fspath(filepath).endswith('.h5'):
+                return kerasLoadWeights(self, filepath, *args, **kwargs)
+            tensorflowScripts.add(currentScript)
+            # Same file loaded into a model of the same architecture
+            key = weightsKey(filepath, args, sorted(kwargs.items()), [str(weight.shape) for weight in self.weights])
+            if key in loadedWeights:
+                usedWeights.add(key)
+                self.set_weights(loadedWeights[key][1])
+                return None
+
+            def load():
+                kerasLoadWeights(self, filepath, *args, **kwargs)
+                return self.get_weights()
+
+            cachedWeights(key, load)
+
+        loadWeights.workerCache = True
+        model.load_weights = loadWeights
+
+
+def releaseModels():
+    # Free the weights that the last command did not use in place of weights loaded by a previous
+    # run of the same script, and the models built by the command; the frameworks stay imported.
+    # The TensorFlow session holding the models is only cleared when weights are released, so that
+    # runs with the same weights keep it.
+    global currentScript
+    released = [key for key, (script, _) in loadedWeights.items()
+                if script == currentScript and key not in usedWeights]
+    for key in released:
+        del loadedWeights[key]
+    usedWeights.clear()
+    currentScript = None
+    tf = sys.modules.get('tensorflow')
+    if released and tf is not None:
+        try:
+            tf.keras.backend.clear_session()
+        except Exception:
+            pass
+    gc.collect()
+
+
+def applyThreads(environment):
+    # Thread pools of the frameworks are created when they are imported: the
+    # thread count of a command must be set with their API in the worker.
+    # Commands without thread count get the default of the frameworks back.
+    threads = int(environment.get('OMP_NUM_THREADS') or 0)
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        defaultThreads.setdefault('torch', torch.get_num_threads())
+        torch.set_num_threads(threads or defaultThreads['torch'])
+    tf = sys.modules.get('tensorflow')
+    if tf is not None:
+        # 0 is the default of TensorFlow (all CPU cores)
+        currentThreads = tf.config.threading.get_intra_op_parallelism_threads()
+        if currentThreads != threads:
+            try:
+                tf.config.threading.set_intra_op_parallelism_threads(threads)
+            except RuntimeError:
+                # Cannot be changed once the runtime is initialized by a previous command:
+                # reported in the output of TensorFlow commands, which is logged by the application
+                if currentScript not in tensorflowScripts:
+                    return
+                print(f"Warning: FreeSurfer worker cannot change the TensorFlow threads to "
+                      f"{threads or 'all CPU cores'}, this command uses {currentThreads or 'all CPU cores'}; "
+                      "disable the persistent worker to run TensorFlow commands with different thread counts",
+                      file=sys.stderr)
+
+
+def runCommand(args, environment=None):
+    """
+    Run a Python script with command line arguments in this process.
+    :param environment: environment variables to set while the script runs
+    :return: exit code of the script
+    """
+    global currentScript
+    environment = environment or {}
+    installWeightsCache()
+    currentScript = os.path.realpath(args[0])
+    previousEnvironment = {name: os.environ.get(name) for name in environment}
+    os.environ.update(environment)
+    applyThreads(environment)
+    sys.argv = list(args)
+    # The script folder is searched first for imports, as when the script is run directly
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args[0])))
+    try:
+        runpy.run_path(args[0], run_name='__main__')
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        # Error message of the script, part of its error output as when run from the command line
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException:
+        traceback.print_exc(file=sys.stderr)
+        return 1
+    finally:
+        del sys.path[0]
+        for name, value in previousEnvironment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        sys.stdout.flush()
+        releaseModels()
+
+
+def main():
+    # Error output of the commands is merged into the command output
+    sys.stderr = sys.stdout
+    for name in sys.argv[1:]:
+        try:
+            __import__(name)
+        except ImportError as e:
+            print(f"Failed to preload {name}: {e}", file=sys.__stderr__)
+
+    stdin = sys.stdin
+    for line in stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        code = runCommand(request['args'], request.get('environment'))
+        sys.stdout.write(f'{DONE_MARKER} {code}\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
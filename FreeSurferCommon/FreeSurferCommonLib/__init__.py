@@ -0,0 +1,15 @@
+from .ColorTable import *
+from .CommandJob import *
+from .Fingerprint import *
+from .JobScheduler import *
+from .ProcessingWidget import *
+from .Profiling import *
+from .Progress import *
+from .ResultCache import *
+from .Staging import *
+from .Tables import *
+from .Testing import *
+from .Toolchain import *
+from .VolumeIO import *
+from .Volumetrics import *
+from .Worker import *
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Measure the overhead of the FreeSurfer modules themselves (export of the
+input volume, temporary files, import of the results into volume and
+segmentation nodes, color table loading) without a FreeSurfer installation.
+
+A fake FreeSurfer installation is created in a temporary folder, with
+mri_synthseg and mri_synthstrip scripts that copy or threshold their input
+instead of running the neural networks. The modules are run on synthetic
+256^3 and 512^3 label volumes with many labels, and the median wall time of
+each processing stage is printed and appended to a JSON Lines results file.
+The time of the fake commands is reported separately from the module
+overhead, and the overhead is compared with the last recorded result of the
+same case so that regressions show up.
+
+Usage (in 3D Slicer, with the FreeSurfer Commands extension installed):
+
+    Slicer --no-main-window --python-script ModuleBenchmark.py [--sizes 256 512] [--labels 96]
+        [--repeat 3] [--results ModuleBenchmark.jsonl]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import textwrap
+import time
+
+import numpy as np
+
+import slicer
+
+COMMON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+# Fake commands: same command line as the FreeSurfer ones, output lines recognized by the progress parser
+FAKE_SYNTHSEG = """
+    import argparse
+    import shutil
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--i')
+    parser.add_argument('--o')
+    parser.add_argument('--resample')
+    args, _ = parser.parse_known_args()
+
+    print('using CPU, hiding all CUDA_VISIBLE_DEVICES', flush=True)
+    print('predicting 1/1', flush=True)
+    # The synthetic input is a label volume: it is its own segmentation
+    shutil.copyfile(args.i, args.o)
+    if args.resample:
+        shutil.copyfile(args.i, args.resample)
+    print('segmentation saved in: ' + args.o, flush=True)
+    """
+
+FAKE_SYNTHSTRIP = """
+    import argparse
+    import sys
+
+    import numpy as np
+
+    sys.path.insert(0, {commonPath!r})
+    from FreeSurferCommonLib.VolumeIO import readVolumeFile, writeVolumeFile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--image')
+    parser.add_argument('-o', '--out')
+    parser.add_argument('-m', '--mask')
+    args, _ = parser.parse_known_args()
+
+    print('Configuring model on the CPU', flush=True)
+    print('Running SynthStrip model version 1', flush=True)
+    voxels, ijkToRAS = readVolumeFile(args.image)
+    mask = voxels > 0
+    if args.out:
+        writeVolumeFile(args.out, np.where(mask, voxels, 0).astype(voxels.dtype), ijkToRAS)
+        print('Masked image saved to: ' + args.out, flush=True)
+    if args.mask:
+        writeVolumeFile(args.mask, mask.astype(np.uint8), ijkToRAS)
+        print('Binary brain mask saved to: ' + args.mask, flush=True)
+    """
+
+
+def pythonExecutable():
+    """
+    Return a Python interpreter with NumPy to run the fake commands with.
+    """
+    for name in ('PythonSlicer', 'PythonSlicer.exe'):
+        path = os.path.join(slicer.app.slicerHome, 'bin', name)
+        if os.path.isfile(path):
+            return path
+    return sys.executable
+
+
+def fakeCommands():
+    """
+    Return the scripts of the fake mri_synthseg and mri_synthstrip commands, see fakeFreeSurferInstallation().
+    """
+    python = pythonExecutable()
+    return {name: f'#!{python}\n' + textwrap.dedent(source.format(commonPath=os.path.abspath(COMMON_PATH)))
+            for name, source in (('mri_synthseg', FAKE_SYNTHSEG), ('mri_synthstrip', FAKE_SYNTHSTRIP))}
+
+
+def syntheticLabelVolume(size, labelCount):
+    """
+    Return a label volume of concentric shells split in octants, with about labelCount labels.
+    """
+    shells = max(1, labelCount // 8)
+    voxels = np.zeros((size, size, size), dtype=np.int16)
+    center = (size - 1) / 2
+    j, i = np.ogrid[:size, :size]
+    for k in range(size):
+        radius = np.sqrt((i - center) ** 2 + (j - center) ** 2 + (k - center) ** 2, dtype=np.float32) / size
+        octant = (i > center) * 1 + (j > center) * 2 + (k > center) * 4
+        shell = (radius / 0.45 * shells).astype(np.int16)
+        voxels[k] = np.where(shell < shells, 1 + shell * 8 + octant, 0)
+    return voxels
+
+
+def createInputNode(voxels):
+    inputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'BenchmarkInput')
+    inputNode.SetSpacing(256 / voxels.shape[0], 256 / voxels.shape[1], 256 / voxels.shape[2])
+    slicer.util.updateVolumeFromArray(inputNode, voxels)
+    return inputNode
+
+
+def runCases(inputNode):
+    """
+    Run each benchmark case once and return the ProcessingStats of each case.
+    """
+    from FreeSurferSynthSeg import FreeSurferSynthSegLogic
+    from FreeSurferSynthStripSkullStripScripted import FreeSurferSynthStripSkullStripScriptedLogic
+
+    synthSegLogic = FreeSurferSynthSegLogic()
+    synthStripLogic = FreeSurferSynthStripSkullStripScriptedLogic()
+    results = {}
+    outputNodes = []
+
+    def addNode(className):
+        node = slicer.mrmlScene.AddNewNodeByClass(className)
+        outputNodes.append(node)
+        return node
+
+    results['SynthSeg labelmap'] = synthSegLogic.process(inputNode, addNode('vtkMRMLLabelMapVolumeNode'))
+    results['SynthSeg segmentation'] = synthSegLogic.process(inputNode, addNode('vtkMRMLSegmentationNode'))
+    results['SynthStrip image, mask and segmentation'] = synthStripLogic.process(
+        inputNode, addNode('vtkMRMLScalarVolumeNode'), addNode('vtkMRMLLabelMapVolumeNode'),
+        outputSegmentationNode=addNode('vtkMRMLSegmentationNode'), stripFromMask=False)
+    results['SynthStrip image from mask, mask and segmentation'] = synthStripLogic.process(
+        inputNode, addNode('vtkMRMLScalarVolumeNode'), addNode('vtkMRMLLabelMapVolumeNode'),
+        outputSegmentationNode=addNode('vtkMRMLSegmentationNode'), stripFromMask=True)
+    for node in outputNodes:
+        slicer.mrmlScene.RemoveNode(node)
+    return results
+
+
+def colorTableLoadTime():
+    """
+    Return the wall time of loading the FreeSurfer color table into an empty scene.
+    """
+    from FreeSurferSynthSeg import FreeSurferSynthSegLogic
+    slicer.mrmlScene.Clear(0)
+    startTime = time.perf_counter()
+    FreeSurferSynthSegLogic().loadColorTable()
+    return time.perf_counter() - startTime
+
+
+def summarize(runs, commandNames=('mri_synthseg', 'mri_synthstrip')):
+    """
+    Return the median wall time of each stage, of the commands and of the module overhead.
+    """
+    stages = {}
+    for stats in runs:
+        for stage in stats.stages:
+            stages.setdefault(stage.name, []).append(stage.wallTime)
+    stageTimes = {name: statistics.median(times) for name, times in stages.items()}
+    commandTime = sum(wallTime for name, wallTime in stageTimes.items() if name in commandNames)
+    overhead = sum(wallTime for name, wallTime in stageTimes.items() if name not in commandNames)
+    return stageTimes, commandTime, overhead
+
+
+def lastResults(path):
+    """
+    Return the last recorded result of each (case, size) in the results file.
+    """
+    results = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[(result['case'], result['size'])] = result
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the overhead of the FreeSurfer modules.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512], help='volume sizes (voxels per side)')
+    parser.add_argument('--labels', type=int, default=96, help='approximate number of labels')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each case, the median is reported')
+    parser.add_argument('--results', default='ModuleBenchmark.jsonl', help='JSON Lines file the results are appended to')
+    args = parser.parse_args(argv)
+
+    from FreeSurferCommonLib import FreeSurferToolchain, fakeFreeSurferInstallation
+
+    previous = lastResults(args.results)
+    # Results must be computed every time: the result cache is disabled in the fake installation
+    with fakeFreeSurferInstallation(fakeCommands(), version='freesurfer-benchmark-stub'):
+        FreeSurferToolchain.resolve()
+
+        records = [{'case': 'color table load', 'size': None,
+                    'stages': {'load': colorTableLoadTime()}, 'commandTime': 0.0}]
+        records[0]['overhead'] = records[0]['stages']['load']
+        for size in args.sizes:
+            slicer.mrmlScene.Clear(0)
+            voxels = syntheticLabelVolume(size, args.labels)
+            labelCount = int(np.count_nonzero(np.bincount(voxels.ravel())[1:]))
+            inputNode = createInputNode(voxels)
+            del voxels
+            runs = {}
+            for _ in range(args.repeat):
+                for case, stats in runCases(inputNode).items():
+                    runs.setdefault(case, []).append(stats)
+            for case, caseRuns in runs.items():
+                stageTimes, commandTime, overhead = summarize(caseRuns)
+                records.append({'case': case, 'size': size, 'labels': labelCount,
+                                'stages': stageTimes, 'commandTime': commandTime, 'overhead': overhead})
+
+    print(f"{'case':<50} {'size':>5} {'overhead [s]':>12} {'command [s]':>11} {'previous':>9}  stages [s]")
+    date = datetime.datetime.now().isoformat()
+    with open(args.results, 'a') as f:
+        for record in records:
+            record.update({'date': date, 'slicerVersion': slicer.app.applicationVersion,
+                           'platform': platform.platform(), 'repeat': args.repeat})
+            f.write(json.dumps(record) + '\n')
+            last = previous.get((record['case'], record['size']))
+            change = f"{record['overhead'] / last['overhead'] - 1:+.0%}" if last and last['overhead'] else '-'
+            stages = ', '.join(f'{name}: {wallTime:.2f}' for name, wallTime in record['stages'].items())
+            print(f"{record['case']:<50} {record['size'] or '':>5} {record['overhead']:>12.2f} "
+                  f"{record['commandTime']:>11.2f} {change:>9}  {stages}")
+
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        slicer.util.exit(1)
+    else:
+        slicer.util.exit(0)
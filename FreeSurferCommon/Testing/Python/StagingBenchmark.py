@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Compare the wall time of writing and reading the temporary image files
+exchanged with FreeSurfer commands in the available staging formats and
+folders, for a 1 mm and a 0.5 mm isotropic head-sized volume.
+
+Usage (does not require 3D Slicer, only NumPy):
+
+    python StagingBenchmark.py [staging folder ...]
+
+The system temporary folder and /dev/shm (if available) are used by default.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from FreeSurferCommonLib.VolumeIO import readVolumeFile, writeVolumeFile  # noqa: E402
+
+FORMATS = ('.mgz', '.nii.gz', '.mgh', '.nii')
+RESOLUTIONS = (1.0, 0.5)
+FIELD_OF_VIEW = 256  # mm
+
+
+def syntheticVolume(spacing):
+    """
+    Return a smooth synthetic head-like volume with noise, so that compression is realistic.
+    """
+    size = int(FIELD_OF_VIEW / spacing)
+    rng = np.random.default_rng(0)
+    k, j, i = np.ogrid[:size, :size, :size]
+    center = size / 2
+    radius = np.sqrt((i - center) ** 2 + (j - center) ** 2 + (k - center) ** 2) / size
+    voxels = (1000 * np.clip(0.4 - radius, 0, None)).astype(np.int16)
+    voxels += rng.integers(0, 20, voxels.shape, dtype=np.int16)
+    ijkToRAS = np.diag([-spacing, -spacing, spacing, 1.0])
+    return voxels, ijkToRAS
+
+
+def benchmark(directory, extension, voxels, ijkToRAS):
+    with tempfile.TemporaryDirectory(dir=directory) as tempDir:
+        path = os.path.join(tempDir, 'input' + extension)
+        startTime = time.perf_counter()
+        writeVolumeFile(path, voxels, ijkToRAS)
+        writeTime = time.perf_counter() - startTime
+        size = os.path.getsize(path)
+        startTime = time.perf_counter()
+        readVolumeFile(path)
+        readTime = time.perf_counter() - startTime
+    return writeTime, readTime, size
+
+
+def main(directories):
+    print(f"{'resolution':>10} {'folder':<20} {'format':<8} {'write [s]':>9} {'read [s]':>9} {'size [MB]':>9}")
+    for spacing in RESOLUTIONS:
+        voxels, ijkToRAS = syntheticVolume(spacing)
+        for directory in directories:
+            for extension in FORMATS:
+                writeTime, readTime, size = benchmark(directory, extension, voxels, ijkToRAS)
+                print(f"{spacing:>8} mm {directory:<20} {extension:<8} {writeTime:>9.2f} {readTime:>9.2f} {size / 1e6:>9.1f}")
+
+
+if __name__ == '__main__':
+    directories = sys.argv[1:]
+    if not directories:
+        directories = [tempfile.gettempdir()]
+        if os.path.isdir('/dev/shm'):
+            directories.append('/dev/shm')
+    main(directories)
@@ -7,6 +7,8 @@ import slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
+from FreeSurferCommonLib import ProcessingWidgetMixin
+
 
 #
 # FreeSurferMRIWatershedSkullStrip
@@ -19,80 +21,31 @@ class FreeSurferMRIWatershedSkullStrip(ScriptedLoadableModule):
 
     def __init__(self, parent):
         ScriptedLoadableModule.__init__(self, parent)
-        self.parent.title = "FreeSurferMRIWatershedSkullStrip"  # TODO: make this more human readable by adding spaces
-        self.parent.categories = ["Examples"]  # TODO: set categories (folders where the module shows up in the module selector)
-        self.parent.dependencies = []  # TODO: add here list of module names that this module requires
-        self.parent.contributors = ["John Doe (AnyWare Corp.)"]  # TODO: replace with "Firstname Lastname (Organization)"
-        # TODO: update with short description of the module and a link to online module documentation
-        self.parent.helpText = """
-This is an example of scripted loadable module bundled in an extension.
-See more information in <a href="https://github.com/organization/projectname#FreeSurferMRIWatershedSkullStrip">module documentation</a>.
+        self.parent.title = "FreeSurfer MRI Watershed Skull Strip"
+        self.parent.categories = ["Segmentation"]
+        self.parent.dependencies = ["FreeSurferCommon"]
+        self.parent.contributors = ["Benjamin Zwick (ISML)"]
+        self.parent.helpText = """Skull stripping using the hybrid watershed algorithm (mri_watershed) from FreeSurfer.
+
+For a detailed description of mri_watershed please refer to its documentation <a href="https://surfer.nmr.mgh.harvard.edu/fswiki/mri_watershed">here</a>.
+
+See more information in <a href="https://github.com/SlicerCBM/SlicerFreeSurferCommands/tree/main/FreeSurferMRIWatershedSkullStrip/README.md">module documentation</a>.
 """
-        # TODO: replace with organization, grant and thanks
         self.parent.acknowledgementText = """
-This file was originally developed by Jean-Christophe Fillion-Robin, Kitware Inc., Andras Lasso, PerkLab,
-and Steve Pieper, Isomics, Inc. and was partially funded by NIH grant 3P41RR013218-12S1.
+This module uses FreeSurfer's mri_watershed command.
+If you use mri_watershed in your analysis, please cite:
+A hybrid approach to the skull stripping problem in MRI
+F. Segonne, A.M. Dale, E. Busa, M. Glessner, D. Salat, H.K. Hahn, B. Fischl
+NeuroImage 22(3), 2004, 1060-1075
+https://doi.org/10.1016/j.neuroimage.2004.03.032
 """
 
-        # Additional initialization step after application startup is complete
-        slicer.app.connect("startupCompleted()", registerSampleData)
-
-
-#
-# Register sample data sets in Sample Data module
-#
-
-def registerSampleData():
-    """
-    Add data sets to Sample Data module.
-    """
-    # It is always recommended to provide sample data for users to make it easy to try the module,
-    # but if no sample data is available then this method (and associated startupCompeted signal connection) can be removed.
-
-    import SampleData
-    iconsPath = os.path.join(os.path.dirname(__file__), 'Resources/Icons')
-
-    # To ensure that the source code repository remains small (can be downloaded and installed quickly)
-    # it is recommended to store data sets that are larger than a few MB in a Github release.
-
-    # FreeSurferMRIWatershedSkullStrip1
-    SampleData.SampleDataLogic.registerCustomSampleDataSource(
-        # Category and sample name displayed in Sample Data module
-        category='FreeSurferMRIWatershedSkullStrip',
-        sampleName='FreeSurferMRIWatershedSkullStrip1',
-        # Thumbnail should have size of approximately 260x280 pixels and stored in Resources/Icons folder.
-        # It can be created by Screen Capture module, "Capture all views" option enabled, "Number of images" set to "Single".
-        thumbnailFileName=os.path.join(iconsPath, 'FreeSurferMRIWatershedSkullStrip1.png'),
-        # Download URL and target file name
-        uris="https://github.com/Slicer/SlicerTestingData/releases/download/SHA256/998cb522173839c78657f4bc0ea907cea09fd04e44601f17c82ea27927937b95",
-        fileNames='FreeSurferMRIWatershedSkullStrip1.nrrd',
-        # Checksum to ensure file integrity. Can be computed by this command:
-        #  import hashlib; print(hashlib.sha256(open(filename, "rb").read()).hexdigest())
-        checksums='SHA256:998cb522173839c78657f4bc0ea907cea09fd04e44601f17c82ea27927937b95',
-        # This node name will be used when the data set is loaded
-        nodeNames='FreeSurferMRIWatershedSkullStrip1'
-    )
-
-    # FreeSurferMRIWatershedSkullStrip2
-    SampleData.SampleDataLogic.registerCustomSampleDataSource(
-        # Category and sample name displayed in Sample Data module
-        category='FreeSurferMRIWatershedSkullStrip',
-        sampleName='FreeSurferMRIWatershedSkullStrip2',
-        thumbnailFileName=os.path.join(iconsPath, 'FreeSurferMRIWatershedSkullStrip2.png'),
-        # Download URL and target file name
-        uris="https://github.com/Slicer/SlicerTestingData/releases/download/SHA256/1a64f3f422eb3d1c9b093d1a18da354b13bcf307907c66317e2463ee530b7a97",
-        fileNames='FreeSurferMRIWatershedSkullStrip2.nrrd',
-        checksums='SHA256:1a64f3f422eb3d1c9b093d1a18da354b13bcf307907c66317e2463ee530b7a97',
-        # This node name will be used when the data set is loaded
-        nodeNames='FreeSurferMRIWatershedSkullStrip2'
-    )
-
 
 #
 # FreeSurferMRIWatershedSkullStripWidget
 #
 
-class FreeSurferMRIWatershedSkullStripWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
+class FreeSurferMRIWatershedSkullStripWidget(ScriptedLoadableModuleWidget, VTKObservationMixin, ProcessingWidgetMixin):
     """Uses ScriptedLoadableModuleWidget base class, available at:
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
     """
@@ -103,6 +56,7 @@ class FreeSurferMRIWatershedSkullStripWidget(ScriptedLoadableModuleWidget, VTKOb
         """
         ScriptedLoadableModuleWidget.__init__(self, parent)
         VTKObservationMixin.__init__(self)  # needed for parameter node observation
+        ProcessingWidgetMixin.__init__(self)
         self.logic = None
         self._parameterNode = None
         self._updatingGUIFromParameterNode = False
@@ -136,14 +90,17 @@ class FreeSurferMRIWatershedSkullStripWidget(ScriptedLoadableModuleWidget, VTKOb
 
         # These connections ensure that whenever user changes some settings on the GUI, that is saved in the MRML scene
         # (in the selected parameter node).
-        self.ui.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-        self.ui.outputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-        self.ui.imageThresholdSliderWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
-        self.ui.invertOutputCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
-        self.ui.invertedOutputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+        self.ui.inputImageSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+        self.ui.outputImageSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+        self.ui.outputMaskSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+        self.ui.prefloodingHeightSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+        self.ui.atlasCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+        self.ui.t1CheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
 
         # Buttons
         self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.ui.cancelButton.connect('clicked(bool)', self.onCancelButton)
+        self.ui.progressBar.hide()
 
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
@@ -152,6 +109,7 @@ class FreeSurferMRIWatershedSkullStripWidget(ScriptedLoadableModuleWidget, VTKOb
         """
         Called when the application closes and the module widget is destroyed.
         """
+        self.onCancelButton()
         self.removeObservers()
 
     def enter(self):
@@ -232,18 +190,20 @@ class FreeSurferMRIWatershedSkullStripWidget(ScriptedLoadableModuleWidget, VTKOb
         self._updatingGUIFromParameterNode = True
 
         # Update node selectors and sliders
-        self.ui.inputSelector.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume"))
-        self.ui.outputSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputVolume"))
-        self.ui.invertedOutputSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputVolumeInverse"))
-        self.ui.imageThresholdSliderWidget.value = float(self._parameterNode.GetParameter("Threshold"))
-        self.ui.invertOutputCheckBox.checked = (self._parameterNode.GetParameter("Invert") == "true")
+        self.ui.inputImageSelector.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume"))
+        self.ui.outputImageSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputVolume"))
+        self.ui.outputMaskSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputMask"))
+        self.ui.prefloodingHeightSpinBox.value = int(self._parameterNode.GetParameter("PrefloodingHeight"))
+        self.ui.atlasCheckBox.checked = (self._parameterNode.GetParameter("UseAtlas") == "true")
+        self.ui.t1CheckBox.checked = (self._parameterNode.GetParameter("T1") == "true")
 
         # Update buttons states and tooltips
-        if self._parameterNode.GetNodeReference("InputVolume") and self._parameterNode.GetNodeReference("OutputVolume"):
-            self.ui.applyButton.toolTip = "Compute output volume"
+        if (self._parameterNode.GetNodeReference("InputVolume") and
+            (self._parameterNode.GetNodeReference("OutputVolume") or self._parameterNode.GetNodeReference("OutputMask"))):
+            self.ui.applyButton.toolTip = "Compute output stripped image volume and/or binary brain mask volume"
             self.ui.applyButton.enabled = True
         else:
-            self.ui.applyButton.toolTip = "Select input and output volume nodes"
+            self.ui.applyButton.toolTip = "Select input and output image volume or binary brain mask volume nodes"
             self.ui.applyButton.enabled = False
 
         # All the GUI updates are done
@@ -260,11 +220,12 @@ class FreeSurferMRIWatershedSkullStripWidget(ScriptedLoadableModuleWidget, VTKOb
 
         wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
 
-        self._parameterNode.SetNodeReferenceID("InputVolume", self.ui.inputSelector.currentNodeID)
-        self._parameterNode.SetNodeReferenceID("OutputVolume", self.ui.outputSelector.currentNodeID)
-        self._parameterNode.SetParameter("Threshold", str(self.ui.imageThresholdSliderWidget.value))
-        self._parameterNode.SetParameter("Invert", "true" if self.ui.invertOutputCheckBox.checked else "false")
-        self._parameterNode.SetNodeReferenceID("OutputVolumeInverse", self.ui.invertedOutputSelector.currentNodeID)
+        self._parameterNode.SetNodeReferenceID("InputVolume", self.ui.inputImageSelector.currentNodeID)
+        self._parameterNode.SetNodeReferenceID("OutputVolume", self.ui.outputImageSelector.currentNodeID)
+        self._parameterNode.SetNodeReferenceID("OutputMask", self.ui.outputMaskSelector.currentNodeID)
+        self._parameterNode.SetParameter("PrefloodingHeight", str(self.ui.prefloodingHeightSpinBox.value))
+        self._parameterNode.SetParameter("UseAtlas", "true" if self.ui.atlasCheckBox.checked else "false")
+        self._parameterNode.SetParameter("T1", "true" if self.ui.t1CheckBox.checked else "false")
 
         self._parameterNode.EndModify(wasModified)
 
@@ -274,15 +235,22 @@ class FreeSurferMRIWatershedSkullStripWidget(ScriptedLoadableModuleWidget, VTKOb
         """
         with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
 
-            # Compute output
-            self.logic.process(self.ui.inputSelector.currentNode(), self.ui.outputSelector.currentNode(),
-                               self.ui.imageThresholdSliderWidget.value, self.ui.invertOutputCheckBox.checked)
+            # Skip the run if inputs, parameters and outputs are unchanged since the last successful run
+            fingerprint = self.outdatedFingerprint(['InputVolume'], ['OutputVolume', 'OutputMask'])
+            if fingerprint is None:
+                return
 
-            # Compute inverted output (if needed)
-            if self.ui.invertedOutputSelector.currentNode():
-                # If additional output volume is selected then result with inverted threshold is written there
-                self.logic.process(self.ui.inputSelector.currentNode(), self.ui.invertedOutputSelector.currentNode(),
-                                   self.ui.imageThresholdSliderWidget.value, not self.ui.invertOutputCheckBox.checked, showResult=False)
+            # Compute output in the background
+            job = self.logic.createProcessingJob(self.ui.inputImageSelector.currentNode(),
+                                                 self.ui.outputImageSelector.currentNode(),
+                                                 self.ui.outputMaskSelector.currentNode(),
+                                                 self.ui.prefloodingHeightSpinBox.value,
+                                                 self.ui.atlasCheckBox.checked,
+                                                 self.ui.t1CheckBox.checked,
+                                                 onOutput=self.onProcessingOutput,
+                                                 onProgress=self.onProcessingProgress,
+                                                 onFinished=self.onProcessingFinished)
+            self.startJob(job, fingerprint)
 
 
 #
@@ -299,6 +267,9 @@ class FreeSurferMRIWatershedSkullStripLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    # Default preflooding height of mri_watershed (in percent)
+    DEFAULT_PREFLOODING_HEIGHT = 25
+
     def __init__(self):
         """
         Called when the logic class is instantiated. Can be used for initializing member variables.
@@ -309,42 +280,152 @@ class FreeSurferMRIWatershedSkullStripLogic(ScriptedLoadableModuleLogic):
         """
         Initialize parameter node with default settings.
         """
-        if not parameterNode.GetParameter("Threshold"):
-            parameterNode.SetParameter("Threshold", "100.0")
-        if not parameterNode.GetParameter("Invert"):
-            parameterNode.SetParameter("Invert", "false")
+        if not parameterNode.GetParameter("PrefloodingHeight"):
+            parameterNode.SetParameter("PrefloodingHeight", str(self.DEFAULT_PREFLOODING_HEIGHT))
+        if not parameterNode.GetParameter("UseAtlas"):
+            parameterNode.SetParameter("UseAtlas", "false")
+        if not parameterNode.GetParameter("T1"):
+            parameterNode.SetParameter("T1", "false")
 
-    def process(self, inputVolume, outputVolume, imageThreshold, invert=False, showResult=True):
+    def process(self, inputImageNode,
+                outputImageNode=None, outputMaskNode=None,
+                prefloodingHeight=DEFAULT_PREFLOODING_HEIGHT, useAtlas=False, t1=False):
         """
         Run the processing algorithm.
         Can be used without GUI widget.
-        :param inputVolume: volume to be thresholded
-        :param outputVolume: thresholding result
-        :param imageThreshold: values above/below this threshold will be set to 0
-        :param invert: if True then values above the threshold will be set to 0, otherwise values below are set to 0
-        :param showResult: show output volume in slice viewers
-        """
-
-        if not inputVolume or not outputVolume:
-            raise ValueError("Input or output volume is invalid")
+        :param inputImageNode: head volume to be skull stripped
+        :param outputImageNode: scalar volume to load the stripped image into (optional)
+        :param outputMaskNode: labelmap volume or segmentation to load the brain mask into (optional)
+        :param prefloodingHeight: preflooding height in percent; higher values keep more tissue
+        :param useAtlas: use the atlas information to correct the segmentation
+        :param t1: the input is a T1 volume normalized by FreeSurfer (white matter intensity of 110)
+        See https://surfer.nmr.mgh.harvard.edu/fswiki/mri_watershed
+        :return: ProcessingStats with the timing and resource usage of each processing stage
+        """
+        job = self.createProcessingJob(inputImageNode, outputImageNode, outputMaskNode,
+                                       prefloodingHeight, useAtlas, t1)
+        job.run()
+        return job.stats
+
+    def createProcessingJob(self, inputImageNode,
+                            outputImageNode=None, outputMaskNode=None,
+                            prefloodingHeight=DEFAULT_PREFLOODING_HEIGHT, useAtlas=False, t1=False,
+                            onOutput=None, onFinished=None, onProgress=None):
+        """
+        Prepare the processing algorithm without running it.
+        The input volume is exported immediately and the returned job runs
+        mri_watershed and loads the results into the output nodes, either
+        synchronously with job.run() or in the background with job.start().
+        :param onOutput: called with each line of the mri_watershed output
+        :param onFinished: called with the job when it succeeded, failed or was cancelled
+        :param onProgress: called with a ProgressEvent when a processing stage starts
+        See process() for the description of the other parameters.
+        """
+
+        if not inputImageNode:
+            raise ValueError("Input volume is undefined")
+        if not outputImageNode and not outputMaskNode:
+            raise ValueError("Output image or mask volume is undefined")
 
-        import time
-        startTime = time.time()
         logging.info('Processing started')
 
-        # Compute the thresholded output volume using the "Threshold Scalar Volume" CLI module
-        cliParams = {
-            'InputVolume': inputVolume.GetID(),
-            'OutputVolume': outputVolume.GetID(),
-            'ThresholdValue': imageThreshold,
-            'ThresholdType': 'Above' if invert else 'Below'
-        }
-        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True, update_display=showResult)
-        # We don't need the CLI module node anymore, remove it to not clutter the scene with it
-        slicer.mrmlScene.RemoveNode(cliNode)
-
-        stopTime = time.time()
-        logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
+        from FreeSurferCommonLib import (CommandJob, FreeSurferToolchain, ProcessingStats, ResultCache, StagingArea,
+                                         exportVolumeNode)
+
+        # Fail before exporting anything if FreeSurfer is not available
+        toolchain = FreeSurferToolchain.resolve()
+        freeSurferHome = toolchain.home
+        staging = StagingArea()
+
+        # Temporary image files in FreeSurfer format
+        temp_image = staging.file('input')
+        temp_out = staging.file('stripped')
+
+        stats = ProcessingStats('FreeSurferMRIWatershedSkullStrip')
+        stats.info['inputDimensions'] = list(inputImageNode.GetImageData().GetDimensions())
+        stats.info['freeSurferVersion'] = toolchain.version
+
+        args = self.watershedArgs(freeSurferHome, temp_image, temp_out, prefloodingHeight, useAtlas, t1)
+
+        # Reuse results of a previous run on the same volume with the same parameters.
+        # mri_watershed only writes the stripped image, the mask is computed from it.
+        cache = ResultCache.fromSettings()
+        outputFiles = {staging.fileName('stripped'): temp_out}
+        with stats.stage('cache lookup'):
+            cacheKey = cache.key(inputImageNode, self.watershedArgs(
+                freeSurferHome, staging.fileName('input'), staging.fileName('stripped'),
+                prefloodingHeight, useAtlas, t1), stats.info['freeSurferVersion'])
+            cached = cache.lookup(cacheKey, outputFiles.keys())
+        if cached:
+            args = None
+            temp_out = cached[staging.fileName('stripped')]
+        else:
+            # Convert image to FreeSurfer format
+            with stats.stage('export') as stage:
+                exportVolumeNode(inputImageNode, temp_image)
+                stage.wrote(temp_image)
+
+        def onCompleted():
+            if not cached:
+                with stats.stage('cache store'):
+                    cache.store(cacheKey, outputFiles)
+
+            # Load temporary files back into nodes
+            with stats.stage('import') as stage:
+                self.loadOutputs(temp_out, outputImageNode, outputMaskNode)
+                stage.read(temp_out)
+
+        job = CommandJob(args, onCompleted=onCompleted, onOutput=onOutput, onFinished=onFinished, stats=stats,
+                         onProgress=onProgress)
+        job.resources.append(staging)
+        return job
+
+    def loadOutputs(self, outPath, outputImageNode=None, outputMaskNode=None):
+        """
+        Load the mri_watershed output file into nodes.
+        The file is read once; the brain mask is made of its non-zero voxels.
+        :param outPath: stripped image file
+        :param outputImageNode: scalar volume to load the stripped image into (optional)
+        :param outputMaskNode: labelmap volume or segmentation to load the brain mask into (optional)
+        """
+        import numpy as np
+        from FreeSurferCommonLib import importArrayToVolumeNode, importLabelmapToSegmentationNode, readVolumeFile
+
+        voxels, ijkToRAS = readVolumeFile(outPath)
+        if outputImageNode:
+            importArrayToVolumeNode(voxels, ijkToRAS, outputImageNode)
+        if outputMaskNode:
+            # Mask has the 'tissue' label with value '1' of the generic anatomy color table
+            colorTableNode = slicer.mrmlScene.GetFirstNodeByName('GenericAnatomyColors')
+            mask = (voxels > 0).astype(np.uint8)
+            if outputMaskNode.GetTypeDisplayName() == 'LabelMapVolume':
+                importArrayToVolumeNode(mask, ijkToRAS, outputMaskNode)
+                outputMaskNode.GetDisplayNode().SetAndObserveColorNodeID(colorTableNode.GetID())
+            elif outputMaskNode.GetTypeDisplayName() == 'Segmentation':
+                importLabelmapToSegmentationNode(mask, ijkToRAS, outputMaskNode, colorTableNode)
+            else:
+                raise NotImplementedError
+
+    def watershedArgs(self, freeSurferHome, imagePath, outPath,
+                      prefloodingHeight=DEFAULT_PREFLOODING_HEIGHT, useAtlas=False, t1=False):
+        """
+        Build the mri_watershed command line.
+        :param freeSurferHome: FreeSurfer installation folder
+        :param imagePath: input image file
+        :param outPath: stripped image file
+        """
+        from FreeSurferCommonLib import FreeSurferToolchain
+
+        args = [FreeSurferToolchain.resolve(freeSurferHome).binary('mri_watershed')]
+        if prefloodingHeight != self.DEFAULT_PREFLOODING_HEIGHT:
+            args.extend(['-h', str(int(prefloodingHeight))])
+        if useAtlas:
+            args.extend(['-atlas'])
+        if t1:
+            args.extend(['-T1'])
+        # Options must precede the input and output files
+        args.extend([imagePath, outPath])
+        return args
 
 
 #
@@ -383,34 +464,43 @@ class FreeSurferMRIWatershedSkullStripTest(ScriptedLoadableModuleTest):
 
         self.delayDisplay("Starting the test")
 
+        logic = FreeSurferMRIWatershedSkullStripLogic()
+
+        # Test the command line, in an installation folder containing only the command
+        import tempfile
+        with tempfile.TemporaryDirectory() as freeSurferHome:
+            binary = os.path.join(freeSurferHome, 'bin', 'mri_watershed')
+            os.mkdir(os.path.dirname(binary))
+            with open(binary, 'w') as f:
+                f.write('#!/bin/sh\n')
+            os.chmod(binary, 0o755)
+            args = logic.watershedArgs(freeSurferHome, 'in.mgz', 'out.mgz')
+            self.assertEqual(args[1:], ['in.mgz', 'out.mgz'])
+            args = logic.watershedArgs(freeSurferHome, 'in.mgz', 'out.mgz', prefloodingHeight=15, useAtlas=True, t1=True)
+            self.assertEqual(args[1:], ['-h', '15', '-atlas', '-T1', 'in.mgz', 'out.mgz'])
+            self.assertEqual(os.path.basename(args[0]), 'mri_watershed')
+
+        if not os.environ.get('FREESURFER_HOME'):
+            self.delayDisplay('FREESURFER_HOME is not set, mri_watershed is not run')
+            return
+
         # Get/create input data
 
         import SampleData
-        registerSampleData()
-        inputVolume = SampleData.downloadSample('FreeSurferMRIWatershedSkullStrip1')
+        inputVolume = SampleData.downloadSample('MRHead')
         self.delayDisplay('Loaded test data set')
 
-        inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-        self.assertEqual(inputScalarRange[0], 0)
-        self.assertEqual(inputScalarRange[1], 695)
-
         outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-        threshold = 100
+        outputMask = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
 
         # Test the module logic
 
-        logic = FreeSurferMRIWatershedSkullStripLogic()
-
-        # Test algorithm with non-inverted threshold
-        logic.process(inputVolume, outputVolume, threshold, True)
-        outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-        self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-        self.assertEqual(outputScalarRange[1], threshold)
-
-        # Test algorithm with inverted threshold
-        logic.process(inputVolume, outputVolume, threshold, False)
-        outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-        self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-        self.assertEqual(outputScalarRange[1], inputScalarRange[1])
+        logic.process(inputVolume, outputVolume, outputMask)
+        strippedVoxels = slicer.util.arrayFromVolume(outputVolume)
+        maskVoxels = slicer.util.arrayFromVolume(outputMask)
+        self.assertEqual(strippedVoxels.shape, maskVoxels.shape)
+        self.assertGreater(maskVoxels.sum(), 0)
+        self.assertLess(maskVoxels.sum(), maskVoxels.size)
+        self.assertTrue(((strippedVoxels != 0) == (maskVoxels == 1)).all())
 
         self.delayDisplay('Test passed')
@@ -7,6 +7,23 @@ import slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
+from FreeSurferCommonLib import ProcessingWidgetMixin
+
+# Image file formats supported by mri_synthseg
+SYNTHSEG_FORMATS = ('.nii', '.nii.gz', '.mgz')
+
+# Volumes of the segmented structures written by mri_synthseg --vol
+VOLUMES_FILE_NAME = 'volumes.csv'
+
+# Quality control scores written by mri_synthseg --qc
+QC_FILE_NAME = 'qc.csv'
+
+# Margin (in mm) added around the region of interest when cropping the input
+CROP_MARGIN = 10.0
+
+# Posteriors are written uncompressed so that they can be memory-mapped
+POSTERIORS_FORMAT = '.nii'
+
 
 #
 # FreeSurferSynthSeg
@@ -21,7 +38,7 @@ class FreeSurferSynthSeg(ScriptedLoadableModule):
         ScriptedLoadableModule.__init__(self, parent)
         self.parent.title = "FreeSurfer SynthSeg Brain MRI Segmentation"
         self.parent.categories = ["Segmentation"]
-        self.parent.dependencies = []
+        self.parent.dependencies = ["FreeSurferCommon", "FreeSurferSynthStripSkullStripScripted"]
         self.parent.contributors = ["Benjamin Zwick (ISML)"]
         # TODO: update with short description of the module and a link to online module documentation
         self.parent.helpText = """Segmentation of brain MRI scans using SynthSeg from FreeSurfer.
@@ -65,7 +82,7 @@ def registerSampleData():
 # FreeSurferSynthSegWidget
 #
 
-class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
+class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin, ProcessingWidgetMixin):
     """Uses ScriptedLoadableModuleWidget base class, available at:
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
     """
@@ -76,6 +93,7 @@ class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         """
         ScriptedLoadableModuleWidget.__init__(self, parent)
         VTKObservationMixin.__init__(self)  # needed for parameter node observation
+        ProcessingWidgetMixin.__init__(self)
         self.logic = None
         self._parameterNode = None
         self._updatingGUIFromParameterNode = False
@@ -112,6 +130,8 @@ class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.ui.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
         self.ui.outputSegmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
         self.ui.outputResampleSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+        self.ui.outputVolumesSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+        self.ui.outputQCSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
         self.ui.parcCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
         self.ui.robustCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
         self.ui.fastCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
@@ -119,9 +139,14 @@ class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.ui.threadsSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
         self.ui.v1CheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
         self.ui.ctCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+        self.ui.cropSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+        self.ui.posteriorsPathLineEdit.connect("currentPathChanged(QString)", self.updateParameterNodeFromGUI)
+        self.ui.posteriorStructuresLineEdit.connect("editingFinished()", self.updateParameterNodeFromGUI)
 
         # Buttons
         self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.ui.cancelButton.connect('clicked(bool)', self.onCancelButton)
+        self.ui.progressBar.hide()
 
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
@@ -130,6 +155,7 @@ class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         """
         Called when the application closes and the module widget is destroyed.
         """
+        self.onCancelButton()
         self.removeObservers()
 
     def enter(self):
@@ -213,6 +239,8 @@ class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.ui.inputSelector.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume"))
         self.ui.outputSegmentationSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputSegmentation"))
         self.ui.outputResampleSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputResample"))
+        self.ui.outputVolumesSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputVolumes"))
+        self.ui.outputQCSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputQC"))
         self.ui.parcCheckBox.checked = (self._parameterNode.GetParameter("Parc") == "true")
         self.ui.robustCheckBox.checked = (self._parameterNode.GetParameter("Robust") == "true")
         self.ui.fastCheckBox.checked = (self._parameterNode.GetParameter("Fast") == "true")
@@ -220,6 +248,9 @@ class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.ui.threadsSpinBox.value = int(self._parameterNode.GetParameter("Threads"))
         self.ui.v1CheckBox.checked = (self._parameterNode.GetParameter("V1") == "true")
         self.ui.ctCheckBox.checked = (self._parameterNode.GetParameter("CT") == "true")
+        self.ui.cropSelector.setCurrentNode(self._parameterNode.GetNodeReference("Crop"))
+        self.ui.posteriorsPathLineEdit.currentPath = self._parameterNode.GetParameter("Posteriors")
+        self.ui.posteriorStructuresLineEdit.text = self._parameterNode.GetParameter("PosteriorStructures")
 
         # Update buttons states and tooltips
         if self._parameterNode.GetNodeReference("InputVolume") and self._parameterNode.GetNodeReference("OutputSegmentation"):
@@ -246,6 +277,8 @@ class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self._parameterNode.SetNodeReferenceID("InputVolume", self.ui.inputSelector.currentNodeID)
         self._parameterNode.SetNodeReferenceID("OutputSegmentation", self.ui.outputSegmentationSelector.currentNodeID)
         self._parameterNode.SetNodeReferenceID("OutputResample", self.ui.outputResampleSelector.currentNodeID)
+        self._parameterNode.SetNodeReferenceID("OutputVolumes", self.ui.outputVolumesSelector.currentNodeID)
+        self._parameterNode.SetNodeReferenceID("OutputQC", self.ui.outputQCSelector.currentNodeID)
         self._parameterNode.SetParameter("Parc", "true" if self.ui.parcCheckBox.checked else "false")
         self._parameterNode.SetParameter("Robust", "true" if self.ui.robustCheckBox.checked else "false")
         self._parameterNode.SetParameter("Fast", "true" if self.ui.fastCheckBox.checked else "false")
@@ -253,6 +286,9 @@ class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self._parameterNode.SetParameter("Threads", str(self.ui.threadsSpinBox.value))
         self._parameterNode.SetParameter("V1", "true" if self.ui.v1CheckBox.checked else "false")
         self._parameterNode.SetParameter("CT", "true" if self.ui.ctCheckBox.checked else "false")
+        self._parameterNode.SetNodeReferenceID("Crop", self.ui.cropSelector.currentNodeID)
+        self._parameterNode.SetParameter("Posteriors", self.ui.posteriorsPathLineEdit.currentPath)
+        self._parameterNode.SetParameter("PosteriorStructures", self.ui.posteriorStructuresLineEdit.text)
 
         self._parameterNode.EndModify(wasModified)
 
@@ -262,22 +298,47 @@ class FreeSurferSynthSegWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         """
         with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
 
-            # Compute output
-            self.logic.process(
+            # Skip the run if inputs, parameters and outputs are unchanged since the last successful run
+            fingerprint = self.outdatedFingerprint(
+                ['InputVolume', 'Crop'],
+                ['OutputSegmentation', 'OutputResample', 'OutputVolumes', 'OutputQC'],
+                outputFileParameters=['Posteriors'])
+            if fingerprint is None:
+                return
+
+            outputNode = self.ui.outputSegmentationSelector.currentNode()
+            parc = self.ui.parcCheckBox.checked
+            post = self.ui.posteriorsPathLineEdit.currentPath
+            structures = [name.strip() for name in self.ui.posteriorStructuresLineEdit.text.split(',') if name.strip()]
+
+            def onFinished(job):
+                # Only the posteriors of the selected structures are loaded into the scene
+                if job.status == job.Succeeded and post and structures:
+                    with slicer.util.tryWithErrorDisplay("Failed to load posteriors."):
+                        self.logic.loadPosteriors(post, parc).loadChannels(structures)
+                self.onProcessingFinished(job)
+
+            # Compute output in the background
+            job = self.logic.createProcessingJob(
                 self.ui.inputSelector.currentNode(),
-                self.ui.outputSegmentationSelector.currentNode(),
-                self.ui.parcCheckBox.checked,
+                outputNode,
+                parc,
                 self.ui.robustCheckBox.checked,
                 self.ui.fastCheckBox.checked,
-                vol=None,
-                qc=None,
-                post=None,
+                vol=self.ui.outputVolumesSelector.currentNode(),
+                qc=self.ui.outputQCSelector.currentNode(),
+                post=post or None,
                 resample=self.ui.outputResampleSelector.currentNode(),
-                crop=None,
-                threads=self.ui.threadsSpinBox.value,
+                crop=self.ui.cropSelector.currentNode(),
+                # The number of threads is a CPU option of the GUI
+                threads=self.ui.threadsSpinBox.value if self.ui.cpuCheckBox.checked else None,
                 cpu=self.ui.cpuCheckBox.checked,
                 v1=self.ui.v1CheckBox.checked,
-                ct=self.ui.ctCheckBox.checked)
+                ct=self.ui.ctCheckBox.checked,
+                onOutput=self.onProcessingOutput,
+                onProgress=self.onProcessingProgress,
+                onFinished=onFinished)
+            self.startJob(job, fingerprint)
 
 
 #
@@ -328,8 +389,162 @@ class FreeSurferSynthSegLogic(ScriptedLoadableModuleLogic):
         Can be used without GUI widget.
         :param input: input volume to be segmented
         :param output: output segmentations
+        :param vol: optional table node to load the volumes of the segmented structures into
+        :param qc: optional table node to load the quality control scores into
+        :param post: optional .nii file where the posterior probabilities are kept,
+          see loadPosteriors() to load the channels of selected structures
+        :param crop: size (in mm) of the image patch to analyse around the center of the image,
+          as one value or three values; or a Markups ROI, labelmap volume or segmentation (e.g., a
+          SynthStrip brain mask) around which the input is cropped, see cropRegion()
+        :param threads: number of CPU threads, None for all the CPU cores; passed as --threads when running
+          on the CPU and, on the CPU or the GPU, as the thread environment variables of mri_synthseg
+          so that TensorFlow does not use every core
         # TODO: add remaining documentation here.
         See https://surfer.nmr.mgh.harvard.edu/fswiki/SynthSeg
+        :return: ProcessingStats with the timing and resource usage of each processing stage
+        """
+        job = self.createProcessingJob(inputNode, outputNode,
+                                       parc=parc, robust=robust, fast=fast,
+                                       vol=vol, qc=qc, post=post, resample=resample, crop=crop,
+                                       threads=threads, cpu=cpu, v1=v1, ct=ct)
+        job.run()
+        return job.stats
+
+    def createProcessingJob(self, inputNode, outputNode,
+                            parc=False, robust=False, fast=False,
+                            vol=None, qc=None, post=None, resample=None, crop=None,
+                            threads=None, cpu=False, v1=False, ct=False,
+                            onOutput=None, onFinished=None, onProgress=None):
+        """
+        Prepare the processing algorithm without running it.
+        The input volume is exported immediately and the returned job runs
+        mri_synthseg and loads the results into the output nodes, either
+        synchronously with job.run() or in the background with job.start().
+        :param onOutput: called with each line of the mri_synthseg output
+        :param onFinished: called with the job when it succeeded, failed or was cancelled
+        :param onProgress: called with a ProgressEvent when a processing stage starts
+        See process() for the description of the other parameters.
+        """
+
+        if not inputNode:
+            raise ValueError("Input volume is undefined")
+        if not outputNode:
+            raise ValueError("Output segmentation is undefined")
+
+        logging.info('Processing started')
+
+        from FreeSurferCommonLib import (CommandJob, ProcessingStats, ResultCache, StagingArea, exportVolumeNode,
+                                         threadEnvironment)
+
+        stats = ProcessingStats('FreeSurferSynthSeg')
+        stats.info['inputDimensions'] = list(inputNode.GetImageData().GetDimensions())
+        stats.info['freeSurferVersion'] = self.freeSurferVersion()
+
+        self.checkPosteriorsPath(post)
+        staging = StagingArea(SYNTHSEG_FORMATS)
+        extent, crop = self.cropRegion(inputNode, crop)
+
+        # Temporary image files in FreeSurfer format
+        temp_input = staging.file('input')
+        temp_output = staging.file('output')
+        temp_resample = staging.file('resample')
+        temp_vol = str(staging.path / VOLUMES_FILE_NAME)
+        temp_qc = str(staging.path / QC_FILE_NAME)
+
+        # Reuse results of a previous run on the same volume with the same parameters
+        cache = ResultCache.fromSettings()
+        outputName = staging.fileName('output')
+        resampleName = staging.fileName('resample')
+        outputFiles = {outputName: temp_output}
+        if resample:
+            outputFiles[resampleName] = temp_resample
+        if vol:
+            outputFiles[VOLUMES_FILE_NAME] = temp_vol
+        if qc:
+            outputFiles[QC_FILE_NAME] = temp_qc
+        cacheFiles = list(outputFiles)
+        with stats.stage('cache lookup'):
+            # Posteriors are written directly to their final file, which is not cached
+            cacheKey = None if post else cache.key(inputNode, self.cacheArgs(
+                staging, parc=parc, robust=robust, fast=fast, vol=vol, qc=qc,
+                resample=resample, crop=crop, cpu=cpu, v1=v1, ct=ct) + [f'extent={extent}'],
+                stats.info['freeSurferVersion'])
+            cached = cache.lookup(cacheKey, cacheFiles)
+        if cached:
+            args = None
+            temp_output = cached[outputName]
+            temp_resample = cached.get(resampleName)
+            temp_vol = cached.get(VOLUMES_FILE_NAME)
+            temp_qc = cached.get(QC_FILE_NAME)
+        else:
+            # Convert image to FreeSurfer format
+            with stats.stage('export') as stage:
+                exportVolumeNode(inputNode, temp_input, extent)
+                stage.wrote(temp_input)
+
+            args = self.synthSegArgs(temp_input, temp_output,
+                                     parc=parc, robust=robust, fast=fast,
+                                     vol=temp_vol if vol else None, qc=temp_qc if qc else None, post=post,
+                                     resample=temp_resample if resample else None,
+                                     crop=crop, threads=threads, cpu=cpu, v1=v1, ct=ct)
+
+        def onCompleted():
+            if not cached:
+                with stats.stage('cache store'):
+                    cache.store(cacheKey, outputFiles)
+
+            # Load temporary files back into nodes
+            with stats.stage('import') as stage:
+                colorTableNode = self.loadColorTable()
+                self.loadOutput(temp_output, outputNode, colorTableNode,
+                                resamplePath=temp_resample, resampleNode=resample)
+                if vol:
+                    self.loadVolumes(temp_vol, vol)
+                if qc:
+                    self.loadQC(temp_qc, qc, [inputNode.GetName()])
+                stage.read(temp_output, temp_resample if resample else None,
+                           temp_vol if vol else None, temp_qc if qc else None)
+
+        job = CommandJob(args, onCompleted=onCompleted, onOutput=onOutput, onFinished=onFinished, stats=stats,
+                         onProgress=onProgress, environment=threadEnvironment(threads))
+        job.resources.append(staging)
+        return job
+
+    def processSkullStripped(self, inputNode, outputNode,
+                             strippedNode=None, maskNode=None,
+                             useGPU=False, borderThreshold=1, excludeCSF=False,
+                             **kwargs):
+        """
+        Skull strip the input volume with SynthStrip and segment the stripped image with SynthSeg.
+        Can be used without GUI widget.
+        :param inputNode: input head volume
+        :param outputNode: output labelmap or segmentation node
+        :param strippedNode: optional scalar volume to load the intermediate stripped image into
+        :param maskNode: optional labelmap or segmentation node to load the brain mask into
+        :param useGPU, borderThreshold, excludeCSF: SynthStrip parameters,
+          see FreeSurferSynthStripSkullStripScriptedLogic.process()
+        :param kwargs: SynthSeg parameters, see process()
+        :return: ProcessingStats with the timing and resource usage of each processing stage
+        """
+        job = self.createSkullStripPipelineJob(inputNode, outputNode, strippedNode, maskNode,
+                                               useGPU=useGPU, borderThreshold=borderThreshold,
+                                               excludeCSF=excludeCSF, **kwargs)
+        job.run()
+        return job.stats
+
+    def createSkullStripPipelineJob(self, inputNode, outputNode,
+                                    strippedNode=None, maskNode=None,
+                                    useGPU=False, borderThreshold=1, excludeCSF=False,
+                                    parc=False, robust=False, fast=False,
+                                    vol=None, qc=None, post=None, resample=None, crop=None,
+                                    threads=None, cpu=False, v1=False, ct=False,
+                                    onOutput=None, onFinished=None, onProgress=None):
+        """
+        Prepare the SynthStrip and SynthSeg pipeline without running it.
+        The stripped image is passed from mri_synthstrip to mri_synthseg as a file
+        in the temporary folder, so it is only loaded into the scene if strippedNode
+        is set; otherwise only the final segmentation (and resampled image) is loaded.
+        See processSkullStripped() for the description of the parameters.
         """
 
         if not inputNode:
@@ -337,34 +552,285 @@ class FreeSurferSynthSegLogic(ScriptedLoadableModuleLogic):
         if not outputNode:
             raise ValueError("Output segmentation is undefined")
 
-        import time
-        startTime = time.time()
         logging.info('Processing started')
 
-        import os
-        from pathlib import Path
-        import qt
+        from FreeSurferCommonLib import (CommandJob, FreeSurferToolchain, ProcessingStats, ResultCache, StagingArea,
+                                         exportVolumeNode, threadEnvironment)
+        from FreeSurferSynthStripSkullStripScripted import FreeSurferSynthStripSkullStripScriptedLogic
+
+        synthStripLogic = FreeSurferSynthStripSkullStripScriptedLogic()
+        freeSurferHome = FreeSurferToolchain.resolve().home
 
-        temp_dir = qt.QTemporaryDir()
-        temp_path = Path(temp_dir.path())
+        stats = ProcessingStats('FreeSurferSynthSeg pipeline')
+        stats.info['inputDimensions'] = list(inputNode.GetImageData().GetDimensions())
+        stats.info['freeSurferVersion'] = self.freeSurferVersion()
+
+        # Both commands must read the intermediate file
+        self.checkPosteriorsPath(post)
+        staging = StagingArea(SYNTHSEG_FORMATS)
+        extent, crop = self.cropRegion(inputNode, crop)
 
         # Temporary image files in FreeSurfer format
-        temp_input = str(temp_path / 'input.mgz')
-        temp_output = str(temp_path / 'output.mgz')
-        temp_resample = str(temp_path / 'resample.mgz')
-
-        # Convert image to FreeSurfer mgz format
-        slicer.util.exportNode(inputNode, temp_input)
-
-        fs_env = os.environ.copy()
-        # Use system Python environment
-        fs_env['PYTHONHOME'] = ''
-        print("FREESURFER_HOME:", fs_env['FREESURFER_HOME'])
-
-        args = [fs_env['FREESURFER_HOME'] + '/bin/mri_synthseg']
-        args.extend(['--i', temp_input])
-        if outputNode:
-            args.extend(['--o', temp_output])
+        temp_input = staging.file('input')
+        temp_stripped = staging.file('stripped')
+        temp_mask = staging.file('mask')
+        temp_output = staging.file('output')
+        temp_resample = staging.file('resample')
+        temp_vol = str(staging.path / VOLUMES_FILE_NAME)
+        temp_qc = str(staging.path / QC_FILE_NAME)
+
+        synthSegParameters = dict(parc=parc, robust=robust, fast=fast, post=post,
+                                  crop=crop, cpu=cpu, v1=v1, ct=ct)
+
+        def pipelineArgs(path, threads=threads):
+            # Command lines of the pipeline, with file names (including extension) mapped to paths by path()
+            def fileName(name):
+                return path(staging.fileName(name))
+            return [
+                synthStripLogic.synthStripArgs(freeSurferHome, fileName('input'), fileName('stripped'),
+                                               fileName('mask') if maskNode else None,
+                                               useGPU, borderThreshold, excludeCSF),
+                self.synthSegArgs(fileName('stripped'), fileName('output'),
+                                  resample=fileName('resample') if resample else None,
+                                  vol=path(VOLUMES_FILE_NAME) if vol else None,
+                                  qc=path(QC_FILE_NAME) if qc else None, threads=threads, **synthSegParameters),
+            ]
+
+        # Reuse results of a previous run on the same volume with the same parameters
+        cache = ResultCache.fromSettings()
+        outputFiles = {staging.fileName('output'): temp_output}
+        if resample:
+            outputFiles[staging.fileName('resample')] = temp_resample
+        if vol:
+            outputFiles[VOLUMES_FILE_NAME] = temp_vol
+        if qc:
+            outputFiles[QC_FILE_NAME] = temp_qc
+        if strippedNode:
+            outputFiles[staging.fileName('stripped')] = temp_stripped
+        if maskNode:
+            outputFiles[staging.fileName('mask')] = temp_mask
+        with stats.stage('cache lookup'):
+            # Posteriors are written directly to their final file, which is not cached. Commands are
+            # identified by their name and the number of threads is left out, as in cacheArgs()
+            cacheArgs = [[os.path.basename(args[0])] + args[1:]
+                         for args in pipelineArgs(lambda name: name, threads=None)]
+            cacheKey = None if post else cache.key(inputNode, cacheArgs + [f'extent={extent}'],
+                                                   stats.info['freeSurferVersion'])
+            cached = cache.lookup(cacheKey, outputFiles.keys())
+        if cached:
+            args = None
+            temp_output = cached[staging.fileName('output')]
+            temp_resample = cached.get(staging.fileName('resample'))
+            temp_stripped = cached.get(staging.fileName('stripped'))
+            temp_mask = cached.get(staging.fileName('mask'))
+            temp_vol = cached.get(VOLUMES_FILE_NAME)
+            temp_qc = cached.get(QC_FILE_NAME)
+        else:
+            # Convert image to FreeSurfer format
+            with stats.stage('export') as stage:
+                exportVolumeNode(inputNode, temp_input, extent)
+                stage.wrote(temp_input)
+            args = pipelineArgs(lambda name: str(staging.path / name))
+
+        def onCompleted():
+            if not cached:
+                with stats.stage('cache store'):
+                    cache.store(cacheKey, outputFiles)
+
+            # Load temporary files back into nodes, intermediate results only if requested
+            with stats.stage('import') as stage:
+                colorTableNode = self.loadColorTable()
+                self.loadOutput(temp_output, outputNode, colorTableNode,
+                                resamplePath=temp_resample, resampleNode=resample)
+                if vol:
+                    self.loadVolumes(temp_vol, vol)
+                if qc:
+                    self.loadQC(temp_qc, qc, [inputNode.GetName()])
+                if strippedNode or maskNode:
+                    synthStripLogic.loadOutputs(temp_stripped, temp_mask, strippedNode, maskNode)
+                stage.read(temp_output, temp_resample if resample else None,
+                           temp_vol if vol else None, temp_qc if qc else None,
+                           temp_stripped if strippedNode else None, temp_mask if maskNode else None)
+
+        job = CommandJob(args, onCompleted=onCompleted, onOutput=onOutput, onFinished=onFinished, stats=stats,
+                         onProgress=onProgress, environment=threadEnvironment(threads))
+        job.resources.append(staging)
+        return job
+
+    def processBatch(self, inputNodes, outputNodes,
+                     parc=False, robust=False, fast=False,
+                     resampleNodes=None, qc=None,
+                     threads=None, cpu=False, v1=False, ct=False):
+        """
+        Segment several volumes with a single mri_synthseg invocation.
+        All inputs are exported into one temporary folder and the folder is
+        passed to mri_synthseg, so the model is loaded only once for the batch.
+        :param inputNodes: list of input volumes to be segmented
+        :param outputNodes: list of output labelmap or segmentation nodes (same length as inputNodes)
+        :param resampleNodes: optional list of scalar volumes (or None items) for the resampled images
+        :param qc: optional table node to append the quality control scores of each volume to (one row per volume),
+          so that the scores of a cohort processed in several batches end up in a single table
+        The remaining parameters are the same as in process().
+        :return: ProcessingStats with the timing and resource usage of each processing stage
+        """
+        job = self.createBatchProcessingJob(inputNodes, outputNodes,
+                                            parc=parc, robust=robust, fast=fast,
+                                            resampleNodes=resampleNodes, qc=qc,
+                                            threads=threads, cpu=cpu, v1=v1, ct=ct)
+        job.run()
+        return job.stats
+
+    def createBatchProcessingJob(self, inputNodes, outputNodes,
+                                 parc=False, robust=False, fast=False,
+                                 resampleNodes=None, qc=None,
+                                 threads=None, cpu=False, v1=False, ct=False,
+                                 onOutput=None, onFinished=None, onProgress=None):
+        """
+        Prepare the batch processing without running it, e.g., to run it with a JobScheduler.
+        The volumes without cached results are exported immediately and the returned job runs
+        mri_synthseg once for all of them and loads the results into the output nodes.
+        :param onOutput: called with each line of the mri_synthseg output
+        :param onFinished: called with the job when it succeeded, failed or was cancelled
+        :param onProgress: called with a ProgressEvent when a processing stage starts
+        See processBatch() for the description of the other parameters.
+        """
+
+        inputNodes = list(inputNodes)
+        outputNodes = list(outputNodes)
+        if not inputNodes:
+            raise ValueError("Input volumes are undefined")
+        if len(outputNodes) != len(inputNodes):
+            raise ValueError("Number of output segmentations must match number of input volumes")
+        if resampleNodes is None:
+            resampleNodes = [None] * len(inputNodes)
+        resampleNodes = list(resampleNodes)
+        if len(resampleNodes) != len(inputNodes):
+            raise ValueError("Number of resampled volumes must match number of input volumes")
+        if not all(inputNodes):
+            raise ValueError("Input volume is undefined")
+        if not all(outputNodes):
+            raise ValueError("Output segmentation is undefined")
+
+        logging.info(f'Batch processing of {len(inputNodes)} volumes started')
+
+        from FreeSurferCommonLib import (CommandJob, ProcessingStats, ResultCache, StagingArea, exportVolumeNode,
+                                         threadEnvironment)
+
+        stats = ProcessingStats('FreeSurferSynthSeg batch')
+        stats.info['numberOfVolumes'] = len(inputNodes)
+        stats.info['freeSurferVersion'] = self.freeSurferVersion()
+
+        staging = StagingArea(SYNTHSEG_FORMATS)
+        temp_path = staging.path
+        extension = staging.extension
+
+        # mri_synthseg processes every image in the input folder and writes
+        # the results to the output folders using the input file names
+        input_dir = temp_path / 'input'
+        output_dir = temp_path / 'output'
+        resample_dir = temp_path / 'resample'
+        qc_dir = temp_path / 'qc'
+        for folder in (input_dir, output_dir, resample_dir, qc_dir):
+            folder.mkdir()
+
+        # Use generated file names: node names are neither unique nor safe to use as file names
+        names = [f'subject{index:04d}' for index in range(len(inputNodes))]
+        outputPaths = [str(output_dir / f'{name}_synthseg{extension}') for name in names]
+        resamplePaths = [str(resample_dir / f'{name}_resampled{extension}') for name in names]
+        # The scores of all volumes are written to a single file, split per volume for caching
+        qcPaths = [str(qc_dir / f'{name}.csv') for name in names]
+
+        # Only segment the volumes that have no cached results
+        cache = ResultCache.fromSettings()
+        outputName = staging.fileName('output')
+        resampleName = staging.fileName('resample')
+        version = stats.info['freeSurferVersion']
+        cacheKeys = []
+        runIndices = []
+        for index, (inputNode, resampleNode) in enumerate(zip(inputNodes, resampleNodes)):
+            cacheFiles = [outputName]
+            if resampleNode:
+                cacheFiles.append(resampleName)
+            if qc:
+                cacheFiles.append(QC_FILE_NAME)
+            with stats.stage('cache lookup'):
+                cacheKey = cache.key(inputNode, self.cacheArgs(
+                    staging, parc=parc, robust=robust, fast=fast, resample=resampleNode, qc=qc,
+                    cpu=cpu, v1=v1, ct=ct), version)
+                cacheKeys.append(cacheKey)
+                cached = cache.lookup(cacheKey, cacheFiles)
+            if cached:
+                outputPaths[index] = cached[outputName]
+                resamplePaths[index] = cached.get(resampleName)
+                qcPaths[index] = cached.get(QC_FILE_NAME)
+            else:
+                with stats.stage('export') as stage:
+                    inputPath = str(input_dir / f'{names[index]}{extension}')
+                    exportVolumeNode(inputNode, inputPath)
+                    stage.wrote(inputPath)
+                runIndices.append(index)
+
+        args = None
+        if runIndices:
+            args = self.synthSegArgs(str(input_dir), str(output_dir),
+                                     parc=parc, robust=robust, fast=fast,
+                                     resample=str(resample_dir) if any(resampleNodes) else None,
+                                     qc=str(temp_path / QC_FILE_NAME) if qc else None,
+                                     threads=threads, cpu=cpu, v1=v1, ct=ct)
+
+        def onCompleted():
+            if qc and runIndices:
+                self.splitQC(str(temp_path / QC_FILE_NAME), {names[index]: qcPaths[index] for index in runIndices})
+
+            with stats.stage('cache store'):
+                for index in runIndices:
+                    files = {outputName: outputPaths[index]}
+                    if resampleNodes[index]:
+                        files[resampleName] = resamplePaths[index]
+                    if qc:
+                        files[QC_FILE_NAME] = qcPaths[index]
+                    cache.store(cacheKeys[index], files)
+
+            # Load temporary files back into nodes
+            with stats.stage('import') as stage:
+                colorTableNode = self.loadColorTable()
+                for outputPath, outputNode, resamplePath, resampleNode in zip(outputPaths, outputNodes, resamplePaths, resampleNodes):
+                    self.loadOutput(outputPath, outputNode, colorTableNode,
+                                    resamplePath=resamplePath, resampleNode=resampleNode)
+                    stage.read(outputPath, resamplePath if resampleNode else None)
+                if qc:
+                    for qcPath, inputNode in zip(qcPaths, inputNodes):
+                        self.loadQC(qcPath, qc, [inputNode.GetName()], append=True)
+                        stage.read(qcPath)
+
+        job = CommandJob(args, onCompleted=onCompleted, onOutput=onOutput, onFinished=onFinished, stats=stats,
+                         onProgress=onProgress, environment=threadEnvironment(threads))
+        job.resources.append(staging)
+        return job
+
+    def synthSegArgs(self, inputPath, outputPath,
+                     parc=False, robust=False, fast=False,
+                     vol=None, qc=None, post=None, resample=None, crop=None,
+                     threads=None, cpu=False, v1=False, ct=False):
+        """
+        Build the mri_synthseg command line.
+        :param inputPath: input image file or folder of images
+        :param outputPath: output segmentation file or folder
+        :param resample: optional resampled image file or folder
+        :param vol: optional CSV file for the volumes of the segmented structures
+        :param qc: optional CSV file for the quality control scores
+        :param post: optional image file for the posterior probabilities
+        :param crop: optional size (in mm) of the analysed image patch, one value or three values
+        """
+
+        from FreeSurferCommonLib import FreeSurferToolchain
+
+        toolchain = FreeSurferToolchain.resolve()
+        toolchain.checkFlags('mri_synthseg', [flag for flag, enabled in (('--v1', v1), ('--ct', ct)) if enabled])
+
+        args = [toolchain.binary('mri_synthseg')]
+        args.extend(['--i', inputPath])
+        args.extend(['--o', outputPath])
         if parc:
             args.extend(['--parc'])
         if robust:
@@ -372,15 +838,16 @@ class FreeSurferSynthSegLogic(ScriptedLoadableModuleLogic):
         if fast:
             args.extend(['--fast'])
         if vol:
-            raise NotImplementedError
+            args.extend(['--vol', vol])
         if qc:
-            raise NotImplementedError
+            args.extend(['--qc', qc])
         if post:
-            raise NotImplementedError
+            args.extend(['--post', post])
         if resample:
-            args.extend(['--resample', temp_resample])
+            args.extend(['--resample', resample])
         if crop:
-            raise NotImplementedError
+            args.append('--crop')
+            args.extend(str(int(size)) for size in (crop if isinstance(crop, (list, tuple)) else [crop]))
         if cpu:
             args.extend(['--cpu'])
             if threads:
@@ -389,45 +856,239 @@ class FreeSurferSynthSegLogic(ScriptedLoadableModuleLogic):
             args.extend(['--v1'])
         if ct:
             args.extend(['--ct'])
+        return args
+
+    def cacheArgs(self, staging, resample=None, vol=None, qc=None, **kwargs):
+        """
+        Build the mri_synthseg command line used as result cache key.
+        File and command names without folder are used so that the key depends on neither the temporary
+        folder nor the FreeSurfer installation folder. The number of threads does not change the results,
+        it is not part of the key.
+        """
+        args = self.synthSegArgs(staging.fileName('input'), staging.fileName('output'),
+                                 resample=staging.fileName('resample') if resample else None,
+                                 vol=VOLUMES_FILE_NAME if vol else None,
+                                 qc=QC_FILE_NAME if qc else None, **kwargs)
+        return [os.path.basename(args[0])] + args[1:]
 
-        print("Command:", args)
-        proc = slicer.util.launchConsoleProcess(args)
-        slicer.util.logProcessOutput(proc)
+    def checkPosteriorsPath(self, post):
+        """
+        Check that posteriors are written in a format that can be memory-mapped.
+        """
+        if post and not str(post).endswith(POSTERIORS_FORMAT):
+            raise ValueError(f"Posteriors must be saved as uncompressed NIfTI ({POSTERIORS_FORMAT}) file: {post}")
+
+    def cropRegion(self, inputNode, crop):
+        """
+        Resolve the crop parameter of process().
+        A crop size is passed to mri_synthseg unchanged. For a region node (Markups ROI, labelmap
+        volume or segmentation), only the bounding box of the region (plus CROP_MARGIN) is exported
+        from the input, so that the exported image is centered on the region, and the patch analysed
+        by mri_synthseg is set to the size of this box.
+        :return: voxel extent of the input to export (None for the whole volume) and crop size for mri_synthseg
+        """
+        import numpy as np
+
+        if crop is None or isinstance(crop, (int, float, list, tuple)):
+            return None, crop
+
+        if crop.IsA('vtkMRMLLabelMapVolumeNode'):
+            voxels = slicer.util.arrayFromVolume(crop)
+            if not voxels.any():
+                raise ValueError(f"Crop region {crop.GetName()} is empty")
+            # Bounding box of the non-zero voxels, in IJK coordinates of the mask
+            ranges = [np.flatnonzero(voxels.any(axis=axes)) for axes in ((0, 1), (0, 2), (1, 2))]
+            box = np.array([[r[0] - 0.5, r[-1] + 0.5] for r in ranges])
+            ijkToRAS = vtk.vtkMatrix4x4()
+            crop.GetIJKToRASMatrix(ijkToRAS)
+            ijkToRAS = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+        else:
+            bounds = np.zeros(6)
+            crop.GetRASBounds(bounds)
+            if bounds[0] > bounds[1]:
+                raise ValueError(f"Crop region {crop.GetName()} is empty")
+            box = bounds.reshape(3, 2)
+            ijkToRAS = np.eye(4)
+        corners = np.array([[box[0][a], box[1][b], box[2][c], 1.0] for a in (0, 1) for b in (0, 1) for c in (0, 1)])
+
+        # Bounding box in IJK coordinates of the input, with margin
+        rasToIJK = vtk.vtkMatrix4x4()
+        inputNode.GetRASToIJKMatrix(rasToIJK)
+        ijk = (slicer.util.arrayFromVTKMatrix(rasToIJK) @ ijkToRAS @ corners.T)[:3].T
+        spacing = np.array(inputNode.GetSpacing())
+        dimensions = np.array(inputNode.GetImageData().GetDimensions())
+        lower = np.floor(ijk.min(axis=0) - CROP_MARGIN / spacing)
+        upper = np.ceil(ijk.max(axis=0) + CROP_MARGIN / spacing)
+        if np.any(upper < 0) or np.any(lower > dimensions - 1):
+            raise ValueError(f"Crop region {crop.GetName()} is outside of the input volume")
+        lower = np.clip(lower, 0, dimensions - 1).astype(int)
+        upper = np.clip(upper, 0, dimensions - 1).astype(int)
+
+        extent = (int(lower[0]), int(upper[0]), int(lower[1]), int(upper[1]), int(lower[2]), int(upper[2]))
+        # One size for all axes, as mri_synthseg crops after reorienting the image
+        size = int(np.ceil(((upper - lower + 1) * spacing).max()))
+        return extent, size
+
+    def freeSurferVersion(self):
+        """
+        Return version of the FreeSurfer installation in FREESURFER_HOME.
+        """
+        from FreeSurferCommonLib import FreeSurferToolchain
+        return FreeSurferToolchain.resolve().version
 
-        # Load the FreeSurfer color table
-        # See: https://surfer.nmr.mgh.harvard.edu/fswiki/FsTutorial/AnatomicalROI/FreeSurferColorLUT
+    def loadColorTable(self):
+        """
+        Get the FreeSurfer color table node.
+        The color table file is parsed and added to the scene only once, later calls reuse the same node.
+        See: https://surfer.nmr.mgh.harvard.edu/fswiki/FsTutorial/AnatomicalROI/FreeSurferColorLUT
+        """
+        from FreeSurferCommonLib import getColorTableNode
         color_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'FreeSurferColorLUT.ctbl')
-        colorTableNode = slicer.util.loadColorTable(color_file)
-
-        # Load temporary files back into nodes
-        if outputNode:
-            if outputNode.GetTypeDisplayName() == 'LabelMapVolume':
-                storage = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLVolumeArchetypeStorageNode')
-                storage.SetFileName(temp_output)
-                storage.ReadData(outputNode)
-                slicer.mrmlScene.RemoveNode(storage)
-                if outputNode.GetDisplayNode() is None:
-                    outputNode.CreateDefaultDisplayNodes()
-                outputNode.GetDisplayNode().SetAndObserveColorNodeID(colorTableNode.GetID())
-            elif outputNode.GetTypeDisplayName() == 'Segmentation':
-                labelmap = slicer.util.loadLabelVolume(temp_output, properties={'colorNodeID': colorTableNode.GetID()})
-                slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmap, outputNode)
-                slicer.mrmlScene.RemoveNode(labelmap)
-            else:
-                raise NotImplementedError
-        if resample:
-            storage = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLVolumeArchetypeStorageNode')
-            storage.SetFileName(temp_resample)
-            storage.ReadData(resample)
-            slicer.mrmlScene.RemoveNode(storage)
+        return getColorTableNode(color_file)
+
+    def loadOutput(self, outputPath, outputNode, colorTableNode, resamplePath=None, resampleNode=None):
+        """
+        Load mri_synthseg output files into nodes.
+        :param outputPath: segmentation file written by mri_synthseg
+        :param outputNode: labelmap volume or segmentation node to load the segmentation into
+        :param colorTableNode: color table used for the segmentation labels
+        :param resamplePath: resampled image file written by mri_synthseg
+        :param resampleNode: optional scalar volume to load the resampled image into
+        """
+        from FreeSurferCommonLib import importSegmentationNode, importVolumeNode
+
+        if outputNode.GetTypeDisplayName() == 'LabelMapVolume':
+            importVolumeNode(outputPath, outputNode)
+            if outputNode.GetDisplayNode() is None:
+                outputNode.CreateDefaultDisplayNodes()
+            outputNode.GetDisplayNode().SetAndObserveColorNodeID(colorTableNode.GetID())
+        elif outputNode.GetTypeDisplayName() == 'Segmentation':
+            # Build segments directly from the labels present in the output
+            importSegmentationNode(outputPath, outputNode, colorTableNode)
+        else:
+            raise NotImplementedError
+        if resampleNode:
+            importVolumeNode(resamplePath, resampleNode)
             # The resampled image has the same resolution as the segmentation
             # so we associate it with the segmentation; otherwise, let the user
             # set it manually.
             if outputNode.GetTypeDisplayName() == 'Segmentation':
-                outputNode.SetReferenceImageGeometryParameterFromVolumeNode(resample)
+                outputNode.SetReferenceImageGeometryParameterFromVolumeNode(resampleNode)
+
+    def loadPosteriors(self, postPath, parc=False):
+        """
+        Open the posterior probabilities written by mri_synthseg --post without loading them.
+        The channels are labelled with the fixed SynthSeg label list, so that they can be selected
+        by structure name or label value, including structures absent from the segmentation.
+        :param postPath: posteriors file, see process()
+        :param parc: mri_synthseg was run with --parc
+        :return: SynthSegPosteriors; e.g., posteriors.loadChannels(['Left-Hippocampus', 'Right-Hippocampus'])
+        """
+        from FreeSurferSynthSegLib.Posteriors import SynthSegPosteriors, synthSegPosteriorsLabels
+        return SynthSegPosteriors(postPath, synthSegPosteriorsLabels(parc), self.loadColorTable())
+
+    def loadVolumes(self, volumesPath, tableNode):
+        """
+        Load the structure volumes written by mri_synthseg --vol into a table.
+        The CSV file has one column per structure and one row per input image;
+        the table has one row per structure.
+        :param volumesPath: CSV file written by mri_synthseg
+        :param tableNode: table node to load the volumes into
+        """
+        from FreeSurferCommonLib import updateTableFromColumns
+
+        names, subjects, values = self.readCSV(volumesPath)
+        updateTableFromColumns(tableNode, [("Structure", names), ("Volume [mm3]", values[0])])
 
-        stopTime = time.time()
-        logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
+    def loadQC(self, qcPath, tableNode, subjectNames=None, append=False):
+        """
+        Load the quality control scores written by mri_synthseg --qc into a table.
+        The table has one row per input image, with one column per structure group and
+        the minimum score, so that likely failures can be found by sorting the table.
+        :param qcPath: CSV file written by mri_synthseg
+        :param tableNode: table node to load the scores into
+        :param subjectNames: names of the input images, in the order of the file, defaults to the file names
+        :param append: append the rows to the table instead of replacing its content
+        """
+        from FreeSurferCommonLib import appendTableRows, updateTableFromColumns
+
+        names, subjects, scores = self.readCSV(qcPath)
+        if subjectNames is not None:
+            subjects = list(subjectNames)
+        columns = [("Subject", subjects)]
+        columns.extend((name, scores[:, index]) for index, name in enumerate(names))
+        columns.append(("Minimum score", scores.min(axis=1)))
+        if append:
+            appendTableRows(tableNode, columns)
+        else:
+            updateTableFromColumns(tableNode, columns)
+
+    def splitQC(self, qcPath, subjectPaths):
+        """
+        Split the quality control scores of a batch into one file per input image.
+        :param qcPath: CSV file written by mri_synthseg for a folder of images
+        :param subjectPaths: dict mapping input file names (without extension) to the CSV file to write
+        """
+        import csv
+        with open(qcPath, newline='') as f:
+            rows = list(csv.reader(f))
+        for row in rows[1:]:
+            # The first column is the input file path
+            name = os.path.basename(row[0]).split('.')[0]
+            if name in subjectPaths:
+                with open(subjectPaths[name], 'w', newline='') as f:
+                    csv.writer(f).writerows([rows[0], row])
+        missing = [name for name, path in subjectPaths.items() if not os.path.exists(path)]
+        if missing:
+            raise ValueError(f"No quality control scores found for {', '.join(missing)} in {qcPath}")
+
+    def readCSV(self, path):
+        """
+        Read a CSV file written by mri_synthseg (--vol or --qc).
+        The file has a header row and one row per input image, whose first column is the input file.
+        :return: structure names, input files and array of values (one row per input file)
+        """
+        import csv
+        import numpy as np
+
+        with open(path, newline='') as f:
+            rows = [row for row in csv.reader(f) if row]
+        if len(rows) < 2:
+            raise ValueError(f"No results found in {path}")
+        names = [name.strip() for name in rows[0][1:]]
+        subjects = [row[0] for row in rows[1:]]
+        values = np.array([row[1:] for row in rows[1:]], dtype=float)
+        return names, subjects, values
+
+    def computeVolumes(self, outputNode, tableNode, colorTableNode=None):
+        """
+        Compute the volume of each structure of a segmentation without running mri_synthseg --vol.
+        Voxels of each label are counted in a single pass over the label array. This is only done
+        on demand: process() loads the volumes computed by mri_synthseg when a volumes table is set.
+        :param outputNode: labelmap volume or segmentation node, as loaded by loadOutput()
+        :param tableNode: table node to write the label, structure name, number of voxels and volume of each structure into
+        :param colorTableNode: color table used for the structure names of a labelmap volume,
+          defaults to the FreeSurfer color table
+        """
+        import numpy as np
+        from FreeSurferCommonLib import labelVolumes, segmentationVolumes, updateTableFromColumns
+
+        if outputNode.GetTypeDisplayName() == 'LabelMapVolume':
+            if colorTableNode is None:
+                colorTableNode = self.loadColorTable()
+            voxelVolume = float(np.prod(outputNode.GetSpacing()))
+            labels, counts, volumes = labelVolumes(slicer.util.arrayFromVolume(outputNode), voxelVolume)
+            names = [colorTableNode.GetColorName(int(label)) for label in labels]
+        elif outputNode.GetTypeDisplayName() == 'Segmentation':
+            segmentIds, counts, volumes = segmentationVolumes(outputNode)
+            segmentation = outputNode.GetSegmentation()
+            segments = [segmentation.GetSegment(segmentId) for segmentId in segmentIds]
+            labels = np.array([segment.GetLabelValue() for segment in segments], dtype=np.int64)
+            names = [segment.GetName() for segment in segments]
+        else:
+            raise NotImplementedError
+        updateTableFromColumns(tableNode, [
+            ("Label", labels), ("Structure", names), ("Voxels", counts), ("Volume [mm3]", volumes)])
 
 
 #
@@ -451,6 +1112,24 @@ class FreeSurferSynthSegTest(ScriptedLoadableModuleTest):
         """
         self.setUp()
         self.test_FreeSurferSynthSeg1()
+        self.setUp()
+        self.test_FreeSurferSynthSegScheduledThreads()
+        self.setUp()
+        self.test_FreeSurferSynthSegPosteriors()
+        self.setUp()
+        self.test_FreeSurferSynthSegComputeVolumes()
+
+    def labelVolume(self):
+        """
+        Add a small label volume, which a fake mri_synthseg can return as its own segmentation.
+        """
+        import numpy as np
+        voxels = np.zeros((20, 24, 28), dtype=np.int16)
+        voxels[5:15, 6:12, 7:14] = 17  # Left-Hippocampus
+        voxels[5:15, 12:18, 14:21] = 53  # Right-Hippocampus
+        inputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Input')
+        slicer.util.updateVolumeFromArray(inputNode, voxels)
+        return inputNode
 
     def test_FreeSurferSynthSeg1(self):
         """ Ideally you should have several levels of tests.  At the lowest level
@@ -466,7 +1145,219 @@ class FreeSurferSynthSegTest(ScriptedLoadableModuleTest):
 
         self.delayDisplay("Starting the test")
 
-        # TODO: add tests...
-        self.delayDisplay("This test does nothing!")
+        from FreeSurferCommonLib import fakeFreeSurferInstallation
+
+        logic = FreeSurferSynthSegLogic()
+
+        # Fake mri_synthseg: returns the label volume as its segmentation, with fixed volumes and QC scores
+        fakeSynthSeg = (
+            '#!/bin/sh\n'
+            'if [ "$1" = "--help" ]; then\n'
+            '  echo "usage: mri_synthseg --i I --o O --parc --robust --fast --vol VOL --qc QC --post POST"\n'
+            '  echo "  --resample RESAMPLE --crop CROP --threads THREADS --cpu --v1 --ct"\n'
+            '  exit 0\n'
+            'fi\n'
+            'while [ $# -gt 0 ]; do\n'
+            '  case "$1" in\n'
+            '    --i) input="$2"; shift;;\n'
+            '    --o) output="$2"; shift;;\n'
+            '    --vol) vol="$2"; shift;;\n'
+            '    --qc) qc="$2"; shift;;\n'
+            '  esac\n'
+            '  shift\n'
+            'done\n'
+            'echo "using CPU"\n'
+            'echo "predicting 1/1"\n'
+            'cp "$input" "$output"\n'
+            'if [ -n "$vol" ]; then\n'
+            '  printf "subject,total intracranial,left hippocampus,right hippocampus\\n%s,1500.5,420.0,420.0\\n" "$input" > "$vol"\n'
+            'fi\n'
+            'if [ -n "$qc" ]; then\n'
+            '  printf "subject,general white matter,hippocampus\\n%s,0.95,0.61\\n" "$input" > "$qc"\n'
+            'fi\n'
+            'echo "segmentation saved in: $output"\n')
+
+        with fakeFreeSurferInstallation({'mri_synthseg': fakeSynthSeg}):
+
+            # Test the command line
+            args = logic.synthSegArgs('in.nii', 'out.nii')
+            self.assertEqual(os.path.basename(args[0]), 'mri_synthseg')
+            self.assertEqual(args[1:], ['--i', 'in.nii', '--o', 'out.nii'])
+            args = logic.synthSegArgs('in.nii', 'out.nii', parc=True, robust=True, crop=160,
+                                      threads=4, cpu=True, v1=True)
+            self.assertEqual(args[1:], ['--i', 'in.nii', '--o', 'out.nii', '--parc', '--robust',
+                                        '--crop', '160', '--cpu', '--threads', '4', '--v1'])
+            # Threads of GPU runs are limited by the environment, see test_FreeSurferSynthSegScheduledThreads
+            args = logic.synthSegArgs('in.nii', 'out.nii', vol='vol.csv', crop=[160, 176, 192.0], threads=4)
+            self.assertEqual(args[1:], ['--i', 'in.nii', '--o', 'out.nii', '--vol', 'vol.csv',
+                                        '--crop', '160', '176', '192'])
+
+            # Test the module logic
+            inputNode = self.labelVolume()
+            labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+            stats = logic.process(inputNode, labelmapNode)
+            self.assertEqual(stats.status, 'Succeeded')
+            self.assertEqual(sorted(set(slicer.util.arrayFromVolume(labelmapNode).ravel())), [0, 17, 53])
+            self.assertEqual(labelmapNode.GetDisplayNode().GetColorNodeID(), logic.loadColorTable().GetID())
+
+            segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+            volumesNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
+            qcNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
+            logic.process(inputNode, segmentationNode, vol=volumesNode, qc=qcNode)
+            segmentation = segmentationNode.GetSegmentation()
+            self.assertEqual(sorted(segmentation.GetSegment(segmentId).GetName()
+                                    for segmentId in segmentation.GetSegmentIDs()),
+                             ['Left-Hippocampus', 'Right-Hippocampus'])
+            self.assertEqual(volumesNode.GetNumberOfRows(), 3)
+            self.assertEqual(volumesNode.GetCellText(1, 0), 'left hippocampus')
+            self.assertEqual(float(volumesNode.GetCellText(0, 1)), 1500.5)
+            self.assertEqual(qcNode.GetNumberOfRows(), 1)
+            self.assertEqual(qcNode.GetCellText(0, 0), inputNode.GetName())
+            self.assertAlmostEqual(float(qcNode.GetCellText(0, qcNode.GetNumberOfColumns() - 1)), 0.61)
+
+            with self.assertRaises(ValueError):
+                logic.process(inputNode, None)
+
+        if not os.environ.get('FREESURFER_HOME'):
+            self.delayDisplay('FREESURFER_HOME is not set, mri_synthseg is not run')
+            return
+
+        # Get/create input data
+
+        import SampleData
+        inputVolume = SampleData.downloadSample('MRHead')
+        self.delayDisplay('Loaded test data set')
+
+        outputLabelmap = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+
+        # Test the module logic
+
+        logic.process(inputVolume, outputLabelmap, cpu=True)
+        labels = set(slicer.util.arrayFromVolume(outputLabelmap).ravel())
+        # Both hippocampi are found in the head
+        self.assertIn(17, labels)
+        self.assertIn(53, labels)
+
+        self.delayDisplay('Test passed')
+
+    def test_FreeSurferSynthSegScheduledThreads(self):
+        """
+        Scheduled SynthSeg jobs are limited to their share of the thread budget, also when not run on the CPU.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        from FreeSurferCommonLib import JobScheduler, fakeFreeSurferInstallation
+
+        # Fake mri_synthseg: records its thread limit and returns the label volume as its segmentation
+        fakeSynthSeg = (
+            '#!/bin/sh\n'
+            'while [ $# -gt 0 ]; do\n'
+            '  case "$1" in\n'
+            '    --i) input="$2"; shift;;\n'
+            '    --o) output="$2"; shift;;\n'
+            '  esac\n'
+            '  shift\n'
+            'done\n'
+            'echo "$OMP_NUM_THREADS" >> "$(dirname "$0")/../threads.txt"\n'
+            'cp "$input" "$output"\n')
+
+        with fakeFreeSurferInstallation({'mri_synthseg': fakeSynthSeg}) as freeSurferHome:
+            inputNode = self.labelVolume()
+            scheduler = JobScheduler(maxConcurrentJobs=2, threadBudget=8)
+            outputNodes = [slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode') for _ in range(2)]
+            for outputNode in outputNodes:
+                scheduler.addJob('FreeSurferSynthSeg', inputNode, outputNode)
+            jobs = []
+            scheduler.onJobFinished = lambda job, stats: jobs.append(job)
+            stats = scheduler.run()
+
+            self.assertEqual(stats['succeeded'], 2)
+            for job in jobs:
+                self.assertEqual(job.environment['OMP_NUM_THREADS'], '4')
+                self.assertNotIn('--threads', job.commands[0])
+            with open(os.path.join(freeSurferHome, 'threads.txt')) as f:
+                self.assertEqual(f.read().split(), ['4', '4'])
+            for outputNode in outputNodes:
+                self.assertEqual(sorted(set(slicer.util.arrayFromVolume(outputNode).ravel())), [0, 17, 53])
+
+        self.delayDisplay('Test passed')
+
+    def test_FreeSurferSynthSegPosteriors(self):
+        """
+        Posteriors channels are labelled with the SynthSeg label list, whatever the segmentation contains.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        import struct
+        import tempfile
+        import numpy as np
+        from FreeSurferCommonLib import writeNIfTI
+        from FreeSurferSynthSegLib.Posteriors import SYNTHSEG_LABELS, synthSegPosteriorsLabels
+
+        logic = FreeSurferSynthSegLogic()
+        shape = (4, 5, 6)
+        for parc in (False, True):
+            labels = synthSegPosteriorsLabels(parc)
+            self.assertEqual(labels[:len(SYNTHSEG_LABELS)], SYNTHSEG_LABELS)
+            with tempfile.TemporaryDirectory() as tempDir:
+                # Channel c has the probability c / 1000 everywhere
+                postPath = os.path.join(tempDir, 'posteriors.nii')
+                channels = np.arange(len(labels), dtype=np.float32)[:, None, None, None] / 1000 * np.ones(shape, np.float32)
+                writeNIfTI(postPath, channels.reshape((-1,) + shape[1:]), np.eye(4))
+                with open(postPath, 'r+b') as f:
+                    # Frames of the 4D volume are stacked along k: set the dimensions to (i, j, k, channel)
+                    f.seek(40)
+                    f.write(struct.pack('<8h', 4, shape[2], shape[1], shape[0], len(labels), 1, 1, 1))
+
+                posteriors = logic.loadPosteriors(postPath, parc)
+                self.assertEqual(posteriors.labels, labels)
+                # Channels of structures absent from any segmentation are still found by name or label value
+                self.assertEqual(posteriors.channelIndex('Left-Hippocampus'), labels.index(17))
+                self.assertEqual(posteriors.channelIndex(60), labels.index(60))
+                if parc:
+                    self.assertEqual(posteriors.channelIndex(2035), len(labels) - 1)
+                volumeNode = posteriors.loadChannel('Right-Hippocampus')
+                np.testing.assert_allclose(slicer.util.arrayFromVolume(volumeNode), labels.index(53) / 1000)
+                slicer.mrmlScene.RemoveNode(volumeNode)
+                del posteriors
+
+        self.delayDisplay('Test passed')
+
+    def test_FreeSurferSynthSegComputeVolumes(self):
+        """
+        Structure volumes are the number of voxels of each label times the voxel volume.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        import numpy as np
+
+        logic = FreeSurferSynthSegLogic()
+        voxels = slicer.util.arrayFromVolume(self.labelVolume()).copy()
+        voxels[0:2, 0:3, 0:4] = 2  # Left-Cerebral-White-Matter
+        labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Labels')
+        slicer.util.updateVolumeFromArray(labelmapNode, voxels)
+        labelmapNode.SetSpacing(0.5, 1.0, 1.5)
+        voxelVolume = 0.75
+        expectedCounts = [2 * 3 * 4, 10 * 6 * 7, 10 * 6 * 7]
+
+        tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
+        logic.computeVolumes(labelmapNode, tableNode)
+        np.testing.assert_array_equal(slicer.util.arrayFromTableColumn(tableNode, 'Label'), [2, 17, 53])
+        self.assertEqual([tableNode.GetCellText(row, 1) for row in range(tableNode.GetNumberOfRows())],
+                         ['Left-Cerebral-White-Matter', 'Left-Hippocampus', 'Right-Hippocampus'])
+        np.testing.assert_array_equal(slicer.util.arrayFromTableColumn(tableNode, 'Voxels'), expectedCounts)
+        np.testing.assert_allclose(slicer.util.arrayFromTableColumn(tableNode, 'Volume [mm3]'),
+                                   np.array(expectedCounts) * voxelVolume)
+
+        # Segments are counted in their binary labelmap representation
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+        logic.computeVolumes(segmentationNode, tableNode)
+        counts = slicer.util.arrayFromTableColumn(tableNode, 'Voxels')
+        np.testing.assert_array_equal(sorted(counts), expectedCounts)
+        np.testing.assert_allclose(slicer.util.arrayFromTableColumn(tableNode, 'Volume [mm3]'), counts * voxelVolume)
 
         self.delayDisplay('Test passed')
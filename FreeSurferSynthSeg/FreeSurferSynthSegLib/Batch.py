@@ -0,0 +1,347 @@
+"""
+Segment brain MRI volumes on disk with SynthSeg, without user interface.
+
+The inputs are either all images in a folder or the images listed in a CSV
+manifest. Subjects are processed in small groups (one by default) that are
+loaded into the scene, segmented and saved, then removed from the scene, so
+that memory usage does not grow with the number of subjects. The groups are
+jobs of a JobScheduler: several groups can be segmented at the same time,
+sharing a budget of CPU threads.
+
+Every completed subject is recorded in a state file in the output folder.
+Subjects whose output is up to date (same input modification time or hash,
+same parameters) are skipped, so an interrupted run can simply be restarted
+to resume where it stopped. Outputs are written to a temporary file that is
+renamed when complete, so a crash never leaves a partial output behind.
+
+Usage:
+
+    Slicer --no-main-window --python-script FreeSurferSynthSegLib/Batch.py \\
+        --input /path/to/images --output /path/to/segmentations [--robust] [--cpu --jobs 2 --thread-budget 16]
+
+The CSV manifest has an "input" column and an optional "output" column
+(paths relative to the manifest file are allowed):
+
+    input,output
+    sub-01/anat/T1w.nii.gz,sub-01_synthseg.nii.gz
+"""
+
+import csv
+import hashlib
+import json
+import logging
+import os
+
+# Image file extensions read from input folders
+INPUT_EXTENSIONS = ('.nii', '.nii.gz', '.mgz', '.mgh', '.nrrd', '.nhdr', '.mha', '.mhd')
+
+# File in the output folder recording the completed subjects
+STATE_FILE_NAME = 'synthseg_batch.jsonl'
+
+
+def splitExtension(path):
+    """
+    Split a file name into name and extension, handling double extensions such as .nii.gz.
+    """
+    name = os.path.basename(path)
+    for extension in INPUT_EXTENSIONS:
+        if name.lower().endswith(extension):
+            return name[:-len(extension)], name[-len(extension):]
+    return os.path.splitext(name)
+
+
+def listSubjects(inputPath, outputDir, outputExtension):
+    """
+    List the (input file, output file) pairs of a folder or CSV manifest.
+    """
+    def outputFile(inputFile):
+        return os.path.join(outputDir, splitExtension(inputFile)[0] + '_synthseg' + outputExtension)
+
+    if os.path.isdir(inputPath):
+        names = sorted(name for name in os.listdir(inputPath) if name.lower().endswith(INPUT_EXTENSIONS))
+        return [(os.path.join(inputPath, name), outputFile(name)) for name in names]
+
+    subjects = []
+    manifestDir = os.path.dirname(os.path.abspath(inputPath))
+    with open(inputPath, newline='') as f:
+        for row in csv.DictReader(f):
+            inputFile = os.path.join(manifestDir, row['input'])
+            output = row.get('output')
+            subjects.append((inputFile, os.path.join(outputDir, output) if output else outputFile(inputFile)))
+    return subjects
+
+
+def fileHash(path, blockSize=1 << 20):
+    """
+    Return the SHA-256 hash of a file, read in blocks to keep memory usage low.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def inputSignature(path, check):
+    """
+    Return the value identifying the content of an input file: modification time and size, or hash.
+    """
+    if check == 'hash':
+        return fileHash(path)
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def readState(path):
+    """
+    Read the records of the completed subjects, the last record of each output wins.
+    A truncated last line (interrupted while writing) is ignored.
+    """
+    state = {}
+    if not os.path.exists(path):
+        return state
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            state[record['output']] = record
+    return state
+
+
+def appendState(path, record):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def isUpToDate(record, inputFile, outputFile, signature, parameters):
+    """
+    Check that the output exists and was computed from the same input with the same parameters.
+    """
+    return (record is not None
+            and os.path.exists(outputFile)
+            and record['input'] == os.path.abspath(inputFile)
+            and record['signature'] == signature
+            and record['parameters'] == parameters)
+
+
+def saveOutput(node, outputFile):
+    """
+    Save a node to a temporary file next to the output and rename it when complete.
+    """
+    import slicer
+    outputDir, name = os.path.split(outputFile)
+    tempFile = os.path.join(outputDir, '.partial-' + name)
+    if not slicer.util.saveNode(node, tempFile):
+        raise OSError(f"Failed to save {outputFile}")
+    os.replace(tempFile, outputFile)
+
+
+class SubjectGroupLogic:
+    """Load, segment and save groups of subjects, as jobs of a JobScheduler.
+
+    The subjects of a group are loaded into the scene when its job starts and
+    removed when it finishes, so that memory usage depends on the number of
+    concurrent jobs, not on the number of subjects.
+
+    :param logic: FreeSurferSynthSegLogic
+    :param parameters: SynthSeg parameters, see FreeSurferSynthSegLogic.processBatch()
+    :param qc: compute the quality control scores
+    :param onGroupProcessed: called with the group, the processing statistics and the quality control
+      scores of each subject (dict, or None if qc is False) when the outputs of a group are saved
+    """
+
+    def __init__(self, logic, parameters, qc=False, onGroupProcessed=None):
+        self.logic = logic
+        self.parameters = parameters
+        self.qc = qc
+        self.onGroupProcessed = onGroupProcessed
+
+    def createProcessingJob(self, group, threads=None, onFinished=None):
+        """
+        Load a group of (input file, output file, input signature) subjects and prepare its segmentation.
+        :param threads: number of CPU threads of the job, set by the JobScheduler
+        :param onFinished: called with the job when it succeeded, failed or was cancelled
+        """
+        import slicer
+        nodes = []
+
+        def removeNodes():
+            for node in nodes:
+                slicer.mrmlScene.RemoveNode(node)
+
+        try:
+            inputNodes = []
+            outputNodes = []
+            for inputFile, outputFile, _ in group:
+                inputNode = slicer.util.loadVolume(inputFile)
+                outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+                nodes.extend([inputNode, outputNode])
+                inputNodes.append(inputNode)
+                outputNodes.append(outputNode)
+            qcTableNode = None
+            if self.qc:
+                qcTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
+                nodes.append(qcTableNode)
+
+            def jobFinished(job):
+                removeNodes()
+                if job.status != job.Succeeded:
+                    logging.error(f"Failed to segment {', '.join(inputFile for inputFile, _, _ in group)}: {job.error}")
+                if onFinished:
+                    onFinished(job)
+
+            job = self.logic.createBatchProcessingJob(inputNodes, outputNodes, qc=qcTableNode, threads=threads,
+                                                      onFinished=jobFinished, **self.parameters)
+        except Exception:
+            removeNodes()
+            raise
+
+        # Outputs are saved when they are loaded, a failure to save them fails the job
+        loadOutputs = job.onCompleted
+
+        def onCompleted():
+            loadOutputs()
+            for (_, outputFile, _), outputNode in zip(group, outputNodes):
+                saveOutput(outputNode, outputFile)
+            if self.onGroupProcessed:
+                self.onGroupProcessed(group, job.stats, tableRows(qcTableNode) if self.qc else [None] * len(group))
+
+        job.onCompleted = onCompleted
+        return job
+
+
+def tableRows(tableNode):
+    """
+    Return the rows of a table node as dicts, without the first (subject) column.
+    """
+    table = tableNode.GetTable()
+    names = [table.GetColumnName(column) for column in range(table.GetNumberOfColumns())]
+    return [{name: table.GetValue(row, column).ToDouble() for column, name in enumerate(names) if column > 0}
+            for row in range(table.GetNumberOfRows())]
+
+
+def writeQCReport(path, subjects, state):
+    """
+    Write the quality control scores of all processed subjects into a single CSV file, one row per subject.
+    The report is written to a temporary file that is renamed when complete.
+    """
+    records = [state[os.path.abspath(outputFile)] for _, outputFile in subjects
+               if state.get(os.path.abspath(outputFile), {}).get('qc')]
+    if not records:
+        return
+    names = list(records[0]['qc'])
+    tempPath = path + '.partial'
+    with open(tempPath, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['subject'] + names)
+        for record in records:
+            writer.writerow([record['input']] + [record['qc'].get(name, '') for name in names])
+    os.replace(tempPath, path)
+
+
+def main(args):
+    import time
+    from FreeSurferCommonLib import JobScheduler
+    from FreeSurferSynthSeg import FreeSurferSynthSegLogic
+
+    os.makedirs(args.output, exist_ok=True)
+    statePath = os.path.join(args.output, STATE_FILE_NAME)
+    # The threads of each job are set by the scheduler and do not change the results
+    parameters = dict(parc=args.parc, robust=args.robust, fast=args.fast,
+                      cpu=args.cpu, v1=args.v1, ct=args.ct)
+    # Outputs computed without quality control scores are not up to date if they are requested
+    recordParameters = dict(parameters, qc=bool(args.qc))
+    state = readState(statePath)
+
+    # Find the subjects to process
+    pending = []
+    failed = 0
+    subjects = listSubjects(args.input, args.output, args.output_format)
+    for inputFile, outputFile in subjects:
+        if not os.path.exists(inputFile):
+            logging.error(f"Input file not found: {inputFile}")
+            failed += 1
+            continue
+        signature = inputSignature(inputFile, args.check)
+        if isUpToDate(state.get(os.path.abspath(outputFile)), inputFile, outputFile, signature, recordParameters):
+            logging.info(f"Skipping {inputFile}: output is up to date")
+            continue
+        pending.append((inputFile, outputFile, signature))
+    logging.info(f"{len(pending)} of {len(subjects)} subjects to process")
+
+    processed = 0
+
+    def recordGroup(group, stats, qcScores):
+        nonlocal processed
+        for (inputFile, outputFile, signature), scores in zip(group, qcScores):
+            record = {
+                'input': os.path.abspath(inputFile),
+                'output': os.path.abspath(outputFile),
+                'signature': signature,
+                'parameters': recordParameters,
+                'time': time.time(),
+                'processingTime': stats.totalTime / len(group),
+                'qc': scores,
+            }
+            appendState(statePath, record)
+            state[record['output']] = record
+        if args.qc:
+            writeQCReport(args.qc, subjects, state)
+        processed += len(group)
+        logging.info(f"Processed {processed} of {len(pending)} subjects")
+
+    scheduler = JobScheduler(maxConcurrentJobs=args.jobs, threadBudget=args.thread_budget)
+    groupLogic = SubjectGroupLogic(FreeSurferSynthSegLogic(), parameters, qc=bool(args.qc),
+                                   onGroupProcessed=recordGroup)
+    for start in range(0, len(pending), args.batch_size):
+        scheduler.addJob(groupLogic, pending[start:start + args.batch_size])
+    scheduler.run()
+    failed += len(pending) - processed
+
+    if args.qc:
+        # Also when all subjects were up to date
+        writeQCReport(args.qc, subjects, state)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Segment brain MRI volumes on disk with SynthSeg.")
+    parser.add_argument('-i', '--input', required=True,
+                        help='Folder of input images or CSV manifest with "input" and optional "output" columns.')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Output folder.')
+    parser.add_argument('--output-format', default='.nii.gz',
+                        help='Output file extension. Default is .nii.gz.')
+    parser.add_argument('--check', choices=('mtime', 'hash'), default='mtime',
+                        help='How to detect changed inputs: modification time and size (default) or content hash.')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Number of subjects loaded in the scene and segmented by one mri_synthseg run. Default is 1.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of mri_synthseg runs at the same time. Default is 1.')
+    parser.add_argument('--thread-budget', '--threads', type=int,
+                        help='Number of CPU cores shared by the concurrent runs. Default is all CPU cores.')
+    parser.add_argument('--qc',
+                        help='Save the quality control scores of all subjects to this CSV file, one row per subject.')
+
+    # SynthSeg parameters, see https://surfer.nmr.mgh.harvard.edu/fswiki/SynthSeg
+    parser.add_argument('--parc', action='store_true', help='Perform cortical parcellation.')
+    parser.add_argument('--robust', action='store_true', help='Use robust mode.')
+    parser.add_argument('--fast', action='store_true', help='Disable some postprocessing operations.')
+    parser.add_argument('--cpu', action='store_true', help='Enforce running with CPU rather than GPU.')
+    parser.add_argument('--v1', action='store_true', help='Use SynthSeg 1.0.')
+    parser.add_argument('--ct', action='store_true', help='Clip intensities for CT scans.')
+
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    import slicer
+    slicer.util.exit(main(args))
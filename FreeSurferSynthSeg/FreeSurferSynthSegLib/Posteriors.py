@@ -0,0 +1,110 @@
+"""
+Posterior probabilities written by mri_synthseg --post.
+"""
+
+import numpy as np
+
+# Labels segmented by SynthSeg (1.0 and 2.0, robust or not), in the order of the posteriors channels:
+# mri_synthseg writes one channel per label, sorted by label value, whether the structure is present or not
+SYNTHSEG_LABELS = [
+    0, 2, 3, 4, 5, 7, 8, 10, 11, 12, 13, 14, 15, 16, 17, 18, 24, 26, 28,
+    41, 42, 43, 44, 46, 47, 49, 50, 51, 52, 53, 54, 58, 60,
+]
+
+# Cortical parcels of the left (1000 + index) and right (2000 + index) hemispheres (DKT protocol) segmented
+# with --parc; their channels follow the segmentation channels in the posteriors
+SYNTHSEG_PARCELLATION_LABELS = [
+    hemisphere + index
+    for hemisphere in (1000, 2000)
+    for index in (2, 3, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20,
+                  21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 34, 35)
+]
+
+
+def synthSegPosteriorsLabels(parc=False):
+    """
+    Return the label value of each channel of the posteriors written by mri_synthseg --post.
+    :param parc: mri_synthseg was run with --parc
+    """
+    return SYNTHSEG_LABELS + SYNTHSEG_PARCELLATION_LABELS if parc else list(SYNTHSEG_LABELS)
+
+
+class SynthSegPosteriors:
+    """Posterior probability maps of the structures segmented by SynthSeg.
+
+    The posteriors file has one channel (frame) per label of the SynthSeg label
+    list (see synthSegPosteriorsLabels()), and is tens of times larger than the
+    segmentation. It is
+    therefore kept on disk and memory-mapped: only the channels that are loaded
+    into volume nodes are read from the file.
+
+    :param path: uncompressed posteriors file (.nii) written by mri_synthseg
+    :param labels: label value of each channel; channels are numbered if not given
+      or if the number of labels does not match the file
+    :param colorTableNode: color table providing the structure names of the labels
+    """
+
+    def __init__(self, path, labels=None, colorTableNode=None):
+        import logging
+        from FreeSurferCommonLib import mapVolumeFile
+
+        self.path = str(path)
+        self.voxels, self.ijkToRAS = mapVolumeFile(self.path)
+        if labels is not None and len(labels) != self.numberOfChannels:
+            logging.warning(f"Posteriors file {self.path} has {self.numberOfChannels} channels "
+                            f"for {len(labels)} labels, channels are numbered instead")
+            labels = None
+        self.labels = [int(label) for label in labels] if labels is not None else None
+        if self.labels is not None and colorTableNode is not None:
+            self.names = [colorTableNode.GetColorName(label) for label in self.labels]
+        else:
+            self.names = [f'Channel_{index}' for index in range(self.numberOfChannels)]
+
+    @property
+    def numberOfChannels(self):
+        return self.voxels.shape[0]
+
+    def channelIndex(self, structure):
+        """
+        Return the channel of a structure given by label value, structure name or channel name.
+        """
+        if isinstance(structure, str) and structure in self.names:
+            return self.names.index(structure)
+        if isinstance(structure, str) and not structure.isdigit():
+            raise ValueError(f"Structure {structure} not found in posteriors {self.path}")
+        if self.labels is not None and int(structure) in self.labels:
+            return self.labels.index(int(structure))
+        raise ValueError(f"Structure {structure} not found in posteriors {self.path}")
+
+    def channel(self, structure):
+        """
+        Return the posterior probability array of a structure, indexed as [k, j, i].
+        The array is read from the file.
+        """
+        return np.array(self.voxels[self.channelIndex(structure)], dtype=np.float32)
+
+    def loadChannel(self, structure, volumeNode=None):
+        """
+        Load the posterior probability of a structure into a scalar volume node.
+        :param structure: label value or structure name
+        :param volumeNode: volume node to fill, a new node is added to the scene if not given
+        :return: volume node
+        """
+        import slicer
+        index = self.channelIndex(structure)
+        if volumeNode is None:
+            volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', f'{self.names[index]} posterior')
+        volumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(self.ijkToRAS))
+        slicer.util.updateVolumeFromArray(volumeNode, np.array(self.voxels[index], dtype=np.float32))
+        if volumeNode.GetDisplayNode() is None:
+            volumeNode.CreateDefaultDisplayNodes()
+        volumeNode.GetDisplayNode().SetAutoWindowLevel(False)
+        volumeNode.GetDisplayNode().SetWindowLevelMinMax(0.0, 1.0)
+        return volumeNode
+
+    def loadChannels(self, structures):
+        """
+        Load the posterior probabilities of several structures, one scalar volume node per structure.
+        :return: list of volume nodes
+        """
+        return [self.loadChannel(structure) for structure in structures]
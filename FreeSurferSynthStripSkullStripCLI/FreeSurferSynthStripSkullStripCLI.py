@@ -5,8 +5,61 @@ import sys
 
 DEBUG = False
 
-
-def convert_image(ifile, ofile):
+# Image formats read and written by mri_synthstrip: used without conversion
+FREESURFER_EXTENSIONS = ('.nii', '.nii.gz', '.mgz', '.mgh')
+
+# Size of the blocks of voxel data copied when converting images
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Environment variables limiting the CPU threads of PyTorch and of the numerical libraries.
+# This CLI module does not depend on FreeSurferCommon: the FreeSurferCommon test checks that
+# the list matches THREAD_VARIABLES of FreeSurferCommonLib.Toolchain.
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS')
+
+# NRRD file format
+# See: http://teem.sourceforge.net/nrrd/format.html
+NRRD_TYPES = {
+    'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+    'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+    'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+    'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+    'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+    'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+    'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8',
+    'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+    'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+    'float': 'f4',
+    'double': 'f8',
+}
+NRRD_TYPE_NAMES = {
+    'i1': 'int8', 'u1': 'uint8', 'i2': 'int16', 'u2': 'uint16', 'i4': 'int32', 'u4': 'uint32',
+    'i8': 'int64', 'u8': 'uint64', 'f4': 'float', 'f8': 'double',
+}
+NRRD_SPACES = {
+    'left-posterior-superior': (-1, -1, 1), 'lps': (-1, -1, 1),
+    'right-anterior-superior': (1, 1, 1), 'ras': (1, 1, 1),
+}
+
+# NIfTI-1 file format
+# See: https://nifti.nimh.nih.gov/nifti-1
+NIFTI_HEADER_FORMAT = 'i10s18sihcc8h3fhhhh8ffffhccffffii80s24shh6f4f4f4f16s4s'
+NIFTI_HEADER_SIZE = 348
+NIFTI_VOX_OFFSET = 352
+NIFTI_DATATYPES = {
+    'u1': 2, 'i2': 4, 'i4': 8, 'f4': 16, 'f8': 64, 'i1': 256, 'u2': 512, 'u4': 768, 'i8': 1024, 'u8': 1280,
+}
+
+
+class UnsupportedImage(Exception):
+    """Image that cannot be converted by streaming its voxels, converted with SimpleITK instead."""
+
+
+def has_extension(path, extensions):
+    return path.lower().endswith(tuple(extensions))
+
+
+def convert_image_sitk(ifile, ofile):
     import SimpleITK as sitk
 
     reader = sitk.ImageFileReader()
@@ -17,9 +70,213 @@ def convert_image(ifile, ofile):
     writer.Execute(image)
 
 
+def copy_voxels(src, dst, size, swap_bytes=False, itemsize=1):
+    """Copy size bytes of voxel data in chunks, swapping the byte order of each voxel if requested."""
+    import numpy as np
+
+    chunk_size = CHUNK_SIZE - CHUNK_SIZE % itemsize
+    while size > 0:
+        chunk = src.read(min(chunk_size, size))
+        if not chunk:
+            raise UnsupportedImage("Voxel data is truncated")
+        size -= len(chunk)
+        if swap_bytes and itemsize > 1:
+            chunk = np.frombuffer(chunk, dtype=f'u{itemsize}').byteswap().tobytes()
+        dst.write(chunk)
+
+
+def read_nrrd_header(f):
+    """Read the fields of a NRRD header, leaving the file at the start of the voxel data."""
+    magic = f.readline()
+    if not magic.startswith(b'NRRD'):
+        raise UnsupportedImage("Not a NRRD file")
+    fields = {}
+    for line in iter(f.readline, b''):
+        line = line.decode('latin-1').rstrip('\r\n')
+        if not line:
+            break
+        if line.startswith('#') or ':=' in line:
+            continue
+        name, _, value = line.partition(': ')
+        fields[name.strip().lower()] = value.strip()
+    return fields
+
+
+def nrrd_vectors(value):
+    import re
+    return [[float(x) for x in vector.split(',')] for vector in re.findall(r'\(([^)]*)\)', value)]
+
+
+def nrrd_to_nifti(ifile, ofile):
+    """Write the voxels of a 3D NRRD file to an uncompressed NIfTI file, translating the header only."""
+    import gzip
+    import numpy as np
+
+    with open(ifile, 'rb') as f:
+        fields = read_nrrd_header(f)
+        if fields.get('dimension') != '3' or 'data file' in fields or 'datafile' in fields:
+            raise UnsupportedImage("Only 3D NRRD files with attached data are streamed")
+        if int(fields.get('byte skip', fields.get('byteskip', 0))) or int(fields.get('line skip', fields.get('lineskip', 0))):
+            raise UnsupportedImage("Skipped bytes or lines are not supported")
+        encoding = fields.get('encoding', '').lower()
+        if encoding not in ('raw', 'gzip', 'gz'):
+            raise UnsupportedImage(f"NRRD encoding {encoding} is not supported")
+        space = NRRD_SPACES.get(fields.get('space', '').lower())
+        if space is None or fields.get('type', '').lower() not in NRRD_TYPES:
+            raise UnsupportedImage("NRRD space or type is not supported")
+        dtype = np.dtype(NRRD_TYPES[fields['type'].lower()])
+        sizes = [int(size) for size in fields['sizes'].split()]
+        directions = nrrd_vectors(fields.get('space directions', ''))
+        origin = nrrd_vectors(fields.get('space origin', '(0,0,0)'))
+        if len(directions) != 3 or len(origin) != 1:
+            raise UnsupportedImage("NRRD space directions or origin are not supported")
+
+        # Columns of the IJK to RAS matrix: axis directions and origin, in RAS
+        flip = np.array(space, dtype=float)
+        ijk_to_ras = np.eye(4)
+        ijk_to_ras[:3, :3] = (np.array(directions) * flip).T
+        ijk_to_ras[:3, 3] = np.array(origin[0]) * flip
+
+        with open(ofile, 'wb') as out:
+            out.write(nifti_header(sizes, dtype, ijk_to_ras))
+            out.write(b'\0' * (NIFTI_VOX_OFFSET - NIFTI_HEADER_SIZE))
+            swap_bytes = dtype.itemsize > 1 and fields.get('endian', 'little').lower() == 'big' and sys.byteorder == 'little'
+            src = gzip.GzipFile(fileobj=f, mode='rb') if encoding in ('gzip', 'gz') else f
+            copy_voxels(src, out, int(np.prod(sizes)) * dtype.itemsize, swap_bytes, dtype.itemsize)
+
+
+def nifti_header(sizes, dtype, ijk_to_ras):
+    """Pack a NIfTI-1 header with the sform set to the IJK to RAS matrix, as Slicer writes it."""
+    import struct
+    import numpy as np
+
+    spacing = np.linalg.norm(ijk_to_ras[:3, :3], axis=0)
+    values = [
+        NIFTI_HEADER_SIZE, b'', b'', 0, 0, b'r', b'\0',  # sizeof_hdr .. dim_info
+        3, sizes[0], sizes[1], sizes[2], 1, 1, 1, 1,  # dim
+        0.0, 0.0, 0.0,  # intent_p1, intent_p2, intent_p3
+        0, NIFTI_DATATYPES[dtype.str[1:]], dtype.itemsize * 8, 0,  # intent_code, datatype, bitpix, slice_start
+        1.0, spacing[0], spacing[1], spacing[2], 1.0, 1.0, 1.0, 1.0,  # pixdim
+        float(NIFTI_VOX_OFFSET), 1.0, 0.0,  # vox_offset, scl_slope, scl_inter
+        0, b'\0', b'\x02',  # slice_end, slice_code, xyzt_units (mm), as in FreeSurferCommonLib.VolumeIO
+        0.0, 0.0, 0.0, 0.0,  # cal_max, cal_min, slice_duration, toffset
+        0, 0, b'', b'',  # glmax, glmin, descrip, aux_file
+        0, 1,  # qform_code, sform_code (scanner)
+        0.0, 0.0, 0.0, 0.0, 0.0, 0.0,  # quatern_b .. qoffset_z
+        *ijk_to_ras[0], *ijk_to_ras[1], *ijk_to_ras[2],  # srow_x, srow_y, srow_z
+        b'', b'n+1\0',  # intent_name, magic
+    ]
+    return struct.pack('<' + NIFTI_HEADER_FORMAT, *values)
+
+
+def nifti_to_nrrd(ifile, ofile):
+    """Write the voxels of an uncompressed 3D NIfTI file to a raw NRRD file, translating the header only."""
+    import struct
+    import numpy as np
+
+    with open(ifile, 'rb') as f:
+        header = f.read(NIFTI_HEADER_SIZE)
+        if len(header) < NIFTI_HEADER_SIZE:
+            raise UnsupportedImage("Not a NIfTI file")
+        byte_order = '<' if struct.unpack('<i', header[:4])[0] == NIFTI_HEADER_SIZE else '>'
+        values = struct.unpack(byte_order + NIFTI_HEADER_FORMAT, header)
+        if values[0] != NIFTI_HEADER_SIZE or values[-1] not in (b'n+1\0', b'n+1'):
+            raise UnsupportedImage("Not a single-file NIfTI-1 image")
+        dim = values[7:15]
+        datatype, pixdim = values[19], values[22:30]
+        vox_offset, scl_slope, scl_inter = values[30:33]
+        qform_code, sform_code = values[44:46]
+        if dim[0] < 3 or any(d > 1 for d in dim[4:dim[0] + 1]):
+            raise UnsupportedImage("Only 3D NIfTI files are streamed")
+        # Unset scaling may be 0 or NaN
+        if (scl_slope == scl_slope and scl_slope not in (0.0, 1.0)) or (scl_inter == scl_inter and scl_inter != 0.0):
+            raise UnsupportedImage("Scaled NIfTI voxel values are not streamed")
+        dtypes = {value: key for key, value in NIFTI_DATATYPES.items()}
+        if datatype not in dtypes:
+            raise UnsupportedImage(f"NIfTI data type {datatype} is not supported")
+        dtype = np.dtype(byte_order + dtypes[datatype])
+        sizes = dim[1:4]
+
+        if sform_code > 0:
+            ijk_to_ras = np.eye(4)
+            ijk_to_ras[:3] = np.array(values[52:64]).reshape(3, 4)
+        elif qform_code > 0:
+            ijk_to_ras = quaternion_to_matrix(values[46:52], pixdim)
+        else:
+            ijk_to_ras = np.diag([pixdim[1], pixdim[2], pixdim[3], 1.0])
+
+        # NRRD geometry in LPS, as written by Slicer
+        ijk_to_lps = np.diag([-1.0, -1.0, 1.0, 1.0]) @ ijk_to_ras
+        directions = ' '.join('(' + ','.join(f'{x:.17g}' for x in ijk_to_lps[:3, axis]) + ')' for axis in range(3))
+        origin = '(' + ','.join(f'{x:.17g}' for x in ijk_to_lps[:3, 3]) + ')'
+
+        f.seek(int(vox_offset))
+        with open(ofile, 'wb') as out:
+            out.write((
+                "NRRD0004\n"
+                "# Complete NRRD file format specification at:\n"
+                "# http://teem.sourceforge.net/nrrd/format.html\n"
+                f"type: {NRRD_TYPE_NAMES[dtype.str[1:]]}\n"
+                "dimension: 3\n"
+                "space: left-posterior-superior\n"
+                f"sizes: {sizes[0]} {sizes[1]} {sizes[2]}\n"
+                f"space directions: {directions}\n"
+                "kinds: domain domain domain\n"
+                f"endian: {'little' if byte_order == '<' else 'big'}\n"
+                "encoding: raw\n"
+                f"space origin: {origin}\n"
+                "\n").encode('latin-1'))
+            copy_voxels(f, out, int(np.prod(sizes)) * dtype.itemsize)
+
+
+def quaternion_to_matrix(quaternion, pixdim):
+    """IJK to RAS matrix of a NIfTI qform."""
+    import numpy as np
+
+    b, c, d, x, y, z = quaternion
+    a = np.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = np.array([
+        [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+        [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+        [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b],
+    ])
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    ijk_to_ras = np.eye(4)
+    ijk_to_ras[:3, :3] = rotation * [pixdim[1], pixdim[2], pixdim[3] * qfac]
+    ijk_to_ras[:3, 3] = [x, y, z]
+    return ijk_to_ras
+
+
+def convert_image(ifile, ofile):
+    """
+    Convert an image between NRRD and NIfTI by copying its voxels and translating its header,
+    without loading the whole image. Other images are converted with SimpleITK.
+    """
+    try:
+        if has_extension(ifile, ('.nrrd', '.nhdr')) and has_extension(ofile, ('.nii',)):
+            return nrrd_to_nifti(ifile, ofile)
+        if has_extension(ifile, ('.nii',)) and has_extension(ofile, ('.nrrd',)):
+            return nifti_to_nrrd(ifile, ofile)
+    except (UnsupportedImage, ValueError, KeyError) as e:
+        if DEBUG:
+            print(f"Converting {ifile} with SimpleITK: {e}")
+    convert_image_sitk(ifile, ofile)
+
+
+def synthstrip_supports(path, flag):
+    """Check whether the mri_synthstrip script accepts a command line option."""
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            source = f.read()
+    except OSError:
+        return False
+    return f"'{flag}'" in source or f'"{flag}"' in source
+
+
 def main(args):
     import tempfile
     import subprocess, os
+    from concurrent.futures import ThreadPoolExecutor
     from pathlib import Path
 
     with tempfile.TemporaryDirectory() as temp_dir:
@@ -27,17 +284,25 @@ def main(args):
         if DEBUG:
             print("temp_path:", temp_path)
 
-        # Temporary image files in FreeSurfer format
-        temp_image = str(temp_path / 'input.mgz')
-        temp_out = str(temp_path / 'stripped.mgz')
-        temp_mask = str(temp_path / 'mask.mgz')
+        # Images read and written by mri_synthstrip: FreeSurfer formats are used directly,
+        # other images are converted from and to uncompressed NIfTI temporary files
+        if has_extension(args.image, FREESURFER_EXTENSIONS):
+            temp_image = args.image
+        else:
+            temp_image = str(temp_path / 'input.nii')
+            convert_image(args.image, temp_image)
+        outputs = []
+        temp_out = temp_mask = None
+        if args.out:
+            temp_out = args.out if has_extension(args.out, FREESURFER_EXTENSIONS) else str(temp_path / 'stripped.nii')
+            if temp_out != args.out:
+                outputs.append([temp_out, args.out])
+        if args.mask:
+            temp_mask = args.mask if has_extension(args.mask, FREESURFER_EXTENSIONS) else str(temp_path / 'mask.nii')
+            if temp_mask != args.mask:
+                outputs.append([temp_mask, args.mask])
         if DEBUG:
             print(temp_image)
-
-        # Convert image to FreeSurfer mgz format
-        convert_image(args.image, temp_image)
-
-        if DEBUG:
             os.listdir(temp_path)
 
         fs_env = os.environ.copy()
@@ -47,14 +312,14 @@ def main(args):
         fs_env['PYTHONHOME'] = ''
         if DEBUG:
             print("PYTHONHOME:", fs_env['PYTHONHOME'])
-            print("PYTHONPATH:", fs_env['PYTHONPATH'])
+            print("PYTHONPATH:", fs_env.get('PYTHONPATH'))
         print("FREESURFER_HOME:", fs_env['FREESURFER_HOME'])
 
         cmd = [fs_env['FREESURFER_HOME'] + '/bin/mri_synthstrip']
         cmd.extend(['--image', temp_image])
-        if args.out:
+        if temp_out:
             cmd.extend(['--out', temp_out])
-        if args.mask:
+        if temp_mask:
             cmd.extend(['--mask', temp_mask])
         if args.gpu:
             cmd.extend(['--gpu'])
@@ -62,21 +327,23 @@ def main(args):
             cmd.extend(['--border', args.border])
         if args.nocsf:
             cmd.extend(['--no-csf'])
+        if args.threads:
+            for name in THREAD_VARIABLES:
+                fs_env[name] = str(args.threads)
+            if synthstrip_supports(cmd[0], '--threads'):
+                cmd.extend(['--threads', str(args.threads)])
         print("Command:", " ".join(cmd))
         subprocess.check_output(cmd, env=fs_env)
 
-        # Convert images to NRRD
-        outputs = []
-        if args.out is not None:
-            outputs.append([temp_out, args.out])
-        if args.mask is not None:
-            outputs.append([temp_mask, args.mask])
-        for temp_fname, args_fname in outputs:
-            convert_image(temp_fname, args_fname)
+        # Convert the outputs in parallel
+        with ThreadPoolExecutor(max_workers=max(1, len(outputs))) as executor:
+            for future in [executor.submit(convert_image, temp_fname, args_fname) for temp_fname, args_fname in outputs]:
+                future.result()
 
 
 if __name__ == "__main__":
     import argparse
+    import os
 
     if DEBUG:
         print(sys.argv[0])
@@ -112,6 +379,10 @@ if __name__ == "__main__":
     parser.add_argument('--nocsf', action=argparse.BooleanOptionalAction,
                         help='Exclude CSF from brain border.')
 
+    # Number of CPU threads (0: all the CPU cores).
+    parser.add_argument('--threads', type=int, default=0,
+                        help='Number of CPU threads. Default (0) uses all the CPU cores.')
+
     # TODO: Add this later if anyone requests it.
     #   --model file          Alternative model weights.
 
@@ -127,6 +398,17 @@ if __name__ == "__main__":
         print("User must request output for either Stripped Volume or Mask Volume, or both.", file=sys.stderr)
         sys.exit(1)
 
+    # Check the FreeSurfer installation before converting any image
+    freesurfer_home = os.environ.get('FREESURFER_HOME')
+    if not freesurfer_home:
+        print("FreeSurfer installation not found: set the FREESURFER_HOME environment variable"
+              " to the FreeSurfer installation folder.", file=sys.stderr)
+        sys.exit(1)
+    if not os.access(os.path.join(freesurfer_home, 'bin', 'mri_synthstrip'), os.X_OK):
+        print(f"mri_synthstrip not found in {freesurfer_home}/bin: FreeSurfer 7.3.2 or higher is required.",
+              file=sys.stderr)
+        sys.exit(1)
+
     # NOTE: Do not print anything to stdout before this line (print errors only).
 
     main(args)
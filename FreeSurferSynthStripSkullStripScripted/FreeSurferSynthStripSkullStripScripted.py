@@ -7,8 +7,7 @@ import slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
-DEBUG = True
-
+from FreeSurferCommonLib import ProcessingWidgetMixin
 
 #
 # FreeSurferSynthStripSkullStripScripted
@@ -23,7 +22,7 @@ class FreeSurferSynthStripSkullStripScripted(ScriptedLoadableModule):
         ScriptedLoadableModule.__init__(self, parent)
         self.parent.title = "FreeSurfer SynthStrip Skull Strip"
         self.parent.categories = ["Segmentation"]
-        self.parent.dependencies = []
+        self.parent.dependencies = ["FreeSurferCommon"]
         self.parent.contributors = ["Benjamin Zwick (ISML)"]
         # TODO: update with short description of the module and a link to online module documentation
         self.parent.helpText = """Skull stripping for head studies using SynthStrip from FreeSurfer.
@@ -70,7 +69,8 @@ def registerSampleData():
 # FreeSurferSynthStripSkullStripScriptedWidget
 #
 
-class FreeSurferSynthStripSkullStripScriptedWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
+class FreeSurferSynthStripSkullStripScriptedWidget(ScriptedLoadableModuleWidget, VTKObservationMixin,
+                                                   ProcessingWidgetMixin):
     """Uses ScriptedLoadableModuleWidget base class, available at:
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
     """
@@ -81,6 +81,7 @@ class FreeSurferSynthStripSkullStripScriptedWidget(ScriptedLoadableModuleWidget,
         """
         ScriptedLoadableModuleWidget.__init__(self, parent)
         VTKObservationMixin.__init__(self)  # needed for parameter node observation
+        ProcessingWidgetMixin.__init__(self)
         self.logic = None
         self._parameterNode = None
         self._updatingGUIFromParameterNode = False
@@ -117,12 +118,17 @@ class FreeSurferSynthStripSkullStripScriptedWidget(ScriptedLoadableModuleWidget,
         self.ui.inputImageSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
         self.ui.outputImageSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
         self.ui.outputMaskSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+        self.ui.outputSegmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
         self.ui.gpuCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
         self.ui.borderThresholdSliderWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
         self.ui.nocsfCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+        self.ui.threadsSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+        self.ui.stripFromMaskCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
 
         # Buttons
         self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.ui.cancelButton.connect('clicked(bool)', self.onCancelButton)
+        self.ui.progressBar.hide()
 
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
@@ -131,6 +137,7 @@ class FreeSurferSynthStripSkullStripScriptedWidget(ScriptedLoadableModuleWidget,
         """
         Called when the application closes and the module widget is destroyed.
         """
+        self.onCancelButton()
         self.removeObservers()
 
     def enter(self):
@@ -214,24 +221,23 @@ class FreeSurferSynthStripSkullStripScriptedWidget(ScriptedLoadableModuleWidget,
         self.ui.inputImageSelector.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume"))
         self.ui.outputImageSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputVolume"))
         self.ui.outputMaskSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputMask"))
+        self.ui.outputSegmentationSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputSegmentation"))
         self.ui.gpuCheckBox.checked = (self._parameterNode.GetParameter("UseGPU") == "true")
         self.ui.borderThresholdSliderWidget.value = float(self._parameterNode.GetParameter("BorderThreshold"))
         self.ui.nocsfCheckBox.checked = (self._parameterNode.GetParameter("ExcludeCSF") == "true")
+        self.ui.threadsSpinBox.value = int(self._parameterNode.GetParameter("Threads"))
+        self.ui.stripFromMaskCheckBox.checked = (self._parameterNode.GetParameter("StripFromMask") == "true")
 
         # Update buttons states and tooltips
-        if self._parameterNode.GetNodeReference("InputVolume"):
-            if self._parameterNode.GetNodeReference("OutputVolume"):
-                self.ui.applyButton.toolTip = "Compute output stripped image volume"
-                self.ui.applyButton.enabled = True
-            if self._parameterNode.GetNodeReference("OutputMask"):
-                self.ui.applyButton.toolTip = "Compute output binary brain mask volume"
-                self.ui.applyButton.enabled = True
-            if (self._parameterNode.GetNodeReference("OutputVolume") and
-                self._parameterNode.GetNodeReference("OutputMask")):
-                self.ui.applyButton.toolTip = "Compute output output image volume and binary brain mask volume"
-                self.ui.applyButton.enabled = True
+        outputs = [description for role, description in (("OutputVolume", "stripped image volume"),
+                                                          ("OutputMask", "binary brain mask volume"),
+                                                          ("OutputSegmentation", "brain segmentation"))
+                   if self._parameterNode.GetNodeReference(role)]
+        if self._parameterNode.GetNodeReference("InputVolume") and outputs:
+            self.ui.applyButton.toolTip = "Compute output " + " and ".join(outputs)
+            self.ui.applyButton.enabled = True
         else:
-            self.ui.applyButton.toolTip = "Select input and output image volume or binary brain mask volume nodes"
+            self.ui.applyButton.toolTip = "Select input and output image volume, binary brain mask volume or segmentation nodes"
             self.ui.applyButton.enabled = False
 
         # All the GUI updates are done
@@ -251,9 +257,12 @@ class FreeSurferSynthStripSkullStripScriptedWidget(ScriptedLoadableModuleWidget,
         self._parameterNode.SetNodeReferenceID("InputVolume", self.ui.inputImageSelector.currentNodeID)
         self._parameterNode.SetNodeReferenceID("OutputVolume", self.ui.outputImageSelector.currentNodeID)
         self._parameterNode.SetNodeReferenceID("OutputMask", self.ui.outputMaskSelector.currentNodeID)
+        self._parameterNode.SetNodeReferenceID("OutputSegmentation", self.ui.outputSegmentationSelector.currentNodeID)
         self._parameterNode.SetParameter("UseGPU", "true" if self.ui.gpuCheckBox.checked else "false")
         self._parameterNode.SetParameter("BorderThreshold", str(self.ui.borderThresholdSliderWidget.value))
         self._parameterNode.SetParameter("ExcludeCSF", "true" if self.ui.nocsfCheckBox.checked else "false")
+        self._parameterNode.SetParameter("Threads", str(self.ui.threadsSpinBox.value))
+        self._parameterNode.SetParameter("StripFromMask", "true" if self.ui.stripFromMaskCheckBox.checked else "false")
 
         self._parameterNode.EndModify(wasModified)
 
@@ -263,13 +272,26 @@ class FreeSurferSynthStripSkullStripScriptedWidget(ScriptedLoadableModuleWidget,
         """
         with slicer.util.tryWithErrorDisplay("Failed to compute results.", waitCursor=True):
 
-            # Compute output
-            self.logic.process(self.ui.inputImageSelector.currentNode(),
-                               self.ui.outputImageSelector.currentNode(),
-                               self.ui.outputMaskSelector.currentNode(),
-                               self.ui.gpuCheckBox.checked,
-                               self.ui.borderThresholdSliderWidget.value,
-                               self.ui.nocsfCheckBox.checked)
+            # Skip the run if inputs, parameters and outputs are unchanged since the last successful run
+            fingerprint = self.outdatedFingerprint(['InputVolume'],
+                                                   ['OutputVolume', 'OutputMask', 'OutputSegmentation'])
+            if fingerprint is None:
+                return
+
+            # Compute output in the background
+            job = self.logic.createProcessingJob(self.ui.inputImageSelector.currentNode(),
+                                                 self.ui.outputImageSelector.currentNode(),
+                                                 self.ui.outputMaskSelector.currentNode(),
+                                                 self.ui.gpuCheckBox.checked,
+                                                 self.ui.borderThresholdSliderWidget.value,
+                                                 self.ui.nocsfCheckBox.checked,
+                                                 self.ui.outputSegmentationSelector.currentNode(),
+                                                 self.ui.threadsSpinBox.value or None,
+                                                 self.ui.stripFromMaskCheckBox.checked,
+                                                 onOutput=self.onProcessingOutput,
+                                                 onProgress=self.onProcessingProgress,
+                                                 onFinished=self.onProcessingFinished)
+            self.startJob(job, fingerprint)
 
 
 #
@@ -302,107 +324,224 @@ class FreeSurferSynthStripSkullStripScriptedLogic(ScriptedLoadableModuleLogic):
             parameterNode.SetParameter("BorderThreshold", "1")
         if not parameterNode.GetParameter("ExcludeCSF"):
             parameterNode.SetParameter("ExcludeCSF", "false")
+        if not parameterNode.GetParameter("Threads"):
+            # Default number of threads of the runtime (all CPU cores)
+            parameterNode.SetParameter("Threads", "0")
+        if not parameterNode.GetParameter("StripFromMask"):
+            parameterNode.SetParameter("StripFromMask", "true")
 
     def process(self, inputImageNode,
                 outputImageNode=None, outputMaskNode=None,
-                useGPU=False, borderThreshold=1, excludeCSF=False):
-        """
-        Run the processing algorithm.
-        Can be used without GUI widget.
-        # FIXME: Update documentation
-        :param inputVolume: volume to be thresholded
-        :param outputVolume: thresholding result
-        :param imageThreshold: values above/below this threshold will be set to 0
-        :param invert: if True then values above the threshold will be set to 0, otherwise values below are set to 0
-        :param showResult: show output volume in slice viewers
+                useGPU=False, borderThreshold=1, excludeCSF=False,
+                outputSegmentationNode=None, threads=None, stripFromMask=True):
+        """
+        Skull strip an image with mri_synthstrip.
+        Can be used without GUI widget. At least one of the output nodes must be set.
+        :param inputImageNode: scalar volume to skull strip
+        :param outputImageNode: scalar volume to load the stripped image into (optional)
+        :param outputMaskNode: labelmap volume or segmentation to load the binary brain mask into (optional)
+        :param useGPU: run SynthStrip on the GPU (--gpu)
+        :param borderThreshold: mask border threshold in mm (--border)
+        :param excludeCSF: exclude CSF from the brain border (--no-csf)
+        :param outputSegmentationNode: segmentation to store the brain mask in, in addition to outputMaskNode
+          (mri_synthstrip still runs once)
+        :param threads: number of CPU threads of mri_synthstrip, None for the default of PyTorch (all CPU cores)
+        :param stripFromMask: only let mri_synthstrip write the brain mask and compute the stripped image
+          from the input image and the mask, instead of writing and reading it as a second full volume;
+          the result is the same, see stripImage()
+        :return: ProcessingStats with the timing and resource usage of each processing stage
+        """
+        job = self.createProcessingJob(inputImageNode, outputImageNode, outputMaskNode,
+                                       useGPU, borderThreshold, excludeCSF, outputSegmentationNode, threads,
+                                       stripFromMask)
+        job.run()
+        return job.stats
+
+    def createProcessingJob(self, inputImageNode,
+                            outputImageNode=None, outputMaskNode=None,
+                            useGPU=False, borderThreshold=1, excludeCSF=False,
+                            outputSegmentationNode=None, threads=None, stripFromMask=True,
+                            onOutput=None, onFinished=None, onProgress=None):
+        """
+        Prepare the processing algorithm without running it.
+        The input volume is exported immediately and the returned job runs
+        mri_synthstrip and loads the results into the output nodes, either
+        synchronously with job.run() or in the background with job.start().
+        :param onOutput: called with each line of the mri_synthstrip output
+        :param onFinished: called with the job when it succeeded, failed or was cancelled
+        :param onProgress: called with a ProgressEvent when a processing stage starts
+        See process() for the description of the other parameters.
         """
 
         if not inputImageNode:
             raise ValueError("Input volume is undefined")
-        if not outputImageNode and not outputMaskNode:
-            raise ValueError("Output image or mask volume is undefined")
+        if not outputImageNode and not outputMaskNode and not outputSegmentationNode:
+            raise ValueError("Output image, mask volume or segmentation is undefined")
+        # The mask is written once, whatever the number of nodes it is loaded into
+        stripFromMask = bool(stripFromMask and outputImageNode)
+        needMask = bool(outputMaskNode or outputSegmentationNode or stripFromMask)
+        needOut = bool(outputImageNode and not stripFromMask)
 
-        import time
-        startTime = time.time()
         logging.info('Processing started')
 
-        import os
-        from pathlib import Path
-        import qt
-        # import subprocess
+        from FreeSurferCommonLib import (CommandJob, FreeSurferToolchain, ProcessingStats, ResultCache, StagingArea,
+                                         exportVolumeNode, threadEnvironment)
 
-        temp_dir = qt.QTemporaryDir()
-        temp_path = Path(temp_dir.path())
-        if DEBUG:
-            print("temp_path:", temp_path)
+        # Fail before exporting anything if FreeSurfer is not available
+        toolchain = FreeSurferToolchain.resolve()
+        logging.debug(f"FREESURFER_HOME: {toolchain.home}")
+
+        staging = StagingArea()
+        logging.debug(f"Staging folder: {staging.path}")
 
         # Temporary image files in FreeSurfer format
-        temp_image = str(temp_path / 'input.mgz')
-        temp_out = str(temp_path / 'stripped.mgz')
-        temp_mask = str(temp_path / 'mask.mgz')
-        if DEBUG:
-            print(temp_image)
-
-        # Convert image to FreeSurfer format
-        slicer.util.exportNode(inputImageNode, temp_image)
-
-        if DEBUG:
-            os.listdir(temp_path)
-
-        fs_env = os.environ.copy()
-        if DEBUG:
-            print(fs_env)
-        # Use system Python environment
-        fs_env['PYTHONHOME'] = ''
-        if DEBUG:
-            print("PYTHONHOME:", fs_env['PYTHONHOME'])
-            print("PYTHONPATH:", fs_env['PYTHONPATH'])
-        print("FREESURFER_HOME:", fs_env['FREESURFER_HOME'])
-
-        args = [fs_env['FREESURFER_HOME'] + '/bin/mri_synthstrip']
-        args.extend(['--image', temp_image])
-        if outputImageNode:
-            args.extend(['--out', temp_out])
-        if outputMaskNode:
-            args.extend(['--mask', temp_mask])
+        temp_image = staging.file('input')
+        temp_out = staging.file('stripped')
+        temp_mask = staging.file('mask')
+
+        stats = ProcessingStats('FreeSurferSynthStripSkullStripScripted')
+        stats.info['inputDimensions'] = list(inputImageNode.GetImageData().GetDimensions())
+        stats.info['freeSurferVersion'] = toolchain.version
+        stats.info['threads'] = threads
+        stats.info['stripFromMask'] = stripFromMask
+
+        args = self.synthStripArgs(toolchain.home, temp_image,
+                                   temp_out if needOut else None,
+                                   temp_mask if needMask else None,
+                                   useGPU, borderThreshold, excludeCSF, threads)
+
+        # Reuse results of a previous run on the same volume with the same parameters
+        cache = ResultCache.fromSettings()
+        outputFiles = {}
+        if needOut:
+            outputFiles[staging.fileName('stripped')] = temp_out
+        if needMask:
+            outputFiles[staging.fileName('mask')] = temp_mask
+        with stats.stage('cache lookup'):
+            # The number of threads does not change the results, it is not part of the cache key, and the
+            # command is identified by its name so that the key does not depend on the installation folder
+            cacheArgs = self.synthStripArgs(
+                toolchain.home, staging.fileName('input'),
+                staging.fileName('stripped') if needOut else None,
+                staging.fileName('mask') if needMask else None,
+                useGPU, borderThreshold, excludeCSF)
+            cacheKey = cache.key(inputImageNode, [os.path.basename(cacheArgs[0])] + cacheArgs[1:],
+                                 stats.info['freeSurferVersion'])
+            cached = cache.lookup(cacheKey, outputFiles.keys())
+        if cached:
+            args = None
+            temp_out = cached.get(staging.fileName('stripped'))
+            temp_mask = cached.get(staging.fileName('mask'))
+        else:
+            # Convert image to FreeSurfer format
+            with stats.stage('export') as stage:
+                exportVolumeNode(inputImageNode, temp_image)
+                stage.wrote(temp_image)
+
+        def onCompleted():
+            if not cached:
+                with stats.stage('cache store'):
+                    cache.store(cacheKey, outputFiles)
+
+            # Load temporary files back into nodes
+            with stats.stage('import') as stage:
+                self.loadOutputs(temp_out if needOut else None, temp_mask, outputImageNode, outputMaskNode,
+                                 outputSegmentationNode, inputImageNode if stripFromMask else None)
+                stage.read(temp_out if needOut else None, temp_mask if needMask else None)
+
+        job = CommandJob(args, onCompleted=onCompleted, onOutput=onOutput, onFinished=onFinished, stats=stats,
+                         onProgress=onProgress, environment=threadEnvironment(threads))
+        job.resources.append(staging)
+        return job
+
+    def loadOutputs(self, outPath, maskPath, outputImageNode=None, outputMaskNode=None, outputSegmentationNode=None,
+                    inputImageNode=None):
+        """
+        Load mri_synthstrip output files into nodes.
+        The mask file is read once and all mask nodes are filled from the same array.
+        :param outPath: stripped image file, None to compute the stripped image from inputImageNode and the mask
+        :param maskPath: binary brain mask file
+        :param outputImageNode: scalar volume to load the stripped image into (optional)
+        :param outputMaskNode: labelmap volume or segmentation to load the brain mask into (optional)
+        :param outputSegmentationNode: segmentation to load the brain mask into (optional)
+        :param inputImageNode: input image the stripped image is computed from when outPath is None
+        """
+        from FreeSurferCommonLib import (importArrayToVolumeNode, importLabelmapToSegmentationNode, importVolumeNode,
+                                         readVolumeFile)
+
+        # Create color table for brain mask (mask will have the 'tissue' label with value '1')
+        colorTableNode = slicer.mrmlScene.GetFirstNodeByName('GenericAnatomyColors')
+
+        if outputImageNode and outPath:
+            importVolumeNode(outPath, outputImageNode)
+
+        maskNodes = [node for node in (outputMaskNode, outputSegmentationNode) if node]
+        for maskNode in maskNodes:
+            if maskNode.GetTypeDisplayName() not in ('LabelMapVolume', 'Segmentation'):
+                raise NotImplementedError
+        stripFromMask = bool(outputImageNode and not outPath)
+        if not maskNodes and not stripFromMask:
+            return
+        voxels, ijkToRAS = readVolumeFile(maskPath)
+        if stripFromMask:
+            # mri_synthstrip writes the mask in the space of the input image
+            importArrayToVolumeNode(self.stripImage(slicer.util.arrayFromVolume(inputImageNode), voxels),
+                                    ijkToRAS, outputImageNode)
+        for maskNode in maskNodes:
+            if maskNode.GetTypeDisplayName() == 'LabelMapVolume':
+                importArrayToVolumeNode(voxels, ijkToRAS, maskNode)
+                maskNode.GetDisplayNode().SetAndObserveColorNodeID(colorTableNode.GetID())
+            else:
+                importLabelmapToSegmentationNode(voxels, ijkToRAS, maskNode, colorTableNode)
+
+    @staticmethod
+    def stripImage(imageVoxels, maskVoxels):
+        """
+        Remove the voxels outside the brain mask, as mri_synthstrip does when writing the stripped image:
+        they are set to the background value, the minimum of 0 and of the image.
+        :param imageVoxels: input image array
+        :param maskVoxels: brain mask array of the same shape
+        :return: new stripped image array, of the type of the input image
+        """
+        import numpy as np
+        if imageVoxels.shape != maskVoxels.shape:
+            raise ValueError(f"Brain mask dimensions {maskVoxels.shape} differ from input image dimensions"
+                             f" {imageVoxels.shape}")
+        background = np.asarray(min(0, imageVoxels.min()), dtype=imageVoxels.dtype)
+        return np.where(maskVoxels != 0, imageVoxels, background)
+
+    def synthStripArgs(self, freeSurferHome, imagePath, outPath=None, maskPath=None,
+                       useGPU=False, borderThreshold=1, excludeCSF=False, threads=None):
+        """
+        Build the mri_synthstrip command line.
+        :param freeSurferHome: FreeSurfer installation folder
+        :param imagePath: input image file
+        :param outPath: stripped image file (optional)
+        :param maskPath: binary brain mask file (optional)
+        :param threads: number of CPU threads, passed as --threads if mri_synthstrip supports it
+          (FreeSurfer 7.4 and later); the thread environment variables are set by the caller
+        """
+        from FreeSurferCommonLib import FreeSurferToolchain
+
+        toolchain = FreeSurferToolchain.resolve(freeSurferHome)
+        if excludeCSF:
+            toolchain.checkFlags('mri_synthstrip', ['--no-csf'])
+
+        args = [toolchain.binary('mri_synthstrip')]
+        args.extend(['--image', imagePath])
+        if outPath:
+            args.extend(['--out', outPath])
+        if maskPath:
+            args.extend(['--mask', maskPath])
         if useGPU:
             args.extend(['--gpu'])
         if borderThreshold != 1:
             args.extend(['--border', str(borderThreshold)])
         if excludeCSF:
             args.extend(['--no-csf'])
-        print("Command:", args)
-        #subprocess.check_output(args, env=fs_env)
-        proc = slicer.util.launchConsoleProcess(args)
-        slicer.util.logProcessOutput(proc)
-
-        # Create color table for brain mask (mask will have the 'tissue' label with value '1')
-        colorTableNode = slicer.mrmlScene.GetFirstNodeByName('GenericAnatomyColors')
-
-        # Load temporary files back into nodes
-        if outputImageNode:
-            storage = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLVolumeArchetypeStorageNode')
-            storage.SetFileName(temp_out)
-            storage.ReadData(outputImageNode)
-            slicer.mrmlScene.RemoveNode(storage)
-        if outputMaskNode:
-            if outputMaskNode.GetTypeDisplayName() == 'LabelMapVolume':
-                storage = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLVolumeArchetypeStorageNode')
-                storage.SetFileName(temp_mask)
-                storage.ReadData(outputMaskNode)
-                slicer.mrmlScene.RemoveNode(storage)
-                if outputMaskNode.GetDisplayNode() is None:
-                    outputMaskNode.CreateDefaultDisplayNodes()
-                outputMaskNode.GetDisplayNode().SetAndObserveColorNodeID(colorTableNode.GetID())
-            elif outputMaskNode.GetTypeDisplayName() == 'Segmentation':
-                labelmap = slicer.util.loadLabelVolume(temp_mask, properties={'colorNodeID': colorTableNode.GetID()})
-                slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmap, outputMaskNode)
-                slicer.mrmlScene.RemoveNode(labelmap)
-            else:
-                raise NotImplementedError
-
-        stopTime = time.time()
-        logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
+        if threads and toolchain.supportsFlag('mri_synthstrip', '--threads'):
+            args.extend(['--threads', str(threads)])
+        return args
 
 
 #
@@ -441,7 +580,109 @@ class FreeSurferSynthStripSkullStripScriptedTest(ScriptedLoadableModuleTest):
 
         self.delayDisplay("Starting the test")
 
-        # TODO: add tests...
-        self.delayDisplay("This test does nothing!")
+        import numpy as np
+        from FreeSurferCommonLib import fakeFreeSurferInstallation
+
+        logic = FreeSurferSynthStripSkullStripScriptedLogic()
+
+        # Voxels outside the mask are set to the background value, as mri_synthstrip does
+        image = np.array([[-5, 3], [7, 9]], dtype=np.int16)
+        mask = np.array([[1, 0], [0, 1]], dtype=np.uint8)
+        stripped = logic.stripImage(image, mask)
+        self.assertEqual(stripped.dtype, image.dtype)
+        np.testing.assert_array_equal(stripped, [[-5, -5], [-5, 9]])
+        np.testing.assert_array_equal(logic.stripImage(image + 10, mask), [[5, 0], [0, 19]])
+        np.testing.assert_array_equal(logic.stripImage(image.astype(np.float32) / 2, mask), [[-2.5, -2.5], [-2.5, 4.5]])
+        with self.assertRaises(ValueError):
+            logic.stripImage(image, mask[:1])
+
+        # Fake mri_synthstrip copying the input image to the output files: an input image
+        # of zeros and ones is its own brain mask
+        synthStrip = """#!/bin/sh
+if [ "$1" = "--help" ]; then
+    echo "usage: mri_synthstrip -i IMAGE -o OUT -m MASK --gpu --border BORDER --no-csf --threads THREADS"
+    exit 0
+fi
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --image) image="$2"; shift ;;
+        --out) out="$2"; shift ;;
+        --mask) mask="$2"; shift ;;
+    esac
+    shift
+done
+echo "Configuring model on the CPU"
+echo "Running SynthStrip model version 1"
+if [ -n "$out" ]; then cp "$image" "$out"; fi
+if [ -n "$mask" ]; then cp "$image" "$mask"; fi
+"""
+        with fakeFreeSurferInstallation({'mri_synthstrip': synthStrip}) as freeSurferHome:
+
+            # Test the command line
+            args = logic.synthStripArgs(freeSurferHome, 'in.nii', 'out.nii', 'mask.nii')
+            self.assertEqual(args[0], os.path.join(freeSurferHome, 'bin', 'mri_synthstrip'))
+            self.assertEqual(args[1:], ['--image', 'in.nii', '--out', 'out.nii', '--mask', 'mask.nii'])
+            args = logic.synthStripArgs(freeSurferHome, 'in.nii', maskPath='mask.nii', useGPU=True,
+                                        borderThreshold=2, excludeCSF=True, threads=4)
+            self.assertEqual(args[1:], ['--image', 'in.nii', '--mask', 'mask.nii', '--gpu', '--border', '2',
+                                        '--no-csf', '--threads', '4'])
+
+            # Test the module logic
+            inputVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Input')
+            inputVoxels = np.zeros((12, 14, 16), dtype=np.int16)
+            inputVoxels[3:9, 4:10, 5:11] = 1
+            slicer.util.updateVolumeFromArray(inputVolume, inputVoxels)
+            inputVolume.SetSpacing(0.9, 1.1, 1.3)
+            inputVolume.SetOrigin(10, -20, 30)
+
+            # The stripped image is computed from the mask by default
+            outputVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+            outputMask = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+            job = logic.createProcessingJob(inputVolume, outputVolume, outputMask, threads=2)
+            self.assertNotIn('--out', job.commands[0])
+            self.assertIn('--mask', job.commands[0])
+            self.assertEqual(job.commands[0][-2:], ['--threads', '2'])
+            self.assertEqual(job.environment['OMP_NUM_THREADS'], '2')
+            job.run()
+            self.assertEqual([event.stage for event in job.events], ['started', 'model loading', 'prediction', 'finished'])
+            np.testing.assert_array_equal(slicer.util.arrayFromVolume(outputMask), inputVoxels)
+            np.testing.assert_array_equal(slicer.util.arrayFromVolume(outputVolume), inputVoxels)
+            np.testing.assert_allclose(outputVolume.GetSpacing(), inputVolume.GetSpacing(), atol=1e-4)
+            np.testing.assert_allclose(outputVolume.GetOrigin(), inputVolume.GetOrigin(), atol=1e-4)
+
+            # Same stripped image as written by mri_synthstrip
+            writtenVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+            job = logic.createProcessingJob(inputVolume, writtenVolume, stripFromMask=False)
+            self.assertIn('--out', job.commands[0])
+            self.assertNotIn('--mask', job.commands[0])
+            job.run()
+            np.testing.assert_array_equal(slicer.util.arrayFromVolume(writtenVolume),
+                                          slicer.util.arrayFromVolume(outputVolume))
+
+            with self.assertRaises(ValueError):
+                logic.createProcessingJob(inputVolume)
+
+        if not os.environ.get('FREESURFER_HOME'):
+            self.delayDisplay('FREESURFER_HOME is not set, mri_synthstrip is not run')
+            return
+
+        # Get/create input data
+
+        import SampleData
+        inputVolume = SampleData.downloadSample('MRHead')
+        self.delayDisplay('Loaded test data set')
+
+        outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+        outputMask = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+
+        # Test the module logic
+
+        logic.process(inputVolume, outputVolume, outputMask)
+        strippedVoxels = slicer.util.arrayFromVolume(outputVolume)
+        maskVoxels = slicer.util.arrayFromVolume(outputMask)
+        self.assertEqual(strippedVoxels.shape, maskVoxels.shape)
+        self.assertGreater(maskVoxels.sum(), 0)
+        self.assertLess(maskVoxels.sum(), maskVoxels.size)
+        self.assertFalse(((strippedVoxels != 0) & (maskVoxels == 0)).any())
 
         self.delayDisplay('Test passed')